@@ -7,4 +7,22 @@ License: MIT
 
 __version__ = "2.2.2"
 
-from passporteye.mrz.image import read_mrz
+# The image processing stack (scikit-image, scipy, ...) takes a while to import, so the names below are only imported
+# from passporteye.mrz.image when first used (PEP 562). E.g. `import passporteye.mrz.text` does not need any of it.
+_LAZY_NAMES = {name: 'passporteye.mrz.image'
+               for name in ['read_mrz', 'read_all_mrz', 'read_mrz_many', 'read_mrz_async', 'locate_mrz', 'MRZReader']}
+
+__all__ = list(_LAZY_NAMES)
+
+
+def __getattr__(name):
+    if name not in _LAZY_NAMES:
+        raise AttributeError("module %r has no attribute %r" % (__name__, name))
+    import importlib
+    value = getattr(importlib.import_module(_LAZY_NAMES[name]), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_LAZY_NAMES))
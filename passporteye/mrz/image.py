@@ -5,28 +5,72 @@ Image processing for MRZ extraction.
 Author: Konstantin Tretyakov
 License: MIT
 '''
+import asyncio
+import contextvars
+import functools
+import hashlib
 import io
+import mmap
+import os
+import sys
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, CancelledError, FIRST_COMPLETED, as_completed, wait
 import numpy as np
-from skimage import transform, morphology, filters, measure
+from scipy import ndimage, sparse
+from skimage import transform, morphology, filters, measure, color, util
 from skimage import io as skimage_io # So as not to clash with builtin io
-from ..util.pdf import extract_first_jpeg_in_pdf
 from ..util.pipeline import Pipeline
 from ..util.geometry import RotatedBox
-from ..util.ocr import ocr
-from .text import MRZ
+from ..util.ocr import ocr, ocr_async
+from ..util.profiling import Timings, traced
+from ..util.cache import content_hash
+from .text import MRZ, MRZOCRCleaner, MRZVoter
 
 
 class Loader(object):
-    """Loads `file` to `img`."""
+    """Loads `file` to `img`. The file may be a filename, a stream, the data of the file (bytes or any object supporting
+    the buffer protocol, such as a mmap), or an already decoded image: a numpy array (grayscale, RGB or RGBA) or a PIL image.
+    Arrays may be of any integer dtype or floats (in [0, 1], or in 0..255 or 0..65535), see _normalize_range.
+    TIFF files (given by name or as a buffer) are memory-mapped and only their first page is decoded."""
 
     __depends__ = []
     __provides__ = ['img']
+    __cacheable__ = True  # The results of the component may be stored in Pipeline.cache (see Pipeline.cache_key)
 
     def __init__(self, file, as_gray=True, pdf_aware=True):
         self.file = file
         self.as_gray = as_gray
         self.pdf_aware = pdf_aware
 
+    def fingerprint(self):
+        """Identifies the image by a hash of the file contents (rather than the file name), see util.cache.fingerprint.
+        Returns None (so that the results are not cached) for streams which can not be read twice, such as pipes or sockets."""
+        h = self._content_hash()
+        return None if h is None else 'Loader(%s, as_gray=%r, pdf_aware=%r)' % (h, self.as_gray, self.pdf_aware)
+
+    def _content_hash(self):
+        f = self.file
+        if isinstance(f, str):
+            with open(f, 'rb') as fh:
+                return _stream_hash(fh)
+        elif isinstance(f, io.IOBase):
+            if not f.seekable():
+                return None
+            start = f.tell()
+            try:
+                return _stream_hash(f)
+            finally:
+                f.seek(start)
+        elif isinstance(f, np.ndarray):
+            return content_hash(repr((f.shape, f.dtype.str)).encode('utf-8'), np.ascontiguousarray(f))
+        elif _is_pil_image(f):
+            return content_hash(repr((f.mode, f.size)).encode('utf-8'), f.tobytes())
+        try:
+            return content_hash(_BufferStream(f).view)
+        except TypeError:
+            return None
+
     def _imread(self, file):
         """Proxy to skimage.io.imread with some fixes."""
         # For now, we have to select the imageio plugin to read image from byte stream
@@ -34,25 +78,206 @@ class Loader(object):
         # code can be simplified at that time.  See issue report and pull request:
         # https://github.com/scikit-image/scikit-image/issues/2889
         # https://github.com/scikit-image/scikit-image/pull/3126
+        start = file.tell() if isinstance(file, io.IOBase) and file.seekable() else None
         img = skimage_io.imread(file, as_gray=self.as_gray, plugin='imageio')
         if img is not None and len(img.shape) != 2:
             # The PIL plugin somewhy fails to load some images
+            if start is not None:
+                file.seek(start)
             img = skimage_io.imread(file, as_gray=self.as_gray, plugin='matplotlib')
         return img
 
     def __call__(self):
+        if self.multi_page:
+            return next(self.iter_images(), (None, None))[1]
         if isinstance(self.file, str):
-            if self.pdf_aware and self.file.lower().endswith('.pdf'):
-                with open(self.file, 'rb') as f:
-                    img_data = extract_first_jpeg_in_pdf(f)
-                if img_data is None:
-                    return None
-                return self._imread(img_data)
-            else:
-                return self._imread(self.file)
-        elif isinstance(self.file, (bytes, io.IOBase)):
             return self._imread(self.file)
-        return None
+        elif isinstance(self.file, io.IOBase):
+            return self._imread(self.file)
+        elif isinstance(self.file, np.ndarray):
+            return self._from_array(self.file)
+        elif _is_pil_image(self.file):
+            return self._from_array(_pil_to_array(self.file))
+        try:
+            # bytes, bytearray, mmap, memoryview or anything else supporting the buffer protocol
+            stream = _BufferStream(self.file)
+        except TypeError:
+            return None
+        return self._imread(stream)
+
+    @property
+    def multi_page(self):
+        """Is the file of a kind which may contain several images (a PDF or a TIFF file), see iter_images."""
+        if isinstance(self.file, str):
+            fn = self.file.lower()
+            return (self.pdf_aware and fn.endswith('.pdf')) or fn.endswith(('.tif', '.tiff'))
+        return self._tiff_buffer() is not None
+
+    def _tiff_buffer(self):
+        """If the file is a buffer-protocol object with TIFF data, returns a _BufferStream over it, otherwise None."""
+        if isinstance(self.file, (str, io.IOBase, np.ndarray)) or _is_pil_image(self.file):
+            return None
+        try:
+            stream = _BufferStream(self.file)
+        except TypeError:
+            return None
+        return stream if _is_tiff(stream.view[:4]) else None
+
+    def iter_images(self):
+        """Yields (page, img) pairs for all the images of the file: every image embedded in a PDF (along with the index
+        of its page, see iter_pdf_images), every page of a TIFF file, or the single image of any other file (with page 0).
+        The images are decoded one at a time, as they are consumed."""
+        if not self.multi_page:
+            img = self()
+            if img is not None:
+                yield 0, img
+        elif isinstance(self.file, str) and self.file.lower().endswith('.pdf'):
+            from ..util.pdf import iter_pdf_images  # Imported here, as pdfminer is only needed for PDFs
+            with open(self.file, 'rb') as f:
+                for page, img in iter_pdf_images(f):
+                    yield page, self._from_array(img)
+        elif isinstance(self.file, str):
+            with open(self.file, 'rb') as f:
+                try:
+                    mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                except (ValueError, OSError):
+                    mapped = None
+            if mapped is None:
+                yield 0, self._imread(self.file)
+            else:
+                yield from self._iter_tiff(_BufferStream(mapped))
+        else:
+            yield from self._iter_tiff(self._tiff_buffer())
+
+    def _iter_tiff(self, stream):
+        """Yields (page, img) pairs for the pages of a TIFF file in a _BufferStream, decoding one page at a time.
+        Pages which are not compressed are not even copied: they are views of the buffer (e.g. of the memory-mapped file)."""
+        try:
+            import tifffile
+        except ImportError:
+            yield 0, self._imread(stream)
+            return
+        with tifffile.TiffFile(stream) as tif:
+            for i, page in enumerate(tif.pages):
+                if page.photometric not in (tifffile.PHOTOMETRIC.MINISBLACK, tifffile.PHOTOMETRIC.RGB):
+                    # Palette, inverted, YCbCr, etc: leave the conversion to PIL
+                    yield i, self._from_array(_pil_to_array(_pil_tiff_page(stream, i)))
+                    continue
+                if page.is_contiguous and page.bitspersample == page.dtype.itemsize * 8:
+                    dtype = page.dtype.newbyteorder(tif.byteorder)
+                    img = np.frombuffer(stream.view, dtype, count=int(np.prod(page.shape)),
+                                        offset=page.dataoffsets[0]).reshape(page.shape)
+                else:
+                    img = page.asarray()
+                if page.planarconfig == tifffile.PLANARCONFIG.SEPARATE and img.ndim == 3:
+                    img = np.moveaxis(img, 0, -1)
+                yield i, self._from_array(img)
+
+    def _from_array(self, img):
+        """Converts an already decoded image the same way as _imread would do. In particular, a grayscale image is returned as is
+        (without copying it), as long as its dtype is one the image processing understands (see _normalize_range)."""
+        img = _normalize_range(img)
+        if img.ndim == 3 and img.shape[2] == 1:
+            img = img[..., 0]
+        if img.ndim > 2 and self.as_gray:
+            if img.shape[2] == 4:
+                img = color.rgba2rgb(img)
+            img = color.rgb2gray(img)
+        return img
+
+
+class _BufferStream(io.RawIOBase):
+    """A read-only stream over an object supporting the buffer protocol (e.g. a mmap or a bytearray), which does not copy
+    the data in advance. The underlying bytes are available as a memoryview in the `view` attribute."""
+
+    def __init__(self, buffer):
+        view = memoryview(buffer)
+        self.view = view.cast('B') if view.c_contiguous else memoryview(view.tobytes())
+        self.pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, b):
+        n = max(min(len(b), len(self.view) - self.pos), 0)
+        b[:n] = self.view[self.pos:self.pos + n]
+        self.pos += n
+        return n
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self.pos = offset
+        elif whence == io.SEEK_CUR:
+            self.pos += offset
+        elif whence == io.SEEK_END:
+            self.pos = len(self.view) + offset
+        else:
+            raise ValueError("Invalid whence: %s" % whence)
+        return self.pos
+
+    def tell(self):
+        return self.pos
+
+
+def _stream_hash(f):
+    """A hash of the rest of the stream (see util.cache.content_hash), read in chunks."""
+    h = hashlib.sha1()
+    for chunk in iter(lambda: f.read(1 << 20), b''):
+        h.update(chunk)
+    return h.hexdigest()
+
+
+def _is_tiff(header):
+    """Does the file start with the TIFF (or BigTIFF) signature?"""
+    return bytes(header[:4]) in (b'II*\x00', b'MM\x00*', b'II+\x00', b'MM\x00+')
+
+
+def _is_pil_image(obj):
+    """Is obj a PIL image? (PIL is not a dependency, so we only check if it has been imported by someone already)"""
+    pil_image = sys.modules.get('PIL.Image')
+    return pil_image is not None and isinstance(obj, pil_image.Image)
+
+
+def _pil_tiff_page(stream, index):
+    """Opens the given page of a TIFF file in a _BufferStream with PIL (which is always available along with imageio)."""
+    from PIL import Image
+    img = Image.open(_BufferStream(stream.view))
+    img.seek(index)
+    return img
+
+
+def _normalize_range(img):
+    """Images of the dtypes which skimage interprets correctly (bool, uint8, uint16 and floats in [0, 1]) are returned as is.
+    Other integer images (e.g. int32 or int64 arrays, PIL images of mode 'I') and float images with values above 1
+    are rescaled to floats in [0, 1]: values up to 255 are taken to be 8-bit, up to 65535 - 16-bit,
+    larger ones are divided by the maximum. Negative values are clipped to 0.
+
+    >>> _normalize_range(np.array([[0, 128, 255]])).tolist()
+    [[0.0, 0.5019607843137255, 1.0]]
+    >>> _normalize_range(np.array([[0, 1000, 65535]], dtype=np.int32)).tolist()[0][2]
+    1.0
+    >>> _normalize_range(np.array([[0.0, 255.0]])).tolist(), _normalize_range(np.array([[0, 200]], dtype=np.uint8)).dtype
+    ([[0.0, 1.0]], dtype('uint8'))
+    """
+    if img.dtype in (np.bool_, np.uint8, np.uint16) or img.dtype.kind not in 'iuf' or img.size == 0:
+        return img
+    hi = img.max()
+    if img.dtype.kind == 'f' and hi <= 1:
+        return img
+    scale = 255.0 if hi <= 255 else 65535.0 if hi <= 65535 else float(hi)
+    return np.clip(img / scale, 0, 1)
+
+
+def _pil_to_array(img):
+    """Converts a PIL image to a numpy array, grayscale, RGB or RGBA."""
+    if img.mode in ('1', 'LA'):
+        img = img.convert('L')
+    elif img.mode not in ('L', 'RGB', 'RGBA', 'I', 'I;16', 'F'):
+        img = img.convert('RGB')
+    return np.asarray(img)
 
 
 class Scaler(object):
@@ -60,6 +285,7 @@ class Scaler(object):
 
     __depends__ = ['img']
     __provides__ = ['img_small', 'scale_factor']
+    __cacheable__ = True
 
     def __init__(self, max_width=250):
         self.max_width = max_width
@@ -74,6 +300,66 @@ class Scaler(object):
         return img_small, scale_factor
 
 
+class QualityAssessor(object):
+    """Computes a few cheap image quality metrics of `img_small` and decides whether the image is hopeless for MRZ extraction.
+    Outputs `quality` - a dictionary with the fields:
+        - `contrast`: the difference between the 99.9% and 0.1% percentiles of pixel intensities,
+        - `sharpness`: variance of the Laplacian, normalized by the variance of the image (so that it does not depend
+                       on the amount of content on the page),
+        - `overexposed`, `underexposed`: fraction of saturated white and black pixels,
+        - `reason`: None if the image passed all the checks, otherwise one of 'overexposed', 'underexposed', 'blank', 'blurry'.
+    Any of the thresholds may be set to None to disable the corresponding check."""
+
+    __depends__ = ['img_small']
+    __provides__ = ['quality']
+    __cacheable__ = True
+
+    def __init__(self, min_contrast=0.05, min_sharpness=0.03, max_overexposed=0.99, max_underexposed=0.99, max_width=250):
+        """
+        :param max_width: images wider than that are subsampled to approximately this width before computing the metrics,
+                          so that the metrics are comparable for different Scaler settings.
+        """
+        self.min_contrast = min_contrast
+        self.min_sharpness = min_sharpness
+        self.max_overexposed = max_overexposed
+        self.max_underexposed = max_underexposed
+        self.max_width = max_width
+
+    def __call__(self, img_small):
+        step = int(np.ceil(img_small.shape[1] / float(self.max_width)))
+        # Images narrower than Scaler.max_width are not rescaled, hence may still be e.g. uint8
+        img = util.img_as_float(img_small[::step, ::step])
+        lo, hi = np.percentile(img, [0.1, 99.9])
+        quality = {'contrast': float(hi - lo),
+                   'sharpness': _sharpness(img),
+                   'overexposed': float(np.mean(img >= 0.98)),
+                   'underexposed': float(np.mean(img <= 0.02)),
+                   'reason': None}
+        if self.max_overexposed is not None and quality['overexposed'] > self.max_overexposed:
+            quality['reason'] = 'overexposed'
+        elif self.max_underexposed is not None and quality['underexposed'] > self.max_underexposed:
+            quality['reason'] = 'underexposed'
+        elif self.min_contrast is not None and quality['contrast'] < self.min_contrast:
+            quality['reason'] = 'blank'
+        elif self.min_sharpness is not None and quality['sharpness'] < self.min_sharpness:
+            quality['reason'] = 'blurry'
+        return quality
+
+
+@functools.lru_cache(maxsize=None)
+def _footprint(shape, size):
+    """Structuring elements ('square' or 'disk') are built once and shared (hence read-only)."""
+    footprint = morphology.square(size) if shape == 'square' else morphology.disk(size)
+    footprint.flags.writeable = False
+    return footprint
+
+
+def _sharpness(img):
+    """Variance of the Laplacian of the image, normalized by the variance of the image."""
+    variance = img.var()
+    return float(filters.laplace(img).var() / variance) if variance > 0 else 0.0
+
+
 class BooneTransform(object):
     """Processes `img_small` according to Hans Boone's method
     (http://www.pyimagesearch.com/2015/11/30/detecting-machine-readable-zones-in-passport-images/)
@@ -81,12 +367,13 @@ class BooneTransform(object):
 
     __depends__ = ['img_small']
     __provides__ = ['img_binary']
+    __cacheable__ = True
 
     def __init__(self, square_size=5):
         self.square_size = square_size
 
     def __call__(self, img_small):
-        m = morphology.square(self.square_size)
+        m = _footprint('square', self.square_size)
         img_th = morphology.black_tophat(img_small, m)
         img_sob = abs(filters.sobel_v(img_th))
         img_closed = morphology.closing(img_sob, m)
@@ -99,6 +386,7 @@ class MRZBoxLocator(object):
 
     __depends__ = ['img_binary']
     __provides__ = ['boxes']
+    __cacheable__ = True
 
     def __init__(self, max_boxes=4, min_points_in_contour=50, min_area=500, min_box_aspect=5, angle_tol=0.1,
                  lineskip_tol=1.5, box_type='bb'):
@@ -185,6 +473,227 @@ class MRZBoxLocator(object):
                 box.angle = 0.0
         return box_list
 
+class PriorRegionBoxLocator(object):
+    """Extracts putative MRZs as RotatedBox instances only from the "prior" regions of `img_small`, i.e. the parts of the
+    image where an MRZ is most likely to be located. These are the strips of the given relative size along the
+    bottom, top, left and right sides of the image (i.e. the bottom part of the document in each of the four orientations).
+    Only the boxes running along the corresponding side are kept (e.g. horizontal boxes in the bottom strip, vertical ones in the left strip).
+    Boxes are returned in the coordinates of `img_small`, in the order of the sides."""
+
+    __depends__ = ['img_small']
+    __provides__ = ['prior_boxes']
+    __cacheable__ = True
+
+    SIDES = ('bottom', 'top', 'left', 'right')
+
+    def __init__(self, fraction=0.4, sides=SIDES, boone=None, box_locator=None):
+        """
+        :param fraction: the size of each strip relative to the corresponding image dimension.
+        :param sides: the sides to look at, in order.
+        :param boone: the BooneTransform instance to apply to each strip (by default, one with default parameters is created).
+        :param box_locator: the MRZBoxLocator instance to apply to each strip (by default, one with default parameters is created).
+        """
+        self.fraction = fraction
+        self.sides = sides
+        self.boone = boone or BooneTransform()
+        self.box_locator = box_locator or MRZBoxLocator()
+
+    def __call__(self, img_small):
+        results = []
+        for side in self.sides:
+            strip, offset = self._strip(img_small, side)
+            if min(strip.shape[0:2]) < 3:
+                continue
+            horizontal = side in ('bottom', 'top')
+            for box in self.box_locator(self.boone(strip)):
+                box = box.translated(offset)
+                if (abs(abs(box.angle) - np.pi / 2) < np.pi / 4) == horizontal and not _is_near_any(box, results):
+                    results.append(box)
+        return results
+
+    def _strip(self, img, side):
+        """Returns the strip of the image along the given side (as a view) and its offset."""
+        h, w = img.shape[0], img.shape[1]
+        dh, dw = int(h * self.fraction), int(w * self.fraction)
+        if side == 'bottom':
+            return img[h - dh:], (h - dh, 0)
+        elif side == 'top':
+            return img[:dh], (0, 0)
+        elif side == 'left':
+            return img[:, :dw], (0, 0)
+        elif side == 'right':
+            return img[:, w - dw:], (0, w - dw)
+        else:
+            raise ValueError("Unknown side: %s" % side)
+
+
+class TiledMRZBoxLocator(object):
+    """Extracts putative MRZs from pages with several documents (e.g. a flatbed scan of a few passports).
+    The page `img` is scaled down so that its width is at most max_width, and then processed by BooneTransform and MRZBoxLocator
+    in overlapping square tiles of size tile_size, hence the cost of detection grows linearly with the area of the page.
+    The overlap (as a fraction of tile_size) should be large enough so that each MRZ fits completely into at least one tile.
+    Fragments of an MRZ cut by the tile borders are dropped in favour of the larger boxes containing them.
+    Boxes are returned in the coordinates of `img`, in reading order."""
+
+    __depends__ = ['img']
+    __provides__ = ['tiled_boxes']
+    __cacheable__ = True
+
+    def __init__(self, max_width=600, tile_size=400, overlap=0.5, boone=None, box_locator=None):
+        """
+        :param boone: the BooneTransform instance to apply to each tile (by default, one with default parameters is created).
+        :param box_locator: the MRZBoxLocator instance to apply to each tile (by default, one looking for up to 8 boxes is created).
+        """
+        self.scaler = Scaler(max_width)
+        self.tile_size = tile_size
+        self.step = max(1, int(tile_size * (1 - overlap)))
+        self.boone = boone or BooneTransform()
+        self.box_locator = box_locator or MRZBoxLocator(max_boxes=8)
+
+    def __call__(self, img):
+        img_small, scale_factor = self.scaler(img)
+        boxes = []
+        for offset in self._tile_offsets(img_small.shape):
+            tile = img_small[offset[0]:offset[0] + self.tile_size, offset[1]:offset[1] + self.tile_size]
+            if min(tile.shape[0:2]) < 3 or tile.min() == tile.max():
+                continue
+            boxes.extend(box.translated(offset) for box in self.box_locator(self.boone(tile)))
+
+        # Drop the duplicates and fragments found in the overlapping parts of the tiles
+        boxes.sort(key=lambda b: -b.area)
+        results = []
+        for box in boxes:
+            if not any(b.contains(box.center) for b in results) and not _is_near_any(box, results):
+                results.append(box)
+        results.sort(key=lambda b: (int(b.cx / self.step), b.cy))
+        return [box.scaled(1.0 / scale_factor) for box in results]
+
+    def _tile_offsets(self, shape):
+        """Offsets of the tiles covering an image of the given shape."""
+        def starts(n):
+            last = max(n - self.tile_size, 0)
+            return sorted(set(list(range(0, last, self.step)) + [last]))
+        return [(r, c) for r in starts(shape[0]) for c in starts(shape[1])]
+
+
+def _is_near_any(box, boxes):
+    """Is the center of the given box closer than its height to the center of any of the boxes (i.e. is it most probably a duplicate)?"""
+    return any(np.linalg.norm(box.center - b.center) < max(box.height, b.height) for b in boxes)
+
+
+class MRZBoxScorer(object):
+    """Computes a cheap "MRZ-likeness" score in [0, 1] for each of the `boxes`, looking at the corresponding region of `img_small`.
+    The score combines three texture features of the region:
+        - periodicity of the column profile (MRZ characters are printed with a fixed pitch),
+        - number of text lines (an MRZ has 2 or 3 lines),
+        - density of ink/paper transitions along the text lines.
+    It is used to order the boxes before they are passed to (the much more expensive) OCR."""
+
+    __depends__ = ['boxes', 'img_small']
+    __provides__ = ['box_scores']
+    __cacheable__ = True
+
+    def __init__(self, margin=2, smooth_width=9, min_pitch=3, max_pitch=10, transition_density=0.3):
+        """
+        :param margin: margin (in pixels of img_small) added around the box when extracting the region.
+        :param smooth_width: the column profile is detrended by subtracting its moving average of this width.
+        :param min_pitch: the smallest expected character pitch (in pixels of img_small).
+        :param max_pitch: the largest expected character pitch (in pixels of img_small).
+        :param transition_density: the number of ink/paper transitions per pixel along a text line for which the
+                                   corresponding feature gets its maximum value.
+        """
+        self.margin = margin
+        self.smooth_width = smooth_width
+        self.min_pitch = min_pitch
+        self.max_pitch = max_pitch
+        self.transition_density = transition_density
+
+    def __call__(self, boxes, img_small):
+        return [self.score(box, img_small) for box in boxes]
+
+    def score(self, box, img_small):
+        roi = box.extract_from_image(img_small, 1.0, self.margin, self.margin)
+        if roi.shape[0] < 3 or roi.shape[1] < 3:
+            return 0.0
+        lo, hi = np.percentile(roi, [2, 98])
+        if hi - lo < 1e-3:
+            return 0.0
+        roi = np.clip((roi - lo) / (hi - lo), 0, 1)
+        ink = roi < filters.threshold_otsu(roi)
+
+        # Text lines are the rows with at least half of the maximal ink density
+        rows = ink.mean(1)
+        in_line = rows > 0.5 * rows.max()
+        n_lines = int(in_line[0]) + np.count_nonzero(in_line[1:] & ~in_line[:-1])
+        lines_score = 1.0 if n_lines in (2, 3) else (0.5 if n_lines in (1, 4) else 0.0)
+
+        transitions = np.count_nonzero(ink[in_line, 1:] != ink[in_line, :-1], axis=1).mean() / ink.shape[1]
+        transitions_score = min(transitions / self.transition_density, 1.0)
+
+        return float(0.5 * self._pitch_score(roi[in_line].mean(0)) + 0.25 * lines_score + 0.25 * transitions_score)
+
+    def _pitch_score(self, profile):
+        """Normalized autocorrelation peak of the detrended column profile at lags corresponding to the character pitch."""
+        k = self.smooth_width
+        if len(profile) < 2 * k + 2 * self.max_pitch:
+            return 0.0
+        profile = (profile - np.convolve(profile, np.ones(k) / k, 'same'))[k:-k]
+        ac = np.correlate(profile, profile, 'full')[len(profile) - 1:]
+        if ac[0] <= 0:
+            return 0.0
+        return max(ac[self.min_pitch:self.max_pitch + 1].max() / ac[0], 0.0)
+
+
+class SkewEstimator(object):
+    """Estimates the skew of the document as the dominant direction of the `boxes`: the circular mean of the box angles,
+    weighted by box area times box_score**score_power. The angles of long text lines (such as those of the MRZ, which also
+    get the highest box_scores) are by far the most precise ones, while the boxes around photos or logos hardly say
+    anything about the skew, hence the strong weighting by the score.
+    The result `skew` follows the RotatedBox.angle convention (np.pi/2 is the "normal orientation"), or is None if there are no boxes."""
+
+    __depends__ = ['boxes', 'box_scores']
+    __provides__ = ['skew']
+    __cacheable__ = True
+
+    def __init__(self, score_power=4):
+        self.score_power = score_power
+
+    def __call__(self, boxes, box_scores):
+        # The direction of a box is only defined up to np.pi, hence we average the doubled angles
+        v = sum(b.area * s ** self.score_power * np.exp(2j * b.angle) for b, s in zip(boxes, box_scores))
+        if abs(v) == 0:
+            return None
+        return float(np.angle(v) / 2)
+
+
+class Deskewer(object):
+    """Snaps the angles of the `boxes` to the dominant direction `skew` of the document: boxes aligned with it (up to angle_tol)
+    get exactly the angle of the document (np.pi/2 when it is already straight up to straight_tol, so that their regions
+    are extracted as slices of the image, without interpolation). Thus short or ragged boxes, whose own angle is imprecise,
+    are extracted at the angle of the whole document, and all the regions have the same, upright, orientation.
+
+    The image itself is not straightened: RotatedBox.extract_from_image only warps the pixels of the region of a box,
+    which costs less than straightening the whole (full-resolution) image even when several boxes are tried.
+    The `boxes_straight` are in the coordinates of `img_small`, like the `boxes`."""
+
+    __depends__ = ['boxes', 'skew']
+    __provides__ = ['boxes_straight']
+    __cacheable__ = True
+
+    def __init__(self, angle_tol=0.02, straight_tol=0.01):
+        self.angle_tol = angle_tol
+        self.straight_tol = straight_tol
+
+    def __call__(self, boxes, skew):
+        if skew is None:
+            return boxes
+        # The smallest rotation which makes the dominant direction horizontal, and the upright direction of the text
+        # in the original image (boxes pointing the opposite way are flipped to it)
+        rotation = (np.pi - skew) % np.pi - np.pi / 2
+        angle = np.pi / 2 if abs(rotation) <= self.straight_tol else np.pi / 2 - rotation
+        return [b.aligned(angle, self.angle_tol) for b in boxes]
+
+
 class ExtractAllBoxes(object):
     """Extract all the images from the boxes, for external OCR processing"""
 
@@ -196,21 +705,38 @@ class ExtractAllBoxes(object):
 
 
 class FindFirstValidMRZ(object):
-    """Iterates over boxes found by MRZBoxLocator, passes them to BoxToMRZ, finds the first valid MRZ
-    or the best-scoring MRZ"""
+    """Iterates over boxes found by MRZBoxLocator in the order of decreasing box_scores, passes them to BoxToMRZ,
+    finds the first valid MRZ or the best-scoring MRZ. Images rejected by the QualityAssessor are not processed at all.
+    With debug=True, all the attempts are recorded as (roi, text, mrz) triples in the `__debug__mrz` item of the pipeline data."""
 
     __provides__ = ['box_idx', 'roi', 'text', 'mrz']
-    __depends__ = ['boxes', 'img', 'img_small', 'scale_factor', '__data__']
+    __depends__ = ['quality', 'boxes', 'box_scores', 'img', 'img_small', 'scale_factor', '__data__']
 
-    def __init__(self, use_original_image=True, extra_cmdline_params=''):
-        self.box_to_mrz = BoxToMRZ(use_original_image, extra_cmdline_params=extra_cmdline_params)
+    def __init__(self, use_original_image=True, extra_cmdline_params='', min_box_score=0.0, debug=False, ocr=None):
+        """
+        :param min_box_score: boxes with a box_score below this value are not passed to OCR at all. By default every box
+                              is tried (as before the boxes were scored): a threshold depends on the kind of documents and images,
+                              and is best chosen by running evaluate_mrz --min-box-score on a sample of them.
+        :param debug: when True, the ROIs, texts and MRZs of all the boxes tried are kept in data['__debug__mrz'].
+        :param ocr: the OCR backend, see BoxToMRZ.
+        """
+        self.box_to_mrz = BoxToMRZ(use_original_image, extra_cmdline_params=extra_cmdline_params, ocr=ocr)
+        self.min_box_score = min_box_score
+        self.debug = debug
 
-    def __call__(self, boxes, img, img_small, scale_factor, data):
+    def __call__(self, quality, boxes, box_scores, img, img_small, scale_factor, data):
         mrzs = []
-        data['__debug__mrz'] = []
-        for i, b in enumerate(boxes):
-            roi, text, mrz = self.box_to_mrz(b, img, img_small, scale_factor)
-            data['__debug__mrz'].append((roi, text, mrz))
+        if self.debug:
+            data['__debug__mrz'] = []
+        if quality['reason'] is not None:
+            return None, None, None, None
+        order = sorted(range(len(boxes)), key=lambda j: -box_scores[j])
+        for i in order:
+            if box_scores[i] < self.min_box_score:
+                break
+            roi, text, mrz = self.box_to_mrz(boxes[i], img, img_small, scale_factor)
+            if self.debug:
+                data['__debug__mrz'].append((roi, text, mrz))
             if mrz.valid:
                 return i, roi, text, mrz
             elif mrz.valid_score > 0:
@@ -222,29 +748,99 @@ class FindFirstValidMRZ(object):
             return mrzs[-1]
 
 
+class FindFirstValidMRZInPriorRegions(FindFirstValidMRZ):
+    """Cascaded version of FindFirstValidMRZ. First tries the boxes found by the PriorRegionBoxLocator, and only if none of them
+    results in a valid MRZ, falls back to the boxes found in the whole image (skipping those which were already tried).
+    The `box_idx` output refers to the list `prior_boxes + boxes`. The pipeline keys of the fallback boxes and their scores
+    are given by the fallback_keys attribute (e.g. ('boxes_straight', 'box_scores'), see MRZPipeline(..., deskew=True))."""
+
+    fallback_keys = ('boxes', 'box_scores')
+
+    __depends__ = ['quality', 'prior_boxes', 'prior_box_scores', 'img', 'img_small', 'scale_factor', '__data__', '__pipeline__']
+
+    def __call__(self, quality, prior_boxes, prior_box_scores, img, img_small, scale_factor, data, __pipeline__):
+        parent = super(FindFirstValidMRZInPriorRegions, self)
+        result = parent.__call__(quality, prior_boxes, prior_box_scores, img, img_small, scale_factor, data)
+        if quality['reason'] is not None or (result[3] is not None and result[3].valid):
+            return result
+
+        # Fall back to the whole image
+        boxes, box_scores = __pipeline__[self.fallback_keys[0]], __pipeline__[self.fallback_keys[1]]
+        idx = [i for i, b in enumerate(boxes) if not _is_near_any(b, prior_boxes)]
+        debug_mrz = data.get('__debug__mrz')
+        fallback = parent.__call__(quality, [boxes[i] for i in idx], [box_scores[i] for i in idx], img, img_small, scale_factor, data)
+        if self.debug:
+            data['__debug__mrz'] = debug_mrz + data['__debug__mrz']
+        if fallback[3] is not None and (result[3] is None or fallback[3].valid_score > result[3].valid_score):
+            return (len(prior_boxes) + idx[fallback[0]],) + tuple(fallback[1:])
+        return result
+
+
+class FindAllValidMRZ(object):
+    """Passes each of the `tiled_boxes` (found by TiledMRZBoxLocator) to BoxToMRZ and returns the list of all valid MRZs,
+    in the order of the boxes. The boxes are OCR-ed concurrently (OCR runs as a separate tesseract process, hence threads suffice).
+    Each returned MRZ has its box stored as aux['box'] (in the coordinates of `img`).
+    Images rejected by the QualityAssessor are not processed at all."""
+
+    __provides__ = ['all_mrz']
+    __depends__ = ['quality', 'tiled_boxes', 'img']
+
+    def __init__(self, extra_cmdline_params='', max_workers=None, ocr=None):
+        """
+        :param max_workers: the maximum number of boxes OCR-ed concurrently (by default, as chosen by ThreadPoolExecutor).
+        :param ocr: the OCR backend, see BoxToMRZ.
+        """
+        self.box_to_mrz = BoxToMRZ(use_original_image=True, extra_cmdline_params=extra_cmdline_params, ocr=ocr)
+        self.max_workers = max_workers
+
+    def __call__(self, quality, tiled_boxes, img):
+        if quality['reason'] is not None or not tiled_boxes:
+            return []
+        with ThreadPoolExecutor(self.max_workers) as executor:
+            # (the context is copied so that the OCR calls are reported to the profiling hooks of the pipeline, if any)
+            futures = [executor.submit(contextvars.copy_context().run, self.box_to_mrz, box, img, img, 1.0) for box in tiled_boxes]
+            results = [future.result() for future in futures]
+
+        mrzs, seen = [], set()
+        for box, (roi, text, mrz) in zip(tiled_boxes, results):
+            # The same MRZ may be read from several overlapping boxes
+            key = tuple(mrz.to_dict().items())
+            if mrz.valid and key not in seen:
+                seen.add(key)
+                mrz.aux['box'] = box
+                mrz.aux['roi'] = roi
+                mrzs.append(mrz)
+        return mrzs
+
+
 class BoxToMRZ(object):
     """Extracts ROI from the image, corresponding to a box found by MRZBoxLocator, does OCR and MRZ parsing on this region."""
 
     __provides__ = ['roi', 'text', 'mrz']
     __depends__ = ['box', 'img', 'img_small', 'scale_factor']
 
-    def __init__(self, use_original_image=True, extra_cmdline_params=''):
+    def __init__(self, use_original_image=True, extra_cmdline_params='', ocr=None):
         """
         :param use_original_image: when True, the ROI is extracted from img, otherwise from img_small
+        :param ocr: the OCR backend: a function with the signature of util.ocr.ocr (by default, this is util.ocr.ocr)
         """
         self.use_original_image = use_original_image
         self.extra_cmdline_params = extra_cmdline_params
+        self.ocr = ocr
+
+    def _ocr(self, roi):
+        return traced('ocr', 'ocr', self.ocr or ocr, roi, extra_cmdline_params=self.extra_cmdline_params)
 
     def __call__(self, box, img, img_small, scale_factor):
         img = img if self.use_original_image else img_small
         scale = 1.0 / scale_factor if self.use_original_image else 1.0
-        roi = box.extract_from_image(img, scale)
-        text = ocr(roi, extra_cmdline_params=self.extra_cmdline_params)
+        roi = traced('roi', 'extract_roi', box.extract_from_image, img, scale)
+        text = self._ocr(roi)
 
         if '>>' in text or ('>' in text and '<' not in text):
             # Most probably we need to reverse the ROI
             roi = roi[::-1, ::-1]
-            text = ocr(roi, extra_cmdline_params=self.extra_cmdline_params)
+            text = self._ocr(roi)
 
         if '<' not in text:
             # Assume this is unrecoverable and stop here (TODO: this may be premature, although it saves time on useless stuff)
@@ -252,67 +848,97 @@ class BoxToMRZ(object):
 
         mrz = MRZ.from_ocr(text)
         mrz.aux['method'] = 'direct'
+        readings = [('direct', text)]
 
-        # Now try improving the result via hacks
+        # Now try improving the result via hacks. After each one, the readings obtained so far are also combined
+        # character by character, as different variants often get different characters right.
         if not mrz.valid:
-            text, mrz = self._try_larger_image(roi, text, mrz)
+            text, mrz = self._try_larger_image(roi, text, mrz, readings=readings)
+        if not mrz.valid:
+            text, mrz = self._try_consensus(readings, text, mrz)
 
         # Sometimes the filter used for enlargement is important!
         if not mrz.valid:
-            text, mrz = self._try_larger_image(roi, text, mrz, 1)
+            text, mrz = self._try_larger_image(roi, text, mrz, 1, readings=readings)
+        if not mrz.valid:
+            text, mrz = self._try_consensus(readings, text, mrz)
 
         if not mrz.valid:
-            text, mrz = self._try_black_tophat(roi, text, mrz)
+            text, mrz = self._try_black_tophat(roi, text, mrz, readings=readings)
+        if not mrz.valid:
+            text, mrz = self._try_consensus(readings, text, mrz)
 
         return roi, text, mrz
 
-    def _try_larger_image(self, roi, cur_text, cur_mrz, filter_order=3):
+    def _try_larger_image(self, roi, cur_text, cur_mrz, filter_order=3, readings=None):
         """Attempts to improve the OCR result by scaling the image. If the new mrz is better, returns it, otherwise returns
-        the old mrz."""
+        the old mrz. The new OCR result is appended to readings (if given)."""
         if roi.shape[1] <= 700:
             scale_by = int(1050.0 / roi.shape[1] + 0.5)
             roi_lg = transform.rescale(roi, scale_by, order=filter_order, mode='constant', channel_axis=None,
                                        anti_aliasing=True)
-            new_text = ocr(roi_lg, extra_cmdline_params=self.extra_cmdline_params)
+            new_text = self._ocr(roi_lg)
             new_mrz = MRZ.from_ocr(new_text)
             new_mrz.aux['method'] = 'rescaled(%d)' % filter_order
+            if readings is not None:
+                readings.append((new_mrz.aux['method'], new_text))
             if new_mrz.valid_score > cur_mrz.valid_score:
                 cur_mrz = new_mrz
                 cur_text = new_text
         return cur_text, cur_mrz
 
-    def _try_black_tophat(self, roi, cur_text, cur_mrz):
-        roi_b = morphology.black_tophat(roi, morphology.disk(5))
+    def _try_black_tophat(self, roi, cur_text, cur_mrz, readings=None):
+        roi_b = morphology.black_tophat(roi, _footprint('disk', 5))
         # There are some examples where this line basically hangs for an undetermined amount of time.
-        new_text = ocr(roi_b, extra_cmdline_params=self.extra_cmdline_params)
+        new_text = self._ocr(roi_b)
         new_mrz = MRZ.from_ocr(new_text)
+        if readings is not None:
+            readings.append(('black_tophat', new_text))
         if new_mrz.valid_score > cur_mrz.valid_score:
             new_mrz.aux['method'] = 'black_tophat'
             cur_text, cur_mrz = new_text, new_mrz
 
-        new_text, new_mrz = self._try_larger_image(roi_b, cur_text, cur_mrz)
+        rescaled = []
+        new_text, new_mrz = self._try_larger_image(roi_b, cur_text, cur_mrz, readings=rescaled)
+        if readings is not None:
+            readings.extend(('black_tophat(%s)' % method, text) for method, text in rescaled)
         if new_mrz.valid_score > cur_mrz.valid_score:
             new_mrz.aux['method'] = 'black_tophat(rescaled(3))'
             cur_text, cur_mrz = new_text, new_mrz
 
         return cur_text, cur_mrz
 
+    def _try_consensus(self, readings, cur_text, cur_mrz):
+        """Combines the OCR readings (a list of (method, text) pairs) character by character (see MRZVoter).
+        If the result is better than the current mrz, returns it, otherwise returns the current one."""
+        voter = MRZVoter()
+        for _, text in readings:
+            voter.add(MRZOCRCleaner.apply(text))
+        if voter.count < 2:
+            return cur_text, cur_mrz
+        new_mrz = voter.result()
+        if new_mrz.valid_score > cur_mrz.valid_score:
+            new_mrz.aux['method'] = 'consensus(%s)' % ','.join(method for method, _ in readings)
+            return new_mrz.aux['raw_text'], new_mrz
+        return cur_text, cur_mrz
+
 
 class TryOtherMaxWidth(object):
     """
     If mrz was not found so far in the current pipeline,
     changes the max_width parameter of the scaler to 1000 and reruns the pipeline again.
+    Images rejected by the QualityAssessor are not retried.
     """
 
     __provides__ = ['mrz_final']
-    __depends__ = ['mrz', '__pipeline__']
+    __depends__ = ['mrz', 'quality', 'img', 'img_binary', '__pipeline__']
 
     def __init__(self, other_max_width=1000):
         self.other_max_width = other_max_width
 
-    def __call__(self, mrz, __pipeline__):
+    def __call__(self, mrz, quality, img, img_binary, __pipeline__):
         # We'll only try this if we see that img_binary.mean() is very small or img.mean() is very large (i.e. image is mostly white).
-        if mrz is None and (__pipeline__['img_binary'].mean() < 0.01 or __pipeline__['img'].mean() > 0.95):
+        if mrz is None and quality['reason'] is None and (img_binary.mean() < 0.01 or img.mean() > 0.95):
             __pipeline__.replace_component('scaler', Scaler(self.other_max_width))
             new_mrz = __pipeline__['mrz']
             if new_mrz is not None:
@@ -322,17 +948,47 @@ class TryOtherMaxWidth(object):
 
 
 class MRZPipeline(Pipeline):
-    """This is the "currently best-performing" pipeline for parsing MRZ from a given image file."""
+    """This is the "currently best-performing" pipeline for parsing MRZ from a given image file.
+
+    :param prior_region: when given (e.g. 0.4), the pipeline first searches for the MRZ only in the strips of this relative size
+                         along each side of the image (see PriorRegionBoxLocator), falling back to the whole image only when this fails.
+    :param deskew: when True, the skew of the document is estimated once (see SkewEstimator) and the angles of all the boxes
+                   aligned with the document are snapped to it (see Deskewer). With prior_region, the skew of the prior boxes
+                   and that of the boxes of the whole image are estimated separately.
+    :param cache: a util.cache.StageCache: the results of the stages before OCR (loading, scaling, box detection, ...)
+                  are read from it when the same file is processed again with the same parameters, and stored there otherwise.
+    :param ocr: the OCR backend, see BoxToMRZ.
+    """
 
-    def __init__(self, file, extra_cmdline_params=''):
+    def __init__(self, file, extra_cmdline_params='', prior_region=None, deskew=False, cache=None, ocr=None):
         super(MRZPipeline, self).__init__()
         self.version = '1.0'  # In principle we might have different pipelines in use, so possible backward compatibility is an issue
         self.file = file
+        self.cache = cache
         self.add_component('loader', Loader(file))
         self.add_component('scaler', Scaler())
+        self.add_component('quality', QualityAssessor())
         self.add_component('boone', BooneTransform())
         self.add_component('box_locator', MRZBoxLocator())
-        self.add_component('mrz', FindFirstValidMRZ(extra_cmdline_params=extra_cmdline_params))
+        self.add_component('box_scorer', MRZBoxScorer())
+        if deskew:
+            self.add_component('skew', SkewEstimator())
+            self.add_component('deskewer', Deskewer())
+        if prior_region is None:
+            self.add_component('mrz', FindFirstValidMRZ(extra_cmdline_params=extra_cmdline_params, ocr=ocr), depends=[
+                'quality', 'boxes_straight' if deskew else 'boxes', 'box_scores', 'img', 'img_small', 'scale_factor', '__data__'])
+        else:
+            self.add_component('prior_box_locator', PriorRegionBoxLocator(prior_region))
+            self.add_component('prior_box_scorer', MRZBoxScorer(), ['prior_box_scores'], ['prior_boxes', 'img_small'])
+            mrz = FindFirstValidMRZInPriorRegions(extra_cmdline_params=extra_cmdline_params, ocr=ocr)
+            prior_boxes = 'prior_boxes'
+            if deskew:
+                self.add_component('prior_skew', SkewEstimator(), ['prior_skew'], ['prior_boxes', 'prior_box_scores'])
+                self.add_component('prior_deskewer', Deskewer(), ['prior_boxes_straight'], ['prior_boxes', 'prior_skew'])
+                mrz.fallback_keys = ('boxes_straight', 'box_scores')
+                prior_boxes = 'prior_boxes_straight'
+            self.add_component('mrz', mrz, depends=['quality', prior_boxes, 'prior_box_scores', 'img', 'img_small', 'scale_factor',
+                                                    '__data__', '__pipeline__'])
         self.add_component('other_max_width', TryOtherMaxWidth())
 
         # Step used by extract_mrz_rois (not even invoked by the standard result method)
@@ -342,17 +998,523 @@ class MRZPipeline(Pipeline):
     def result(self):
         return self['mrz_final']
 
+    @property
+    def rejection_reason(self):
+        """If the image was rejected by the quality check, returns the reason code (e.g. 'blank' or 'blurry'), otherwise None."""
+        return self['quality']['reason']
+
 
-def read_mrz(file, save_roi=False, extra_cmdline_params=''):
+class MultiMRZPipeline(Pipeline):
+    """A pipeline for reading all the MRZs on a page with several documents (e.g. a flatbed scan of a few passports).
+    See TiledMRZBoxLocator and FindAllValidMRZ."""
+
+    def __init__(self, file, extra_cmdline_params='', max_workers=None, ocr=None):
+        super(MultiMRZPipeline, self).__init__()
+        self.version = '1.0'
+        self.file = file
+        self.add_component('loader', Loader(file))
+        self.add_component('scaler', Scaler())
+        self.add_component('quality', QualityAssessor())
+        self.add_component('tiled_box_locator', TiledMRZBoxLocator())
+        self.add_component('all_mrz', FindAllValidMRZ(extra_cmdline_params=extra_cmdline_params, max_workers=max_workers, ocr=ocr))
+
+    @property
+    def result(self):
+        return self['all_mrz']
+
+    @property
+    def rejection_reason(self):
+        """If the image was rejected by the quality check, returns the reason code (e.g. 'blank' or 'blurry'), otherwise None."""
+        return self['quality']['reason']
+
+
+class MRZLocator(object):
+    """Detection-only counterpart of MRZPipeline for live camera frames: given an in-memory frame, runs only the
+    Scaler -> BooneTransform -> MRZBoxLocator steps and returns the putative MRZ boxes in the coordinates of the frame.
+
+    The per-frame work is kept to a minimum: the resampling matrices used for scaling (a plain area average rather than
+    the anti-aliased rescale of Scaler) and the work buffers are allocated once per frame shape and reused across calls. The buffers are kept per thread, so a single instance may be shared by several threads.
+    """
+
+    # The luminance weights of skimage.color.rgb2gray
+    RGB_WEIGHTS = np.array([0.2125, 0.7154, 0.0721])
+
+    def __init__(self, max_width=250, square_size=5, box_locator=None):
+        self.max_width = max_width
+        self.footprint = _footprint('square', square_size)
+        # The (separable) kernel of skimage.filters.sobel_v
+        self.sobel_kernel = np.array([1, 2, 1])[:, None] * np.array([1, 0, -1])[None, :] / 4.0
+        self.box_locator = box_locator or MRZBoxLocator()
+        self._local = threading.local()
+
+    def __call__(self, frame):
+        """
+        :param frame: a grayscale (h x w) or RGB(A) (h x w x 3/4) image, with integer or float [0, 1] values.
+        :return: a list of RotatedBox instances.
+        """
+        frame = np.asarray(frame)
+        buf = self._buffers(frame.shape)
+        gray = self._to_gray(frame, buf)
+        if buf.scale_factor == 1:
+            img_small = gray
+        else:
+            img_small = buf.rows_matrix.dot(buf.cols_matrix.dot(gray.T).T)
+        boxes = self.box_locator(self._boone(img_small, buf))
+        return [box.scaled(1.0 / buf.scale_factor) for box in boxes]
+
+    def _buffers(self, shape):
+        """Returns the work buffers of the current thread for frames of the given shape, allocating them if needed."""
+        buf = getattr(self._local, 'buffers', None)
+        if buf is not None and buf.shape == shape:
+            return buf
+        buf = self._local.buffers = _Buffers()
+        buf.shape = shape
+        h, w = shape[0], shape[1]
+        buf.scale_factor = min(self.max_width / float(w), 1.0)
+        h_small, w_small = max(int(round(h * buf.scale_factor)), 1), max(int(round(w * buf.scale_factor)), 1)
+        buf.gray = np.empty((h, w))
+        buf.rgb = np.empty((h, w, 3)) if len(shape) == 3 else None
+        if buf.scale_factor < 1:
+            # The resampling matrices are banded, hence much cheaper to apply in the sparse form
+            buf.rows_matrix = sparse.csr_matrix(_area_resampling_matrix(h, h_small))
+            buf.cols_matrix = sparse.csr_matrix(_area_resampling_matrix(w, w_small))
+        buf.tophat, buf.sobel, buf.closed = np.empty((h_small, w_small)), np.empty((h_small, w_small)), np.empty((h_small, w_small))
+        buf.binary = np.empty((h_small, w_small), dtype=bool)
+        return buf
+
+    def _to_gray(self, frame, buf):
+        """Converts the frame to a float grayscale image with values in [0, 1], into buf.gray if a conversion is needed."""
+        scale = 1.0 / np.iinfo(frame.dtype).max if frame.dtype.kind in 'ui' else 1.0
+        if frame.ndim == 3:
+            np.copyto(buf.rgb, frame[..., :3])
+            return np.matmul(buf.rgb, self.RGB_WEIGHTS * scale, out=buf.gray)
+        if frame.dtype == np.float64 and frame.flags.c_contiguous:
+            return frame
+        return np.multiply(frame, scale, out=buf.gray)
+
+    def _boone(self, img_small, buf):
+        """Same as BooneTransform, computed in the preallocated buffers."""
+        morphology.black_tophat(img_small, self.footprint, out=buf.tophat)
+        ndimage.convolve(buf.tophat, self.sobel_kernel, output=buf.sobel, mode='reflect')
+        np.abs(buf.sobel, out=buf.sobel)
+        morphology.closing(buf.sobel, self.footprint, out=buf.closed)
+        threshold = filters.threshold_otsu(buf.closed)
+        return np.greater(buf.closed, threshold, out=buf.binary)
+
+
+class _Buffers(object):
+    """Work buffers of MRZLocator for a given frame shape."""
+    pass
+
+
+def _area_resampling_matrix(n, m):
+    """Returns the m x n matrix which resamples a signal of length n to length m (m <= n) by averaging over the
+    covered part of each input sample (i.e. the "area" interpolation).
+
+    >>> _area_resampling_matrix(4, 2)
+    array([[0.5, 0.5, 0. , 0. ],
+           [0. , 0. , 0.5, 0.5]])
+    """
+    edges = np.arange(m + 1) * (n / float(m))
+    lo, hi = edges[:-1, None], edges[1:, None]
+    i = np.arange(n)[None, :]
+    weights = np.clip(np.minimum(hi, i + 1) - np.maximum(lo, i), 0, None)
+    return weights / weights.sum(axis=1, keepdims=True)
+
+
+_default_locator = None
+
+
+def locate_mrz(frame):
+    """Finds the putative MRZ boxes on an in-memory image (e.g. a camera frame) without doing any OCR.
+    Uses a shared MRZLocator instance, so that its work buffers are reused across calls.
+
+    :param frame: a grayscale or RGB(A) image as a numpy array.
+    :return: a list of RotatedBox instances, in the coordinates of the frame, largest first.
+    """
+    global _default_locator
+    if _default_locator is None:
+        _default_locator = MRZLocator()
+    return _default_locator(frame)
+
+
+class MRZStreamReader(object):
+    """Reads the MRZ from a stream of frames (e.g. from a camera), fusing the OCR results of several frames.
+
+    Usage: pass the successive frames to `feed` until it returns the MRZ (or use `read` with an iterable of frames).
+
+    The MRZ box is detected (see MRZLocator) on the full frame only until an MRZ is read from it. After that, the box
+    is tracked: it is only looked for in a window around its location in the previous frame.
+    Only the frames where the MRZ region is sharp (relative to the sharpest one seen so far) are OCR-ed, and the
+    readings are fused character by character (see MRZVoter). As soon as the fused MRZ is valid, it is returned.
+    """
+
+    def __init__(self, extra_cmdline_params='', min_relative_sharpness=0.7, window_margin=0.25, max_candidates=4,
+                 max_misses=3, locator=None):
+        """
+        :param min_relative_sharpness: frames whose MRZ region is less sharp than this fraction of the sharpest one so far are not OCR-ed.
+        :param window_margin: the size of the tracking window around the previous box, relative to the width of the box, on each side.
+        :param max_candidates: the maximum number of boxes OCR-ed when looking for the MRZ on the full frame.
+        :param max_misses: the number of consecutive frames where the tracked box is not found, after which it is looked for
+                           on the full frame again.
+        :param locator: the MRZLocator instance to use (by default, a new one with default parameters is created).
+        """
+        self.extra_cmdline_params = extra_cmdline_params
+        self.min_relative_sharpness = min_relative_sharpness
+        self.window_margin = window_margin
+        self.max_candidates = max_candidates
+        self.max_misses = max_misses
+        self.locator = locator or MRZLocator()
+        self.reset()
+
+    def reset(self):
+        """Forgets everything about the previous frames."""
+        self.box = None
+        self.misses = 0
+        self.voter = MRZVoter()
+        self.max_sharpness = 0.0
+        self.frames = 0
+        self.ocr_frames = 0
+        self.result = None
+
+    def read(self, frames):
+        """Feeds the frames one by one until a valid MRZ is read, and returns it.
+        If the frames run out before that, returns the fused (invalid) MRZ or None if nothing was read at all."""
+        for frame in frames:
+            mrz = self.feed(frame)
+            if mrz is not None:
+                return mrz
+        return self.voter.result()
+
+    def feed(self, frame):
+        """Processes the next frame. Returns the MRZ as soon as the fused result is valid, otherwise None."""
+        if self.result is not None:
+            return self.result
+        self.frames += 1
+        img = util.img_as_float(np.asarray(frame))
+        if img.ndim == 3:
+            img = color.rgb2gray(img[..., :3])
+        if self.box is None:
+            self._acquire(img)
+        else:
+            self._track(img)
+        mrz = self.voter.result()
+        if mrz is not None and mrz.valid:
+            mrz.aux['method'] = 'vote(%d)' % self.voter.count
+            mrz.aux['box'] = self.box
+            self.result = mrz
+        return self.result
+
+    def _acquire(self, img):
+        """Looks for the MRZ box on the full frame, OCR-ing the candidate boxes until something MRZ-like is read."""
+        for box in self.locator(img)[:self.max_candidates]:
+            roi = box.extract_from_image(img)
+            if self._read(roi, _sharpness(roi)):
+                self.box = box
+                return
+
+    def _track(self, img):
+        """Looks for the MRZ box in the window around its previous location, OCR-ing it if the frame is sharp enough."""
+        margin = self.window_margin * self.box.width
+        (r1, c1), (r2, c2) = np.min(self.box.as_poly(), 0) - margin, np.max(self.box.as_poly(), 0) + margin
+        r1, c1 = max(int(r1), 0), max(int(c1), 0)
+        window = img[r1:max(int(r2), r1 + 1), c1:max(int(c2), c1 + 1)]
+        boxes = [b.translated((r1, c1)) for b in self.locator(window)] if min(window.shape) > 2 else []
+        boxes = [b for b in boxes if 0.5 < b.width / self.box.width < 2 and _is_near_any(b, [self.box])]
+        if not boxes:
+            # Keep the previous box for a few frames (e.g. the detection fails on a blurry frame), then start over
+            self.misses += 1
+            if self.misses >= self.max_misses:
+                self.box = None
+            return
+        self.misses = 0
+        self.box = min(boxes, key=lambda b: np.linalg.norm(b.center - self.box.center))
+        roi = self.box.extract_from_image(img)
+        sharpness = _sharpness(roi)
+        if sharpness >= self.min_relative_sharpness * self.max_sharpness:
+            self._read(roi, sharpness)
+
+    def _read(self, roi, sharpness):
+        """OCRs the region and adds the result to the vote. Returns True if anything MRZ-like was read."""
+        text = traced('ocr', 'ocr', ocr, roi, extra_cmdline_params=self.extra_cmdline_params)
+        if '>>' in text or ('>' in text and '<' not in text):
+            text = traced('ocr', 'ocr', ocr, roi[::-1, ::-1], extra_cmdline_params=self.extra_cmdline_params)
+        if not self.voter.add(MRZOCRCleaner.apply(text)):
+            return False
+        self.ocr_frames += 1
+        self.max_sharpness = max(self.max_sharpness, sharpness)
+        return True
+
+
+class MRZReader(object):
+    """Reads MRZs from many inputs with the same configuration. The pipeline is built once (available as `template`,
+    which may be further customized with replace_component), and each input is processed by a clone of it
+    (see Pipeline.clone), so that a reader may be shared between threads.
+
+    :param extra_cmdline_params: extra parameters to the ocr.py
+    :param prior_region: see MRZPipeline.
+    :param deskew: see MRZPipeline.
+    :param cache: a util.cache.StageCache for the results of the stages before OCR, see MRZPipeline.
+    :param ocr: the OCR backend: a function with the signature of util.ocr.ocr (by default, util.ocr.ocr).
+                It must be safe to call from several threads if the reader is used so.
+    :param max_width: the width the image is scaled down to for detecting the MRZ, see Scaler.
+    :param other_max_width: the width used for a second attempt on mostly white images, see TryOtherMaxWidth.
+    :param min_box_score: candidate boxes with a lower box_score are not OCR-ed, see FindFirstValidMRZ.
+    """
+
+    # The only pipeline values used by read: all the intermediate images are released as soon as they are no longer needed
+    RESULT_KEYS = ['mrz_final', 'quality']
+
+    def __init__(self, extra_cmdline_params='', prior_region=None, deskew=False, cache=None, ocr=None,
+                 max_width=250, other_max_width=1000, min_box_score=0.0):
+        self.template = MRZPipeline(None, extra_cmdline_params, prior_region=prior_region, deskew=deskew, cache=cache, ocr=ocr)
+        self.template.replace_component('scaler', Scaler(max_width))
+        self.template.replace_component('other_max_width', TryOtherMaxWidth(other_max_width))
+        self.template.components['mrz'].min_box_score = min_box_score
+
+    def pipeline(self, file):
+        """Returns a fresh MRZPipeline for the given input (a clone of the template)."""
+        p = self.template.clone()
+        p.file = file
+        p.replace_component('loader', Loader(file))
+        return p
+
+    def read(self, file, save_roi=False, max_workers=None, timings=False, return_reason=False):
+        """Reads the MRZ from the given input, see read_mrz for the meaning of the parameters and the result."""
+        hooks = [Timings()] if timings else []
+        loader = Loader(file)
+        if loader.multi_page:
+            mrz, reason = self._read_pages(loader.iter_images(), save_roi, max_workers, hooks)
+        else:
+            mrz, reason = self._read_image(file, save_roi, hooks)
+        if mrz is not None and timings:
+            mrz.aux['timings'] = hooks[0].summary()
+        return (mrz, reason) if return_reason else mrz
+
+    def _read_image(self, file, save_roi, hooks):
+        """Returns a pair (mrz, rejection_reason), see MRZPipeline.rejection_reason."""
+        p = self.pipeline(file)
+        for hook in hooks:
+            p.add_hook(hook)
+        p.retain(self.RESULT_KEYS + ['roi'] if save_roi else self.RESULT_KEYS)
+        mrz = p.result
+        if mrz is not None and save_roi:
+            mrz.aux['roi'] = p['roi']
+        return mrz, p.rejection_reason
+
+    def _read_pages(self, images, save_roi, max_workers, hooks):
+        """Reads each of the (page, img) pairs until a valid MRZ is found. Returns it, or the best MRZ found,
+        along with the rejection reason: None if any of the pages passed the quality check, otherwise that of the first page.
+        With max_workers, up to that many pages are decoded and processed concurrently, the results are still considered in page order."""
+        def read_page(page, img):
+            mrz, reason = self._read_image(img, save_roi, hooks)
+            if mrz is not None:
+                mrz.aux['page'] = page
+            return mrz, reason
+
+        if max_workers is None or max_workers <= 1:
+            results = (read_page(page, img) for page, img in images)
+            executor = None
+        else:
+            executor = ThreadPoolExecutor(max_workers=max_workers)
+            results = _bounded_map(executor, read_page, images, max_workers)
+        best = None
+        reasons = []
+        try:
+            for mrz, reason in results:
+                reasons.append(reason)
+                if mrz is None:
+                    continue
+                if mrz.valid:
+                    return mrz, None
+                if best is None or mrz.valid_score > best.valid_score:
+                    best = mrz
+            return best, None if not reasons or None in reasons else reasons[0]
+        finally:
+            results.close()
+            if executor is not None:
+                executor.shutdown(wait=True)
+
+    def read_many(self, files, threads=None, ordered=True, save_roi=False, timings=False):
+        """Reads the MRZs of the given inputs in a pool of threads, see read_mrz_many."""
+        read = functools.partial(self._read_one, save_roi=save_roi, timings=timings)
+        threads = threads or min(32, (os.cpu_count() or 1) + 4)  # The default of ThreadPoolExecutor
+        executor = ThreadPoolExecutor(max_workers=threads)
+        try:
+            if ordered:
+                yield from _bounded_map(executor, read, ((f,) for f in files), 2 * threads)
+            else:
+                yield from _bounded_as_completed(executor, read, files, 2 * threads)
+        finally:
+            executor.shutdown(wait=True)
+
+    def _read_one(self, file, save_roi, timings):
+        return file, self.read(file, save_roi=save_roi, timings=timings)
+
+
+def read_mrz(file, save_roi=False, extra_cmdline_params='', prior_region=None, deskew=False, max_workers=None, timings=False,
+             cache=None, return_reason=False, min_box_score=0.0):
     """The main interface function to this module, encapsulating the recognition pipeline.
        Given an image filename, runs MRZPipeline on it, returning the parsed MRZ object.
+       (To read many files with the same parameters, create an MRZReader once and use its read method instead.)
 
-    :param file: A filename or a stream to read the file data from.
+    :param file: A filename or a stream to read the file data from, or an already decoded image (a numpy array or a PIL image).
     :param save_roi: when this is True, the .aux['roi'] field will contain the Region of Interest where the MRZ was parsed from.
     :param extra_cmdline_params:extra parameters to the ocr.py
+    :param prior_region: when given, the MRZ is first looked for in the strips of this relative size along the sides of the image
+                         (e.g. 0.4 for the bottom 40% of the document in each of the four orientations), see MRZPipeline.
+    :param deskew: when True, the angles of the candidate boxes are snapped to the dominant direction of the document, see MRZPipeline.
+    :param max_workers: for files with several images, the number of pages processed concurrently (and kept in memory).
+                        By default the pages are processed one at a time.
+    :param timings: when this is True, the .aux['timings'] field will contain the number of calls and the time spent
+                    in each pipeline component and in OCR (see util.profiling.Timings).
+    :param cache: a util.cache.StageCache for the results of the stages before OCR, see MRZPipeline.
+    :param min_box_score: candidate boxes with a lower MRZ-likeness score (see MRZBoxScorer) are not OCR-ed at all.
+                          By default all of them are tried, see FindFirstValidMRZ.
+    :param return_reason: when this is True, a pair (mrz, rejection_reason) is returned, where rejection_reason is the reason
+                          the image was rejected by the quality check without any OCR (e.g. 'blank' or 'blurry', see QualityAssessor)
+                          or None if it passed the check.
+    :return: the parsed MRZ or None (or a pair, see return_reason).
+             For files with several images (PDFs and multi-page TIFFs), the images are decoded and tried in order until a valid
+             MRZ is found (otherwise the best one is returned), and the index of the page it was found on is stored in .aux['page'].
+    """
+    reader = MRZReader(extra_cmdline_params, prior_region=prior_region, deskew=deskew, cache=cache, min_box_score=min_box_score)
+    return reader.read(file, save_roi=save_roi, max_workers=max_workers, timings=timings, return_reason=return_reason)
+
+
+def read_mrz_many(files, threads=None, ordered=True, save_roi=False, extra_cmdline_params='', prior_region=None, deskew=False,
+                  timings=False, cache=None, min_box_score=0.0):
+    """Reads the MRZs of many inputs in a pool of threads, yielding (file, mrz) pairs, where mrz is the result of read_mrz(file).
+       Most of the time is spent in OCR (an external process) and in numpy/scikit-image routines which release the GIL,
+       so that the threads actually run in parallel.
+
+       The reading path is thread-safe: a single MRZReader is shared by the threads, each input is processed by its own clone
+       of the pipeline (so that the components which modify the pipeline, like TryOtherMaxWidth, only affect that clone),
+       and the shared helpers (MRZOCRCleaner, MRZCheckDigit, the structuring elements) are immutable.
+
+    :param files: an iterable of inputs (anything accepted by read_mrz). It is consumed lazily: at most 2 * threads inputs
+                  are taken ahead of the results.
+    :param threads: the number of threads (by default, as many as ThreadPoolExecutor uses).
+    :param ordered: when True, the pairs are yielded in the order of the inputs, otherwise in the order in which they are done.
+    The other parameters are those of read_mrz. An exception raised when reading an input is raised by the generator.
+
+    >>> list(read_mrz_many([]))
+    []
+    """
+    reader = MRZReader(extra_cmdline_params, prior_region=prior_region, deskew=deskew, cache=cache, min_box_score=min_box_score)
+    return reader.read_many(files, threads=threads, ordered=ordered, save_roi=save_roi, timings=timings)
+
+
+async def read_mrz_async(file, save_roi=False, extra_cmdline_params='', prior_region=None, deskew=False, max_workers=None,
+                         timings=False, cache=None, executor=None, semaphore=None, return_reason=False, min_box_score=0.0):
+    """The asyncio counterpart of read_mrz. The image processing stages run in the given executor (by default,
+    the default executor of the event loop), while Tesseract is run as a subprocess of the event loop (see util.ocr.ocr_async),
+    so that no thread is blocked waiting for it.
+
+    When the task is cancelled, the running Tesseract processes are killed and the pipeline stops at its next OCR call.
+
+    :param executor: a concurrent.futures.ThreadPoolExecutor for the image processing stages.
+    :param semaphore: an asyncio.Semaphore limiting the number of concurrent Tesseract processes. Share it between
+                      the calls to limit the total number of processes.
+    The other parameters and the result are those of read_mrz.
+    """
+    loop = asyncio.get_running_loop()
+    async_ocr = _AsyncOCR(loop, semaphore)
+    reader = MRZReader(extra_cmdline_params, prior_region=prior_region, deskew=deskew, cache=cache, ocr=async_ocr,
+                       min_box_score=min_box_score)
+    read = functools.partial(reader.read, file, save_roi=save_roi, max_workers=max_workers, timings=timings,
+                             return_reason=return_reason)
+    try:
+        return await loop.run_in_executor(executor, read)
+    except asyncio.CancelledError:
+        async_ocr.cancel()
+        raise
+
+
+class _AsyncOCR(object):
+    """An OCR backend (see BoxToMRZ) for the pipelines run by read_mrz_async: called from the executor threads,
+    it runs util.ocr.ocr_async in the event loop and waits for the result."""
+
+    def __init__(self, loop, semaphore=None):
+        self._loop = loop
+        self._semaphore = semaphore
+        self._futures = set()
+        self._cancelled = False
+        self._lock = threading.Lock()
+
+    def __call__(self, img, extra_cmdline_params=''):
+        with self._lock:
+            if self._cancelled:
+                raise CancelledError()
+            future = asyncio.run_coroutine_threadsafe(self._ocr(img, extra_cmdline_params), self._loop)
+            self._futures.add(future)
+        try:
+            return future.result()
+        finally:
+            with self._lock:
+                self._futures.discard(future)
+
+    async def _ocr(self, img, extra_cmdline_params):
+        if self._semaphore is None:
+            return await ocr_async(img, extra_cmdline_params=extra_cmdline_params)
+        async with self._semaphore:
+            return await ocr_async(img, extra_cmdline_params=extra_cmdline_params)
+
+    def cancel(self):
+        """Cancels the running OCR calls (killing their processes) and makes all further calls raise CancelledError."""
+        with self._lock:
+            self._cancelled = True
+            for future in self._futures:
+                future.cancel()
+
+
+def _bounded_as_completed(executor, fn, items, window):
+    """Like _bounded_map(executor, fn, ((item,) for item in items), window), but yields the results in the order of completion."""
+    pending = set()
+    try:
+        for item in items:
+            pending.add(executor.submit(fn, item))
+            if len(pending) >= window:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+        for future in as_completed(pending):
+            pending.discard(future)
+            yield future.result()
+    finally:
+        for future in pending:
+            future.cancel()
+
+
+def _bounded_map(executor, fn, items, window):
+    """Like executor.map(lambda args: fn(*args), items), but only takes the next item from the iterator when fewer than
+    `window` of them are in progress, so that at most `window` items (e.g. decoded pages) are held at a time."""
+    pending = deque()
+    try:
+        for args in items:
+            pending.append(executor.submit(fn, *args))
+            if len(pending) >= window:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        for future in pending:
+            future.cancel()
+
+
+def read_all_mrz(file, save_roi=False, extra_cmdline_params='', max_workers=None):
+    """Given an image of a page with several documents (e.g. a flatbed scan of a few passports),
+       runs MultiMRZPipeline on it, returning the list of all valid MRZs found, in reading order.
+       The box each MRZ was read from is available as its .aux['box'] (a RotatedBox in the coordinates of the image).
+
+    :param file: A filename or a stream to read the file data from, or an already decoded image (a numpy array or a PIL image).
+    :param save_roi: when this is True, the .aux['roi'] field of each MRZ will contain the Region of Interest it was parsed from.
+    :param extra_cmdline_params: extra parameters to the ocr.py
+    :param max_workers: the maximum number of MRZ regions OCR-ed concurrently.
+    :return: a (possibly empty) list of MRZ objects.
     """
-    p = MRZPipeline(file, extra_cmdline_params)
-    mrz = p.result
-    if mrz is not None and save_roi:
-        mrz.aux['roi'] = p['roi']
-    return mrz
+    mrzs = MultiMRZPipeline(file, extra_cmdline_params, max_workers=max_workers).result
+    if not save_roi:
+        for mrz in mrzs:
+            del mrz.aux['roi']
+    return mrzs
@@ -6,7 +6,10 @@ Author: Konstantin Tretyakov
 License: MIT
 '''
 import argparse
+import concurrent.futures
+import csv
 import glob
+import io
 import json
 import logging
 import multiprocessing
@@ -14,27 +17,34 @@ import os
 import shutil
 import sys
 import time
-from collections import Counter
-import pkg_resources
-from skimage import io
-import numpy as np
-from pytesseract.pytesseract import TesseractNotFoundError, TesseractError
+from collections import Counter, deque
 import passporteye
-from .image import read_mrz, MRZPipeline
+from .sinks import open_sink
+from .text import MRZ_FIELDS, MRZOCRCleaner, parse_batch
+
+# NB: The image processing stack (passporteye.mrz.image, skimage, pytesseract) is imported by the scripts which need it,
+# so that starting a script (or just asking for its --version) does not take seconds.
 
 
 def process_file(params):
     """
     Processes a file and returns the parsed MRZ (or None if no candidate regions were even found).
 
-    The input argument is a list (filename, save_roi, extra_params).
+    The input argument is a list (filename, save_roi, extra_params, min_box_score).
     (Because we need to use this function within imap_unordered)
+
+    Returns a tuple (filename, mrz, walltime, rejection_reason), where rejection_reason is
+    the reason code reported by the image quality check (or None if the image passed it).
+    The file is read by read_mrz, so that all the pages of PDFs and multi-page TIFFs are tried.
+    The time spent in each pipeline stage is reported in the .aux['timings'] field of the MRZ (see util.profiling.Timings).
     """
+    from .image import read_mrz
     tic = time.time()
-    filename, save_roi, extra_params = params
-    result = read_mrz(filename, save_roi=save_roi, extra_cmdline_params=extra_params)
+    filename, save_roi, extra_params, min_box_score = params
+    result, rejection_reason = read_mrz(filename, save_roi=save_roi, extra_cmdline_params=extra_params, timings=True,
+                                        return_reason=True, min_box_score=min_box_score)
     walltime = time.time() - tic
-    return (filename, result, walltime)
+    return (filename, result, walltime, rejection_reason)
 
 
 def evaluate_mrz():
@@ -43,7 +53,7 @@ def evaluate_mrz():
     """
     parser = argparse.ArgumentParser(description='Run the MRZ OCR recognition algorithm on the sample test data, reporting the quality summary.')
     parser.add_argument('-j', '--jobs', default=1, type=int, help='Number of parallel jobs to run')
-    parser.add_argument('-dd', '--data-dir', default=pkg_resources.resource_filename('passporteye.mrz', 'testdata'),
+    parser.add_argument('-dd', '--data-dir', default=os.path.join(os.path.dirname(__file__), 'testdata'),
                         help='Read files from this directory instead of the package test files')
     parser.add_argument('-sd', '--success-dir', default=None,
                         help='Copy files with successful (nonzero score) extraction results to this directory')
@@ -52,12 +62,21 @@ def evaluate_mrz():
     parser.add_argument('-rd', '--roi-dir', default=None,
                         help='Extract ROIs to this directory')
     parser.add_argument('-l', '--limit', default=-1, type=int, help='Only process the first <limit> files in the directory.')
+    parser.add_argument('-o', '--output', default=None,
+                        help='Store the results (fields, timings) to this file: .jsonl, .csv, .sqlite, or a .parquet or .arrow '
+                        'directory (these need pyarrow), see passporteye.mrz.sinks')
+    parser.add_argument('--resume', action='store_true', help='Skip the files whose results are already in the --output')
+    parser.add_argument('--min-box-score', default=0.0, type=float,
+                        help='Do not OCR the candidate regions with a lower MRZ-likeness score (between 0 and 1, see MRZBoxScorer). '
+                        'By default all of them are tried. Compare the scores and times with a few values to choose one for your data.')
     parser.add_argument('--legacy', action='store_true',
                         help='Use the "legacy" Tesseract OCR engine (--oem 0). Despite the name, it most often results in better '
                         'results. It is not the default option, because it will only work if '
                         'your Tesseract installation includes the legacy *.traineddata files. You can download them at '
                         'https://github.com/tesseract-ocr/tesseract/wiki/Data-Files#data-files-for-version-400-november-29-2016')
     args = parser.parse_args()
+    if args.resume and args.output is None:
+        parser.error('--resume requires --output')
     files = sorted(glob.glob(os.path.join(args.data_dir, '*.*')))
     if args.limit >= 0:
         files = files[0:args.limit]
@@ -65,6 +84,17 @@ def evaluate_mrz():
     logging.basicConfig(level=logging.INFO)
     log = logging.getLogger("evaluate_mrz")
 
+    sink = open_sink(args.output) if args.output is not None else None
+    if sink is not None and args.resume:
+        done = sink.done()
+        log.info("Skipping %d files already processed", len([f for f in files if f in done]))
+        files = [f for f in files if f not in done]
+    if not files:
+        log.info("Nothing to do")
+        if sink is not None:
+            sink.close()
+        return
+
     tic = time.time()
     pool = multiprocessing.Pool(args.jobs)
     log.info("Preparing computation for %d files from %s", len(files), args.data_dir)
@@ -88,25 +118,39 @@ def evaluate_mrz():
             return '?'
 
     method_stats = Counter()
+    rejection_stats = Counter()
+    stage_times = Counter()
 
     extra_params = '--oem 0' if args.legacy else ''
-    for result in pool.imap_unordered(process_file, [(f, save_roi, extra_params) for f in files]):
-        filename, mrz_, walltime = result
-        results.append(result)
-        log.info("Processed %s in %0.2fs (score %d) [%s]", os.path.basename(filename), walltime, valid_score(mrz_), score_change_type(filename, mrz_))
-        log.debug("\t%s", mrz_)
-
-        vs = valid_score(mrz_)
-        if args.success_dir is not None and vs > 0:
-            shutil.copyfile(filename, os.path.join(args.success_dir, '%d_%s' % (vs, os.path.basename(filename))))
-        if args.fail_dir is not None and vs == 0:
-            shutil.copyfile(filename, os.path.join(args.fail_dir, '%d_%s' % (vs, os.path.basename(filename))))
-        if args.roi_dir is not None and mrz_ is not None and 'roi' in mrz_.aux:
-            roi_fn = '%d_roi_%s.png' % (vs, os.path.basename(filename))
-            io.imsave(os.path.join(args.roi_dir, roi_fn), mrz_.aux['roi'])
-
-        if vs > 0 and 'method' in mrz_.aux:
-            method_stats[mrz_.aux['method']] += 1
+    try:
+        for result in pool.imap_unordered(process_file, [(f, save_roi, extra_params, args.min_box_score) for f in files]):
+            filename, mrz_, walltime, rejection_reason = result
+            results.append(result[:3])
+            if sink is not None:
+                sink.write_mrz(filename, mrz_, walltime, rejection_reason)
+            log.info("Processed %s in %0.2fs (score %d) [%s]", os.path.basename(filename), walltime, valid_score(mrz_), score_change_type(filename, mrz_))
+            log.debug("\t%s", mrz_)
+
+            vs = valid_score(mrz_)
+            if args.success_dir is not None and vs > 0:
+                shutil.copyfile(filename, os.path.join(args.success_dir, '%d_%s' % (vs, os.path.basename(filename))))
+            if args.fail_dir is not None and vs == 0:
+                shutil.copyfile(filename, os.path.join(args.fail_dir, '%d_%s' % (vs, os.path.basename(filename))))
+            if args.roi_dir is not None and mrz_ is not None and 'roi' in mrz_.aux:
+                from skimage import io
+                roi_fn = '%d_roi_%s.png' % (vs, os.path.basename(filename))
+                io.imsave(os.path.join(args.roi_dir, roi_fn), mrz_.aux['roi'])
+
+            if vs > 0 and 'method' in mrz_.aux:
+                method_stats[mrz_.aux['method']] += 1
+            if rejection_reason is not None:
+                rejection_stats[rejection_reason] += 1
+            if mrz_ is not None:
+                for stage, total in mrz_.aux['timings'].items():
+                    stage_times[stage] += total['seconds']
+    finally:
+        if sink is not None:
+            sink.close()
 
     num_files = len(results)
     score_changes = [score_change_type(fn, mrz_) for fn, mrz_, wt in results]
@@ -130,6 +174,12 @@ def evaluate_mrz():
     print("Methods used:")
     for stat in method_stats.most_common():
         print("  %s: %d" % stat)
+    print("Rejected inputs:   %d" % sum(rejection_stats.values()))
+    for stat in rejection_stats.most_common():
+        print("  %s: %d" % stat)
+    print("Time by stage:")
+    for stat in stage_times.most_common():
+        print("  %s: %0.2fs" % stat)
 
 
 def mrz():
@@ -149,9 +199,10 @@ def mrz():
     parser.add_argument('--version', action='version', version='PassportEye MRZ v%s' % passporteye.__version__)
     args = parser.parse_args()
 
+    from pytesseract.pytesseract import TesseractNotFoundError, TesseractError
     try:
         extra_params = '--oem 0' if args.legacy else ''
-        filename, mrz_, walltime = process_file((args.filename, args.save_roi is not None, extra_params))
+        filename, mrz_, walltime, rejection_reason = process_file((args.filename, args.save_roi is not None, extra_params, 0.0))
     except TesseractNotFoundError:
         sys.stderr.write("ERROR: The tesseract executable was not found.\n"
                          "Please, make sure Tesseract is installed and the appropriate directory is included "
@@ -162,10 +213,14 @@ def mrz():
         sys.exit(ex.status)
     
     d = mrz_.to_dict() if mrz_ is not None else {'mrz_type': None, 'valid': False, 'valid_score': 0}
+    if rejection_reason is not None:
+        d['rejection_reason'] = rejection_reason
     d['walltime'] = walltime
     d['filename'] = filename
 
     if args.save_roi is not None and mrz_ is not None and 'roi' in mrz_.aux:
+        import numpy as np
+        from skimage import io
         io.imsave(args.save_roi, (mrz_.aux['roi'] * 255).astype(np.uint8))
 
     if not args.json:
@@ -188,9 +243,180 @@ def extract_mrz_rois():
     parser.add_argument('--version', action='version', version='PassprtEye extract_mrz_rois v%s' % passporteye.__version__)
     args = parser.parse_args()
 
+    import numpy as np
+    from skimage import io
+    from .image import MRZPipeline
     rois = MRZPipeline(args.filename)['rois']
     if args.create_dir:
         os.makedirs(args.output_dir, exist_ok=True)
 
     for n, img in enumerate(rois, 1):
         io.imsave(os.path.join(args.output_dir, '%d.png' % n), (img * 255).astype(np.uint8))
+
+
+# The columns of the mrz-parse output: the fields of MRZ.to_dict() along with the parsed text (and the error for malformed records)
+PARSE_FIELDS = ['record', 'mrz_type', 'valid_score', 'raw_text'] + MRZ_FIELDS[2:] + ['error']
+
+
+def read_records(stream, input_format='text', field='mrz'):
+    """
+    Lazily reads the MRZ texts from a text stream, yielding them as lists of lines.
+    Malformed records (invalid JSON, a missing field, a value which is not a text) are yielded as ValueError instances
+    describing the problem rather than raised, so that a bad record does not stop a bulk run.
+
+    :param input_format: 'text' (the lines of each MRZ are consecutive, MRZs are separated by empty lines),
+                         'jsonl' (one JSON object per line, its `field` holds the MRZ as a newline-separated string or a list of lines)
+                         or 'csv' (with a header row, the column `field` holds the MRZ as a newline-separated string).
+
+    >>> list(read_records(io.StringIO('AAA\\nBBB\\n\\n\\nCCC\\nDDD\\nEEE\\n')))
+    [['AAA', 'BBB'], ['CCC', 'DDD', 'EEE']]
+    >>> list(read_records(io.StringIO('{"mrz": "AAA\\\\nBBB"}\\n{"mrz": ["CCC", "DDD"]}\\n'), 'jsonl'))
+    [['AAA', 'BBB'], ['CCC', 'DDD']]
+    >>> [str(e).split(':')[0] for e in read_records(io.StringIO('{"mrz": 5}\\n{"id": 1}\\n{"mrz"\\n'), 'jsonl')]
+    ['not an MRZ text', "missing field 'mrz'", 'invalid JSON']
+    """
+    if input_format == 'text':
+        lines = []
+        for line in stream:
+            line = line.strip()
+            if line:
+                lines.append(line)
+            elif lines:
+                yield lines
+                lines = []
+        if lines:
+            yield lines
+    elif input_format == 'jsonl':
+        for line in stream:
+            if line.strip():
+                try:
+                    value = json.loads(line)
+                except ValueError as e:
+                    yield ValueError('invalid JSON: %s' % e)
+                    continue
+                yield _record_lines(value.get(field) if isinstance(value, dict) else None, field)
+    elif input_format == 'csv':
+        for row in csv.DictReader(stream):
+            yield _record_lines(row.get(field), field)
+    else:
+        raise ValueError("Unknown input format: %s" % input_format)
+
+
+def _record_lines(value, field):
+    """The MRZ lines of the value of a JSON field or CSV column (a newline-separated string or a list of lines), or a ValueError."""
+    if value is None:
+        return ValueError('missing field %r' % field)
+    if isinstance(value, str):
+        return value.strip().split('\n')
+    if isinstance(value, list) and all(isinstance(line, str) for line in value):
+        return value
+    return ValueError('not an MRZ text: %r' % (value,))
+
+
+def parse_chunk(params):
+    """
+    Parses a chunk of MRZ texts (see parse_batch), returning a list of records (dictionaries with the PARSE_FIELDS,
+    without the fields absent from the MRZ.to_dict() of the respective MRZ). Malformed records (see read_records) get
+    valid_score 0 and the description of the problem in the `error` field.
+
+    The input argument is a tuple (first record index, list of MRZs as lists of lines, cleanup), where cleanup requests
+    the OCR cleanup of the lines (see MRZOCRCleaner).
+    (Because we need to use this function in a process pool)
+    """
+    start, chunk, cleanup = params
+    good = [i for i, lines in enumerate(chunk) if not isinstance(lines, ValueError)]
+    texts = ['\n'.join(chunk[i]) for i in good]
+    mrzs = [MRZOCRCleaner.apply(text) for text in texts] if cleanup else [chunk[i] for i in good]
+    columns = {k: v.tolist() for k, v in parse_batch(mrzs).items()}
+    records = [{'record': start + i, 'mrz_type': None, 'valid_score': 0, 'raw_text': None, 'error': str(lines)}
+               for i, lines in enumerate(chunk)]
+    for j, (i, text) in enumerate(zip(good, texts)):
+        record = {'record': start + i, 'mrz_type': columns['mrz_type'][j], 'valid_score': columns['valid_score'][j], 'raw_text': text}
+        for k in MRZ_FIELDS[2:]:
+            if columns[k][j] is not None:
+                record[k] = columns[k][j]
+        records[i] = record
+    return records
+
+
+def mrz_parse(argv=None):
+    """
+    Command-line script for validating MRZ texts (e.g. exported from a database) and extracting their fields, without any OCR.
+    The input is read and parsed in chunks, so the memory use does not depend on its size.
+    """
+    parser = argparse.ArgumentParser(description='Parse and validate MRZ texts, writing the extracted fields as JSON lines or CSV.')
+    parser.add_argument('files', nargs='*', help='Input files (by default, or for "-", the standard input)')
+    parser.add_argument('-i', '--input-format', choices=['text', 'jsonl', 'csv'], default='text',
+                        help='text: the lines of each MRZ on consecutive lines, MRZs separated by empty lines (default); '
+                        'jsonl, csv: the MRZ text is in the given field of each record, see --field')
+    parser.add_argument('--field', default='mrz', help='The JSON field or CSV column holding the MRZ text (default: mrz)')
+    parser.add_argument('-f', '--format', choices=['jsonl', 'csv'], default='jsonl', help='Output format (default: jsonl)')
+    parser.add_argument('-o', '--output', default=None, help='Output file (by default, the standard output)')
+    parser.add_argument('--cleanup', action='store_true', help='Clean up OCR errors in the texts first (as MRZ.from_ocr does)')
+    parser.add_argument('-j', '--jobs', default=1, type=int, help='Number of parallel processes to run')
+    parser.add_argument('-c', '--chunk-size', default=10000, type=int, help='Number of MRZs parsed at once by a process')
+    parser.add_argument('--version', action='version', version='PassportEye mrz-parse v%s' % passporteye.__version__)
+    args = parser.parse_args(argv)
+
+    out = open(args.output, 'w', newline='', encoding='utf-8') if args.output else sys.stdout
+    if args.format == 'csv':
+        writer = csv.DictWriter(out, PARSE_FIELDS, lineterminator='\n')
+        writer.writeheader()
+        write = writer.writerow
+    else:
+        write = lambda record: out.write(json.dumps(record) + '\n')
+
+    tic = time.time()
+    num_records = num_valid = num_malformed = 0
+    chunks = ((start, chunk, args.cleanup) for start, chunk in _chunked(_read_all_records(args), args.chunk_size))
+    try:
+        for records in _map_chunks(chunks, args.jobs):
+            for record in records:
+                write(record)
+            num_records += len(records)
+            num_valid += sum(record['valid_score'] == 100 for record in records)
+            num_malformed += sum('error' in record for record in records)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    walltime = time.time() - tic
+    sys.stderr.write("Parsed %d MRZs (%d valid, %d malformed) in %0.2fs: %0.0f records/s\n"
+                     % (num_records, num_valid, num_malformed, walltime, num_records / walltime if walltime > 0 else 0))
+
+
+def _read_all_records(args):
+    for filename in args.files or ['-']:
+        if filename == '-':
+            yield from read_records(sys.stdin, args.input_format, args.field)
+        else:
+            with open(filename, newline='', encoding='utf-8') as f:
+                yield from read_records(f, args.input_format, args.field)
+
+
+def _chunked(items, size):
+    """Yields (index of the first item, list of items) pairs for consecutive chunks of the given size."""
+    chunk, start = [], 0
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield start, chunk
+            chunk, start = [], start + size
+    if chunk:
+        yield start, chunk
+
+
+def _map_chunks(chunks, jobs):
+    """Yields the results of parse_chunk for the chunks, in order. With several jobs, the chunks are parsed in a process pool,
+    with at most 2 chunks per process read ahead (unlike Pool.imap, which would read all the input at once)."""
+    if jobs <= 1:
+        for chunk in chunks:
+            yield parse_chunk(chunk)
+        return
+    with concurrent.futures.ProcessPoolExecutor(jobs) as executor:
+        pending = deque()
+        for chunk in chunks:
+            pending.append(executor.submit(parse_chunk, chunk))
+            if len(pending) >= 2 * jobs:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
@@ -0,0 +1,269 @@
+'''
+PassportEye::MRZ: Machine-readable zone extraction and parsing.
+Output sinks for the results of batch runs.
+
+A sink stores one record per input: the filename, the fields of MRZ.to_dict(), the validity, the wall time,
+the rejection reason and the timings (see util.profiling.Timings). Every record has all the SINK_FIELDS
+(the ones which do not apply to an MRZ type, or to an input without an MRZ, are None), so the schema is the same
+for all the document types.
+
+Records are buffered and written in batches. Each batch is committed atomically: after a crash, a sink opened on the same
+path sees exactly the batches committed before it, and `done()` tells which inputs may be skipped when resuming the run.
+
+Author: Konstantin Tretyakov
+License: MIT
+'''
+import csv
+import io
+import json
+import os
+import sqlite3
+from .text import MRZ_FIELDS
+
+SINK_FIELDS = (['filename', 'mrz_type', 'valid_score', 'valid', 'raw_text'] + MRZ_FIELDS[2:]
+               + ['method', 'walltime', 'rejection_reason', 'timings'])
+_INT_FIELDS = ['valid_score']
+_BOOL_FIELDS = ['valid'] + [k for k in MRZ_FIELDS if k.startswith('valid_')]
+_FLOAT_FIELDS = ['walltime']
+
+
+def mrz_record(filename, mrz, walltime=None, rejection_reason=None):
+    """Converts the result of reading a file (an MRZ or None) into a record with all the SINK_FIELDS.
+    The timings (if any) are stored as a JSON string.
+
+    >>> from .text import MRZ
+    >>> r = mrz_record('a.png', MRZ(['IDAUT10000999<6<<<<<<<<<<<<<<<', '7109094F1112315AUT<<<<<<<<<<<4', 'MUSTERFRAU<<ISOLDE<<<<<<<<<<<<']))
+    >>> r['mrz_type'], r['valid'], r['optional2'], r['personal_number'], list(r) == SINK_FIELDS
+    ('TD1', True, '<<<<<<<<<<<', None, True)
+    >>> r = mrz_record('b.png', None, 0.5, 'blank')
+    >>> r['mrz_type'], r['valid_score'], r['valid'], r['rejection_reason']
+    (None, 0, False, 'blank')
+    """
+    record = dict.fromkeys(SINK_FIELDS)
+    record.update(filename=filename, valid_score=0, valid=False, walltime=walltime, rejection_reason=rejection_reason)
+    if mrz is not None:
+        record.update((k, v) for k, v in mrz.to_dict().items() if k in record)
+        record['valid'] = mrz.valid
+        if 'timings' in mrz.aux:
+            record['timings'] = json.dumps(mrz.aux['timings'])
+    return record
+
+
+class Sink(object):
+    """
+    Base class for the sinks: buffers the records and commits them in batches of buffer_size (and on close).
+    Subclasses implement _commit(records) and done(). Sinks are context managers, and are meant to be used from one thread.
+    """
+
+    def __init__(self, buffer_size=1000):
+        self.buffer_size = buffer_size
+        self.buffer = []
+
+    def write(self, record):
+        """Adds a record (a dictionary with the SINK_FIELDS, see mrz_record)."""
+        self.buffer.append(record)
+        if len(self.buffer) >= self.buffer_size:
+            self.flush()
+
+    def write_mrz(self, filename, mrz, walltime=None, rejection_reason=None):
+        """Adds the result of reading a file, see mrz_record."""
+        self.write(mrz_record(filename, mrz, walltime, rejection_reason))
+
+    def flush(self):
+        """Commits the buffered records."""
+        if self.buffer:
+            self._commit(self.buffer)
+            self.buffer = []
+
+    def close(self):
+        self.flush()
+
+    def done(self):
+        """Returns the set of filenames of the committed records (e.g. to skip them when resuming a run)."""
+        raise NotImplementedError()
+
+    def _commit(self, records):
+        raise NotImplementedError()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class _FileSink(Sink):
+    """A sink appending to a single text file. The length of the committed part of the file is kept in the file
+    <path>.committed (replaced atomically after the data is synced), and whatever follows it (i.e. a batch which was
+    being written during a crash) is truncated when the sink is opened again."""
+
+    def __init__(self, path, buffer_size=1000):
+        super(_FileSink, self).__init__(buffer_size)
+        self.path = path
+        self.file = os.fdopen(os.open(path, os.O_RDWR | os.O_CREAT), 'r+b')
+        self.committed = self._read_committed()
+        self.file.truncate(self.committed)
+
+    def _read_committed(self):
+        size = os.path.getsize(self.path)
+        try:
+            with open(self.path + '.committed') as f:
+                return min(int(f.read()), size)
+        except (OSError, ValueError):
+            return size  # Not written by a sink: all of it is taken as committed
+
+    def _commit(self, records):
+        data = self._encode(records).encode('utf-8')
+        self.file.seek(self.committed)
+        self.file.write(data)
+        self.file.truncate()  # In case a failed commit left more data after this point
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.committed += len(data)
+        with open(self.path + '.committed.tmp', 'w') as f:
+            f.write(str(self.committed))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(self.path + '.committed.tmp', self.path + '.committed')
+
+    def _read(self):
+        """Returns the committed contents of the file as text."""
+        self.file.seek(0)
+        return self.file.read(self.committed).decode('utf-8')
+
+    def close(self):
+        try:
+            super(_FileSink, self).close()
+        finally:
+            self.file.close()
+
+
+class JSONLSink(_FileSink):
+    """Writes the records as JSON lines."""
+
+    def _encode(self, records):
+        return ''.join(json.dumps(record) + '\n' for record in records)
+
+    def done(self):
+        return {json.loads(line)['filename'] for line in self._read().splitlines() if line}
+
+
+class CSVSink(_FileSink):
+    """Writes the records as CSV with a header row (None is written as an empty value)."""
+
+    def _encode(self, records):
+        out = io.StringIO()
+        writer = csv.DictWriter(out, SINK_FIELDS, lineterminator='\n')
+        if self.committed == 0:
+            writer.writeheader()
+        writer.writerows(records)
+        return out.getvalue()
+
+    def done(self):
+        return {row['filename'] for row in csv.DictReader(io.StringIO(self._read()))}
+
+
+class SQLiteSink(Sink):
+    """Writes the records to the `results` table of an SQLite database, committing a transaction per batch."""
+
+    def __init__(self, path, buffer_size=1000):
+        super(SQLiteSink, self).__init__(buffer_size)
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        types = ['INTEGER' if k in _INT_FIELDS or k in _BOOL_FIELDS else 'REAL' if k in _FLOAT_FIELDS else 'TEXT' for k in SINK_FIELDS]
+        with self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS results (%s)' % ', '.join('%s %s' % ft for ft in zip(SINK_FIELDS, types)))
+
+    def _commit(self, records):
+        with self.connection:
+            self.connection.executemany('INSERT INTO results VALUES (%s)' % ', '.join(['?'] * len(SINK_FIELDS)),
+                                        [[record[k] for k in SINK_FIELDS] for record in records])
+
+    def done(self):
+        return {row[0] for row in self.connection.execute('SELECT filename FROM results')}
+
+    def close(self):
+        try:
+            super(SQLiteSink, self).close()
+        finally:
+            self.connection.close()
+
+
+class ParquetSink(Sink):
+    """
+    Writes the records to a directory of Parquet files (a dataset readable with e.g. pyarrow.dataset or pandas.read_parquet),
+    one file per batch. Each file is written under a temporary name and then renamed, so a file is either complete or absent.
+    Requires pyarrow.
+    """
+
+    EXTENSION = '.parquet'
+
+    def __init__(self, path, buffer_size=10000):
+        super(ParquetSink, self).__init__(buffer_size)
+        try:
+            import pyarrow
+        except ImportError:
+            raise ImportError("The %s requires pyarrow (pip install pyarrow)" % type(self).__name__)
+        self.pa = pyarrow
+        self.schema = pyarrow.schema([(k, pyarrow.int64() if k in _INT_FIELDS else pyarrow.bool_() if k in _BOOL_FIELDS
+                                       else pyarrow.float64() if k in _FLOAT_FIELDS else pyarrow.string()) for k in SINK_FIELDS])
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self.num_parts = len(self._parts())
+
+    def _parts(self):
+        return sorted(os.path.join(self.path, fn) for fn in os.listdir(self.path)
+                      if fn.startswith('part-') and fn.endswith(self.EXTENSION))
+
+    def _commit(self, records):
+        table = self.pa.Table.from_pylist(records, schema=self.schema)
+        part = os.path.join(self.path, 'part-%05d%s' % (self.num_parts, self.EXTENSION))
+        self._write_table(table, part + '.tmp')
+        os.replace(part + '.tmp', part)
+        self.num_parts += 1
+
+    def _write_table(self, table, filename):
+        import pyarrow.parquet
+        pyarrow.parquet.write_table(table, filename)
+
+    def _read_filenames(self, part):
+        import pyarrow.parquet
+        return pyarrow.parquet.read_table(part, columns=['filename'])['filename'].to_pylist()
+
+    def done(self):
+        return {fn for part in self._parts() for fn in self._read_filenames(part)}
+
+
+class ArrowSink(ParquetSink):
+    """The same as ParquetSink, but writes Arrow IPC files (faster to write and to memory-map, larger). Requires pyarrow."""
+
+    EXTENSION = '.arrow'
+
+    def _write_table(self, table, filename):
+        with self.pa.OSFile(filename, 'wb') as f, self.pa.ipc.new_file(f, table.schema) as writer:
+            writer.write_table(table)
+
+    def _read_filenames(self, part):
+        with self.pa.memory_map(part) as source:
+            return self.pa.ipc.open_file(source).read_all()['filename'].to_pylist()
+
+
+SINKS = {'jsonl': JSONLSink, 'csv': CSVSink, 'sqlite': SQLiteSink, 'parquet': ParquetSink, 'arrow': ArrowSink}
+
+
+def open_sink(path, format=None, **kwargs):
+    """Opens a sink of the given format (one of SINKS), or the one given by the extension of the path
+    (.jsonl, .csv, .sqlite or .db, .parquet, .arrow). Existing results are kept, new ones are appended.
+
+    >>> import tempfile
+    >>> with open_sink(os.path.join(tempfile.mkdtemp(), 'results.jsonl')) as sink:
+    ...     sink.write_mrz('a.png', None)
+    ...     sink.done()  # Not committed yet
+    set()
+    """
+    if format is None:
+        ext = os.path.splitext(path)[1].lower().lstrip('.')
+        format = 'sqlite' if ext == 'db' else ext
+    if format not in SINKS:
+        raise ValueError("Unknown sink format: %s (use one of %s)" % (format, ', '.join(SINKS)))
+    return SINKS[format](path, **kwargs)
@@ -6,9 +6,13 @@ Author: Konstantin Tretyakov
 License: MIT
 '''
 #pylint: disable=attribute-defined-outside-init,line-too-long
+import itertools
 from collections import OrderedDict
 from datetime import datetime
 
+_DAYS_IN_MONTH = [0, 31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31]
+_MONTH_DAYS = frozenset('%02d%02d' % (m, d) for m in range(1, 13) for d in range(1, _DAYS_IN_MONTH[m] + 1))  # Except '0229'
+
 
 class MRZ(object):
     """
@@ -103,6 +107,12 @@ class MRZ(object):
 
     """
 
+    __slots__ = ['mrz_type', 'valid', 'valid_score', 'aux', 'type', 'country', 'number', 'date_of_birth', 'expiration_date',
+                 'nationality', 'sex', 'names', 'surname', 'optional1', 'optional2', 'personal_number', 'check_number',
+                 'check_date_of_birth', 'check_expiration_date', 'check_composite', 'check_personal_number', 'valid_number',
+                 'valid_date_of_birth', 'valid_expiration_date', 'valid_composite', 'valid_personal_number',
+                 'valid_check_digits', 'valid_line_lengths', 'valid_misc']
+
     def __init__(self, mrz_lines):
         """
         Parse a TD1/TD2/TD3/MRVA/MRVB MRZ from a single newline-separated string or a list of strings.
@@ -356,6 +366,16 @@ class MRZ(object):
 
     @staticmethod
     def _check_date(ymd):
+        """Is ymd a valid date in the YYMMDD format (as parsed by datetime.strptime(ymd, '%y%m%d'))?
+
+        >>> MRZ._check_date('000229'), MRZ._check_date('010229'), MRZ._check_date('741231'), MRZ._check_date('741301')
+        (True, False, True, False)
+        >>> MRZ._check_date('7412 1'), MRZ._check_date('74123')  # strptime also allows single-digit days and months
+        (True, True)
+        """
+        if len(ymd) == 6 and ymd.isascii() and ymd.isdigit():
+            # The same as strptime, without its overhead. The years are 1969-2068, so those divisible by 4 are leap years.
+            return ymd[2:] in _MONTH_DAYS or (ymd[2:] == '0229' and int(ymd[0:2]) % 4 == 0)
         try:
             datetime.strptime(ymd, '%y%m%d')
             return True
@@ -396,6 +416,97 @@ class MRZ(object):
         return self.valid_score == 100
 
 
+class MRZVoter(object):
+    """
+    Fuses several OCR readings of the same MRZ (e.g. from successive video frames or from differently preprocessed images)
+    into one, by voting on each character position separately. Positions where the readings disagree are then used
+    to repair the fused result: if it is not valid, the contested characters are greedily replaced by their runner-ups
+    as long as this improves the valid_score (i.e. fixes the check digits).
+
+    Readings are given as lists of cleaned MRZ lines (see MRZOCRCleaner). A line is only counted if it has the
+    expected length for the MRZ type, as otherwise its characters can not be aligned with the positions.
+
+    >>> v = MRZVoter()
+    >>> v.add(['P<POLKOWALSKA<KWIATKOWSKA<<JOANNA<<<<<<<<<<<', 'AA00000000POL6002084F1412314<<<<<<<<<<<<<<<4'])
+    True
+    >>> v.add(['P<POLKOWALSKA<KWIATKOWSKA<<JOANNA<<<<<<<<<<<', 'AA00000000POL6002064F1412314<<<<<<<<<<<<<<<4'])
+    True
+    >>> v.add(['P<POLKOWALSKA<KWIATKOWSKA<<JOANNA<<<<<<<<<<<', 'AA00008000POL6002084F1412314<<<<<<<<<<<<<<<4'])
+    True
+    >>> m = v.result()
+    >>> assert m.valid and m.number == 'AA0000000' and m.date_of_birth == '600208'
+
+    # With two readings only, the check digits decide
+    >>> v = MRZVoter()
+    >>> v.add(['P<POLKOWALSKA<KWIATKOWSKA<<JOANNA<<<<<<<<<<<', 'AA00000000POL6002064F1412314<<<<<<<<<<<<<<<4'])
+    True
+    >>> v.add(['P<POLKOWALSKA<KWIATKOWSKA<<JOANNA<<<<<<<<<<<', 'AA00000000POL6002084F1412314<<<<<<<<<<<<<<<4'])
+    True
+    >>> assert v.result().valid
+
+    >>> MRZVoter().add(['short', 'lines']), MRZVoter().result()
+    (False, None)
+    """
+
+    LINE_LENGTHS = {'TD1': 30, 'TD2': 36, 'TD3': 44, 'MRVA': 44, 'MRVB': 36}
+
+    def __init__(self, max_flips=3):
+        """
+        :param max_flips: the maximum number of contested characters replaced when repairing the fused MRZ.
+        """
+        self.max_flips = max_flips
+        self.votes = {}     # MRZ type -> list of lines, each a list of {char: total weight} dicts (one per position)
+        self.weights = {}   # MRZ type -> total weight of the readings of this type
+        self.count = 0      # Number of readings counted
+
+    def add(self, mrz_lines, weight=1.0):
+        """Adds a reading (a list of cleaned MRZ lines) with the given weight. Returns True if (any part of) the reading was counted."""
+        tp = MRZ._guess_type(mrz_lines)  #pylint: disable=protected-access
+        if tp is None:
+            return False
+        length = self.LINE_LENGTHS[tp]
+        votes = self.votes.setdefault(tp, [[{} for _ in range(length)] for _ in mrz_lines])
+        counted = False
+        for line, line_votes in zip(mrz_lines, votes):
+            if len(line) != length:
+                continue
+            for c, v in zip(line, line_votes):
+                v[c] = v.get(c, 0) + weight
+            counted = True
+        if counted:
+            self.weights[tp] = self.weights.get(tp, 0) + weight
+            self.count += 1
+        return counted
+
+    def result(self):
+        """Returns the fused MRZ (of the type with most votes), or None if no reading was counted so far.
+        The fused lines are available as its aux['raw_text']."""
+        if not self.weights:
+            return None
+        votes = self.votes[max(self.weights, key=self.weights.get)]
+        lines = [[max(v, key=v.get) if v else '<' for v in line_votes] for line_votes in votes]
+        mrz = MRZ([''.join(ln) for ln in lines])
+
+        # The alternatives for the contested positions, the closest votes first
+        alternatives = sorted((v[lines[i][j]] - w, i, j, c) for i, line_votes in enumerate(votes)
+                              for j, v in enumerate(line_votes) for c, w in v.items() if c != lines[i][j])
+        for _ in range(self.max_flips):
+            if mrz.valid:
+                break
+            best = None
+            for _, i, j, c in alternatives:
+                old, lines[i][j] = lines[i][j], c
+                candidate = MRZ([''.join(ln) for ln in lines])
+                lines[i][j] = old
+                if candidate.valid_score > (best[0] if best else mrz).valid_score:
+                    best = (candidate, i, j, c)
+            if best is None:
+                break
+            mrz, i, j, lines[i][j] = best
+        mrz.aux['raw_text'] = '\n'.join(''.join(ln) for ln in lines)
+        return mrz
+
+
 class MRZOCRCleaner(object):
     """
     The __call__ method of this class implements the "cleaning" of an OCR-obtained string in preparation for MRZ parsing.
@@ -432,6 +543,23 @@ class MRZOCRCleaner(object):
         n = {'B': '8', 'C': '0', 'D': '0', 'G': '6', 'I': '1', 'O': '0', 'Q': '0', 'S': '5', 'Z': '2'}
         self.FIXERS = {'a': a, 'A': a, 'n': n, 'N': n, '*': {}}
 
+        # The same fixing, compiled into str.translate tables (for ASCII characters): for each line of each document type,
+        # a list of (start, end, table) segments, one for each run of positions with the same fixer (see _fix_line).
+        tables = {kind: {ord(c): fixer.get(c.upper(), c.upper()) for c in map(chr, range(128))} for kind, fixer in self.FIXERS.items()}
+        self.PLANS = {tp: [self._plan(fmt, tables) for fmt in lines] for tp, lines in self.FORMAT.items()}
+
+    @staticmethod
+    def _plan(fmt, tables):
+        plan, start = [], 0
+        for kind, run in itertools.groupby(fmt):
+            end = start + len(list(run))
+            if plan and plan[-1][2] == tables[kind]:
+                plan[-1] = (plan[-1][0], end, plan[-1][2])
+            else:
+                plan.append((start, end, tables[kind]))
+            start = end
+        return plan
+
     def _split_lines(self, mrz_ocr_string):
         return [ln for ln in mrz_ocr_string.replace(' ', '').split('\n') if (len(ln) >= 20 or '<<' in ln)]
 
@@ -453,6 +581,10 @@ class MRZOCRCleaner(object):
         return lines
 
     def _fix_line(self, line, type, line_idx):
+        if line.isascii():
+            plan = self.PLANS[type][line_idx]
+            return ''.join([line[start:end].translate(table) for start, end, table in plan]) + line[plan[-1][1]:]
+        # Otherwise character by character, as upper() may turn a non-ASCII character into several ones
         ln = list(line)
         for j in range(len(ln)): #pylint: disable=consider-using-enumerate
             ln[j] = self._fix_char(ln[j], type, line_idx, j)
@@ -469,11 +601,20 @@ class MRZOCRCleaner(object):
 
     @staticmethod
     def apply(txt):
-        if getattr(MRZOCRCleaner, '__instance__', None) is None:
-            MRZOCRCleaner.__instance__ = MRZOCRCleaner()
         return MRZOCRCleaner.__instance__(txt)
 
 
+# The singleton is created eagerly, so that there is no race when it is first used from several threads
+MRZOCRCleaner.__instance__ = MRZOCRCleaner()
+
+
+class _CheckCodes(dict):
+    """The values of the characters in check digit computations, -1000 for the characters which may not be used there."""
+
+    def __missing__(self, key):
+        return -1000
+
+
 class MRZCheckDigit(object):
     """
     The algorithm used to compute "check digits" within MRZ.
@@ -501,25 +642,175 @@ class MRZCheckDigit(object):
     """
 
     def __init__(self):
-        self.CHECK_CODES = dict()
+        self.CHECK_CODES = _CheckCodes()
         for i in range(10):
             self.CHECK_CODES[str(i)] = i
         for i in range(ord('A'), ord('Z')+1):
             self.CHECK_CODES[chr(i)] = i - 55   # A --> 10, B --> 11, etc
         self.CHECK_CODES['<'] = 0
         self.CHECK_WEIGHTS = [7, 3, 1]
+        # The values of the ASCII characters as a bytes.translate table, 255 for the invalid ones
+        self.CHECK_VALUES = bytes(self.CHECK_CODES[chr(i)] if chr(i) in self.CHECK_CODES else 255 for i in range(256))
 
     def __call__(self, txt):
         if txt == '':
             return ''
-        res = sum([self.CHECK_CODES.get(c, -1000)*self.CHECK_WEIGHTS[i % 3] for i, c in enumerate(txt)])
+        is_ascii = txt.isascii()
+        if is_ascii:
+            values = txt.encode('ascii').translate(self.CHECK_VALUES)
+        if not is_ascii or 255 in values:
+            values = list(map(self.CHECK_CODES.__getitem__, txt))  # With -1000 for the invalid characters
+        res = sum(values[0::3])*self.CHECK_WEIGHTS[0] + sum(values[1::3])*self.CHECK_WEIGHTS[1] + sum(values[2::3])*self.CHECK_WEIGHTS[2]
         if res < 0:
             return ''
         else:
-            return str(res % 10)
+            return '0123456789'[res % 10]
 
     @staticmethod
     def compute(txt):
-        if getattr(MRZCheckDigit, '__instance__', None) is None:
-            MRZCheckDigit.__instance__ = MRZCheckDigit()
         return MRZCheckDigit.__instance__(txt)
+
+
+MRZCheckDigit.__instance__ = MRZCheckDigit()  # (See MRZOCRCleaner.__instance__)
+
+
+# All the keys which may be present in MRZ.to_dict() (except raw_text and method, which come from OCR), in the same order
+MRZ_FIELDS = ['mrz_type', 'valid_score', 'type', 'country', 'number', 'date_of_birth', 'expiration_date', 'nationality', 'sex',
+              'names', 'surname', 'optional1', 'optional2', 'personal_number', 'check_number', 'check_date_of_birth',
+              'check_expiration_date', 'check_composite', 'check_personal_number', 'valid_number', 'valid_date_of_birth',
+              'valid_expiration_date', 'valid_composite', 'valid_personal_number']
+
+# Field layouts for parse_batch: fields are (name, line, start, end), surname and names are split from (line, start, end),
+# the composite check digit is computed over the given (line, start, end) segments, the first character must be one of 'misc'.
+# The dates of birth and expiration are checked to be valid dates, except in visas (see MRZ._parse_mrv).
+_SECOND_LINE = [('number', 1, 0, 9), ('check_number', 1, 9, 10), ('nationality', 1, 10, 13), ('date_of_birth', 1, 13, 19),
+                ('check_date_of_birth', 1, 19, 20), ('sex', 1, 20, 21), ('expiration_date', 1, 21, 27),
+                ('check_expiration_date', 1, 27, 28)]
+_BATCH_LAYOUTS = {
+    'TD1': {'check_dates': True, 'length': 30, 'misc': 'IAC', 'names': (2, 0, None),
+            'fields': [('type', 0, 0, 2), ('country', 0, 2, 5), ('number', 0, 5, 14), ('check_number', 0, 14, 15),
+                       ('optional1', 0, 15, 30), ('date_of_birth', 1, 0, 6), ('check_date_of_birth', 1, 6, 7), ('sex', 1, 7, 8),
+                       ('expiration_date', 1, 8, 14), ('check_expiration_date', 1, 14, 15), ('nationality', 1, 15, 18),
+                       ('optional2', 1, 18, 29), ('check_composite', 1, 29, 30)],
+            'composite': [(0, 5, 30), (1, 0, 7), (1, 8, 15), (1, 18, 29)]},
+    'TD2': {'check_dates': True, 'length': 36, 'misc': 'ACI', 'names': (0, 5, 36),
+            'fields': [('type', 0, 0, 2), ('country', 0, 2, 5)] + _SECOND_LINE + [('optional1', 1, 28, 35), ('check_composite', 1, 35, 36)],
+            'composite': [(1, 0, 10), (1, 13, 20), (1, 21, 35)]},
+    'TD3': {'check_dates': True, 'length': 44, 'misc': 'P', 'names': (0, 5, 44),
+            'fields': [('type', 0, 0, 2), ('country', 0, 2, 5)] + _SECOND_LINE + [
+                ('personal_number', 1, 28, 42), ('check_personal_number', 1, 42, 43), ('check_composite', 1, 43, 44)],
+            'composite': [(1, 0, 10), (1, 13, 20), (1, 21, 43)]},
+    'MRVA': {'check_dates': False, 'length': 44, 'misc': 'V', 'names': (0, 5, 44),
+             'fields': [('type', 0, 0, 2), ('country', 0, 2, 5)] + _SECOND_LINE + [('optional1', 1, 28, 44)], 'composite': None},
+    'MRVB': {'check_dates': False, 'length': 36, 'misc': 'V', 'names': (0, 5, 36),
+             'fields': [('type', 0, 0, 2), ('country', 0, 2, 5)] + _SECOND_LINE + [('optional1', 1, 28, 36)], 'composite': None},
+}
+
+# The values of the characters (by their code, up to 127) in check digit computations, -1000 for invalid ones (see MRZCheckDigit)
+_CHECK_VALUES = [MRZCheckDigit.__instance__.CHECK_CODES.get(chr(i), -1000) for i in range(128)]
+
+
+def parse_batch(lines):
+    """
+    Parses many MRZs at once, returning the results in columnar form: a dictionary, mapping each of the MRZ_FIELDS
+    (and 'valid') to a numpy array with one value per MRZ. The values are exactly those of MRZ(lines[i]).to_dict(), except that
+    the fields which are not present in it (e.g. personal_number of a TD1 MRZ, or all the fields but mrz_type and valid_score
+    of an unparseable one) are None. The valid_score column is an integer array, valid is a boolean one, the others have dtype object.
+
+    The MRZs of each type are processed together: the lines are padded to the same width and encoded as arrays of character codes,
+    the fields are sliced as columns of these arrays and the check digits are computed as dot products with the weights.
+
+    :param lines: a sequence of MRZs, each given as a list of 2 or 3 strings (as for the MRZ constructor).
+
+    >>> b = parse_batch([['IDAUT10000999<6<<<<<<<<<<<<<<<', '7109094F1112315AUT<<<<<<<<<<<4', 'MUSTERFRAU<<ISOLDE<<<<<<<<<<<<'],
+    ...                  ['I<UTOERIKSSON<<ANNA<MARIA<<<<<<<<<<<', 'D231458907UTO7408122F1204159<<<<<<<6'],
+    ...                  ['not an MRZ']])
+    >>> b['mrz_type'].tolist(), b['valid_score'].tolist(), b['names'].tolist(), b['optional2'].tolist()
+    (['TD1', 'TD2', None], [100, 100, 0], ['ISOLDE', 'ANNA MARIA', None], ['<<<<<<<<<<<', None, None])
+    >>> [k for k in MRZ_FIELDS if b[k][1] is not None or k == 'mrz_type'] == list(MRZ(['I<UTOERIKSSON<<ANNA<MARIA<<<<<<<<<<<', 'D231458907UTO7408122F1204159<<<<<<<6']).to_dict())
+    True
+    """
+    import numpy as np  # Imported here, so that parsing single MRZs does not need numpy
+    lines = list(lines)
+    n = len(lines)
+    result = {k: np.full(n, None, dtype=object) for k in MRZ_FIELDS}
+    result['valid_score'] = np.zeros(n, dtype=int)
+    result['valid'] = np.zeros(n, dtype=bool)
+    types = [_batch_type(mrz_lines) for mrz_lines in lines]
+    result['mrz_type'][:] = types
+    for i, tp in enumerate(types):
+        if tp is not None and any('\x00' in ln for ln in lines[i]):
+            # NUL characters can not be kept in numpy strings, such (rare) MRZs are parsed one by one
+            types[i] = None
+            mrz = MRZ(lines[i])
+            for k, v in mrz.to_dict().items():
+                result[k][i] = v
+            result['valid'][i] = mrz.valid
+    values = np.array(_CHECK_VALUES + [-1000])
+    for tp, layout in _BATCH_LAYOUTS.items():
+        rows = np.array([i for i, t in enumerate(types) if t == tp], dtype=int)
+        if len(rows) > 0:
+            _parse_batch_group([lines[i] for i in rows], layout, rows, result, values)
+    return result
+
+
+def _batch_type(mrz_lines):
+    """The type of the MRZ as determined by MRZ._parse, i.e. None if its parsing would fail (because not all the lines are strings)."""
+    tp = MRZ._guess_type(mrz_lines)  #pylint: disable=protected-access
+    return tp if tp is not None and all(isinstance(ln, str) for ln in mrz_lines) else None
+
+
+def _parse_batch_group(group, layout, rows, result, values):
+    """Parses the MRZs of the same type for parse_batch, storing the results in the given rows of the result."""
+    import numpy as np
+    length = layout['length']
+    valid_lengths, chars = [], []
+    for i in range(len(group[0])):
+        column = [mrz_lines[i] for mrz_lines in group]
+        valid_lengths.append(np.array([len(ln) == length for ln in column]))
+        chars.append(np.array([ln.ljust(length, '<') for ln in column]))  # Fixed width unicode strings
+    codes = [c.view(np.uint32).reshape(len(group), -1) for c in chars]
+    # The lines are at least `length` long, longer lines may have NULs at the end, which are not part of any field
+    check_values = [values[np.minimum(c[:, :length], 128)] for c in codes]
+
+    def field(line, start, end):
+        return np.ascontiguousarray(chars[line].view('U1').reshape(len(group), -1)[:, start:end]).view('U%d' % (end - start))[:, 0]
+
+    def check_digit_valid(segments, check):
+        vals = np.concatenate([check_values[line][:, start:end] for line, start, end in segments], axis=1)
+        res = vals.dot(np.resize([7, 3, 1], vals.shape[1]))
+        return (res >= 0) & (codes[check[0]][:, check[1]] == ord('0') + res % 10)
+
+    fields = {name: (line, start, end) for name, line, start, end in layout['fields']}
+    for name, (line, start, end) in fields.items():
+        result[name][rows] = field(line, start, end).astype(object)
+    line, start, end = layout['names']
+    names_source = field(line, start, end) if end is not None else chars[line]
+    surname, _, names = np.char.partition(names_source, '<<').T
+    result['surname'][rows] = np.char.strip(np.char.replace(surname, '<', ' ')).astype(object)
+    result['names'][rows] = np.char.strip(np.char.replace(names, '<', ' ')).astype(object)
+
+    checks = []
+    for name in ['number', 'date_of_birth', 'expiration_date']:
+        line, start, end = fields[name]
+        valid = check_digit_valid([fields[name]], fields['check_' + name][:2])
+        if name != 'number' and layout['check_dates']:
+            # The dates are also checked to be valid dates (once per distinct date)
+            unique, inverse = np.unique(field(line, start, end), return_inverse=True)
+            valid &= np.array([MRZ._check_date(d) for d in unique], dtype=bool)[inverse.ravel()]  #pylint: disable=protected-access
+        checks.append(valid)
+    if layout['composite'] is not None:
+        checks.append(check_digit_valid(layout['composite'], fields['check_composite'][:2]))
+    if 'personal_number' in fields:
+        line, start, end = fields['personal_number']
+        check = codes[line][:, fields['check_personal_number'][1]]
+        optional = ((check == ord('<')) | (check == ord('0'))) & np.all(codes[line][:, start:end] == ord('<'), axis=1)
+        checks.append(optional | check_digit_valid([fields['personal_number']], fields['check_personal_number'][:2]))
+    for name, valid in zip(['valid_number', 'valid_date_of_birth', 'valid_expiration_date', 'valid_composite', 'valid_personal_number'], checks):
+        result[name][rows] = valid.astype(object)
+
+    misc = np.isin(codes[0][:, 0], [ord(c) for c in layout['misc']])
+    score = 10*np.sum(checks, axis=0) + np.sum(valid_lengths, axis=0) + misc + 1
+    score = 100*score//(10*len(checks) + len(valid_lengths) + 1 + 1)
+    result['valid_score'][rows] = score
+    result['valid'][rows] = score == 100
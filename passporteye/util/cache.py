@@ -0,0 +1,182 @@
+'''
+PassportEye::Util: On-disk cache for pipeline intermediates
+
+Author: Konstantin Tretyakov
+License: MIT
+'''
+import hashlib
+import os
+import pickle
+import shutil
+import tempfile
+import threading
+import time
+import numpy as np
+
+
+class StageCache(object):
+    """
+    A persistent cache for the values computed by the pipeline components, see Pipeline.cache.
+    Each entry holds all the values provided by a component, under a key which is a hash of the input file, the parameters
+    of the component and all the components before it (see Pipeline.cache_key).
+    Arrays are stored as .npy files (and loaded memory-mapped and read-only), other values are pickled.
+
+    Entries are stored in a separate directory for each pipeline version, so that a new version of the pipeline
+    never sees the results of an old one. When the total size of the cache exceeds max_bytes, the least recently used
+    entries (of any version) are removed until it is down to evict_to * max_bytes.
+    The total size is scanned from the disk once and then kept up to date by put (rescanning only when evicting),
+    so that storing an entry does not get slower as the cache grows. Entries stored by other processes are only
+    accounted for at the next eviction.
+
+    >>> cache = StageCache(tempfile.mkdtemp(), max_bytes=1000)
+    >>> cache.put('k1', {'img': np.zeros((10, 10)), 'scale_factor': 0.5}, version='1.0')
+    >>> sorted(cache.get('k1', ['img', 'scale_factor'], version='1.0').items())[1]
+    ('scale_factor', 0.5)
+    >>> cache.get('k1', ['img', 'scale_factor'], version='2.0') is None
+    True
+    >>> cache.put('k2', {'img': np.zeros((10, 10))}, version='1.0')  # 2 x 800 bytes, k1 must go
+    >>> cache.get('k1', ['img', 'scale_factor'], version='1.0') is None
+    True
+    >>> cache.clear()
+    >>> cache.get('k2', ['img'], version='1.0') is None
+    True
+    """
+
+    def __init__(self, directory, max_bytes=2**30, evict_to=0.9):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.evict_to = evict_to
+        self._size = None  # The total size of the entries, scanned on first put
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _entry_dir(self, key, version):
+        return os.path.join(self.directory, 'v' + version, key)
+
+    def get(self, key, names, version=''):
+        """Returns the dictionary name -> value stored under the key, or None if there is no such (complete) entry."""
+        entry = self._entry_dir(key, version)
+        values = dict()
+        try:
+            for name in names:
+                fn = os.path.join(entry, name)
+                if os.path.exists(fn + '.npy'):
+                    values[name] = np.load(fn + '.npy', mmap_mode='r').view(np.ndarray)
+                else:
+                    with open(fn + '.pkl', 'rb') as f:
+                        values[name] = pickle.load(f)
+            _touch(entry)
+        except (OSError, EOFError, ValueError, pickle.UnpicklingError):
+            return None
+        return values
+
+    def put(self, key, values, version=''):
+        """Stores the dictionary name -> value under the key (unless there already is such an entry),
+        then evicts the least recently used entries if the cache is too large."""
+        entry = self._entry_dir(key, version)
+        if os.path.isdir(entry):
+            return
+        os.makedirs(os.path.dirname(entry), exist_ok=True)
+        tmp = tempfile.mkdtemp(dir=os.path.dirname(entry), prefix='.tmp')
+        size = 0
+        try:
+            for name, value in values.items():
+                fn = os.path.join(tmp, name)
+                if isinstance(value, np.ndarray) and value.dtype != object:
+                    np.save(fn + '.npy', value)
+                else:
+                    with open(fn + '.pkl', 'wb') as f:
+                        pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+            size = sum(f.stat().st_size for f in os.scandir(tmp))
+            os.rename(tmp, entry)  # Atomic, so that concurrent readers never see a partial entry
+            _touch(entry)
+        except (OSError, pickle.PicklingError, TypeError, AttributeError):
+            size = 0  # E.g. the entry was created by someone else meanwhile, or a value can not be pickled
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+        with self._lock:
+            if self._size is None:
+                self._size = sum(size for _, size, _ in self._entries())
+            else:
+                self._size += size
+            if self._size > self.max_bytes:
+                self._size = self._evict(self.evict_to * self.max_bytes)
+
+    def _entries(self):
+        """Lists (last use time, size, path) of all the entries of all versions."""
+        entries = []
+        for version in os.scandir(self.directory):
+            if not version.is_dir():
+                continue
+            for entry in os.scandir(version.path):
+                if entry.is_dir() and not entry.name.startswith('.tmp'):
+                    size = sum(f.stat().st_size for f in os.scandir(entry.path))
+                    entries.append((entry.stat().st_mtime, size, entry.path))
+        return entries
+
+    def evict(self):
+        """Removes the least recently used entries until the cache fits in max_bytes."""
+        with self._lock:
+            self._size = self._evict(self.max_bytes)
+
+    def _evict(self, max_bytes):
+        """Removes the least recently used entries until the cache fits in max_bytes, returns the remaining total size."""
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= max_bytes:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+        return total
+
+    def clear(self, version=None):
+        """Removes all the entries (of the given pipeline version, or of all versions)."""
+        for d in os.scandir(self.directory):
+            if d.is_dir() and (version is None or d.name == 'v' + version):
+                shutil.rmtree(d.path, ignore_errors=True)
+        self._size = None
+
+    def prune(self, version):
+        """Removes all the entries of the pipeline versions other than the given one."""
+        for d in os.scandir(self.directory):
+            if d.is_dir() and d.name != 'v' + version:
+                shutil.rmtree(d.path, ignore_errors=True)
+        self._size = None
+
+
+def _touch(path):
+    """Sets the modification time of the path to now (with a finer resolution than the file system clock may have)."""
+    now = time.time_ns()
+    os.utime(path, ns=(now, now))
+
+
+def fingerprint(component):
+    """Returns a string identifying the computation performed by a component: its class along with its parameters
+    (or the result of its own `fingerprint()` method, if it has one, which may return None when its results must not be cached).
+
+    >>> class Scaler(object):
+    ...     def __init__(self, max_width=250):
+    ...         self.max_width = max_width
+    >>> fingerprint(Scaler(1000))
+    'passporteye.util.cache.Scaler(max_width=1000)'
+
+    Parameters which are objects themselves (e.g. nested components) are fingerprinted recursively.
+    """
+    if hasattr(component, 'fingerprint'):
+        return component.fingerprint()
+    params = ', '.join('%s=%s' % (k, fingerprint(v) if hasattr(v, '__dict__') else repr(v))
+                       for k, v in sorted(vars(component).items()) if not k.startswith('_'))
+    return '%s.%s(%s)' % (type(component).__module__, type(component).__qualname__, params)
+
+
+def content_hash(*chunks):
+    """A hash of the given bytes-like objects (e.g. the contents of a file).
+
+    >>> content_hash(b'abc') == content_hash(memoryview(b'abc'))
+    True
+    """
+    h = hashlib.sha1()
+    for chunk in chunks:
+        h.update(chunk)
+    return h.hexdigest()
@@ -5,10 +5,7 @@ Author: Konstantin Tretyakov
 License: MIT
 '''
 import numpy as np
-from sklearn.decomposition import PCA
-from matplotlib import pyplot as plt
-from matplotlib import patches
-from skimage import transform
+from skimage import transform, util
 
 
 class RotatedBox(object):
@@ -61,6 +58,51 @@ class RotatedBox(object):
         new_c = np.dot(rot.T, (self.center - t)) + t
         return RotatedBox(new_c, self.width, self.height, (self.angle+angle) % (np.pi*2))
 
+    def translated(self, offset):
+        """Returns a copy of this box (along with its points, if any), shifted by the given offset.
+
+        >>> RotatedBox([1, 2], 4, 2, 0.5).translated([10, 20])
+        RotatedBox(cx=11.0, cy=22.0, width=4, height=2, angle=0.5)
+        """
+        offset = np.asarray(offset, dtype=np.float64)
+        points = self.points + offset if self.points is not None else None
+        return RotatedBox(self.center + offset, self.width, self.height, self.angle, points)
+
+    def scaled(self, scale):
+        """Returns a copy of this box (along with its points, if any), with all coordinates multiplied by the given scale.
+
+        >>> RotatedBox([1, 2], 4, 2, 0.5).scaled(2)
+        RotatedBox(cx=2.0, cy=4.0, width=8, height=4, angle=0.5)
+        """
+        points = self.points * scale if self.points is not None else None
+        return RotatedBox(self.center * scale, self.width * scale, self.height * scale, self.angle, points)
+
+    def contains(self, point):
+        """Returns True if the given point lies within the box.
+
+        >>> b = RotatedBox([0, 0], 4, 2, np.pi/2)
+        >>> b.contains([0.5, 1.5]), b.contains([1.5, 0.5])
+        (True, False)
+        """
+        d = np.asarray(point, dtype=np.float64) - self.center
+        along = np.dot(d, [np.cos(self.angle), np.sin(self.angle)])
+        across = np.dot(d, [-np.sin(self.angle), np.cos(self.angle)])
+        return bool(abs(along) <= self.width / 2 and abs(across) <= self.height / 2)
+
+    def aligned(self, angle, tol):
+        """Returns a copy of this box with the angle set exactly to the given value, if it differs from it by at most tol
+        (up to a multiple of np.pi, i.e. regardless of the direction of the box). Otherwise returns the box itself.
+
+        >>> RotatedBox([1, 2], 4, 2, -1.56).aligned(np.pi/2, 0.02)
+        RotatedBox(cx=1.0, cy=2.0, width=4, height=2, angle=1.5707963267948966)
+        >>> RotatedBox([1, 2], 4, 2, 1.5).aligned(np.pi/2, 0.02)
+        RotatedBox(cx=1.0, cy=2.0, width=4, height=2, angle=1.5)
+        """
+        diff = (self.angle - angle) % np.pi
+        if min(diff, np.pi - diff) > tol:
+            return self
+        return RotatedBox(self.center, self.width, self.height, angle, self.points)
+
     def as_poly(self, margin_width=0, margin_height=0):
         """Converts this box to a polygon, i.e. 4x2 array, representing the four corners starting from lower left to upper left counterclockwise.
 
@@ -105,6 +147,7 @@ class RotatedBox(object):
         :param kwargs: arguments passed to the matplotlib's `Polygon` patch object. By default, fill is set to False, color to red and lw to 2.
         :return: The created Polygon object.
         """
+        from matplotlib import pyplot as plt, patches  # Imported here, as matplotlib is only needed for plotting
         ax = ax or plt.gca()
         poly = self.as_poly()
         if mode == 'image':
@@ -134,10 +177,20 @@ class RotatedBox(object):
         :param margin_height: The margin that should be added to the height dimension of the box from each side.
         :return: a numpy ndarray, corresponding to the extracted region (aligned straight).
 
-        TODO: This could be made more efficient if we avoid rotating the full image and cut out the ROI from it beforehand.
+        The result is the same as if we rotated the whole image with skimage.transform.rotate(..., resize=True) and cut the
+        region out of it, however only the pixels of the region itself are actually computed.
+        When the box is axis-aligned (i.e. its angle is a multiple of np.pi/2), no interpolation is needed and the result is a
+        view into the image if it is floating-point (otherwise only the region is converted to floats).
+
+        >>> img = np.arange(100, dtype=np.float64).reshape(10, 10) / 100
+        >>> roi = RotatedBox([4, 5], 4, 2, np.pi/2).extract_from_image(img, margin_width=0, margin_height=0)
+        >>> assert np.allclose(roi, img[3:5, 3:7]) and roi.base is not None
+        >>> roi8 = RotatedBox([4, 5], 4, 2, np.pi/2).extract_from_image((img * 100).astype(np.uint8), margin_width=0, margin_height=0)
+        >>> assert roi8.dtype == np.float64 and roi8.shape == (2, 4) and np.allclose(roi8 * 255, img[3:5, 3:7] * 100)
+        >>> RotatedBox([4, 5], 4, 2, 0.3).extract_from_image(img).shape
+        (11, 12)
         """
-        rotate_by = (np.pi/2 - self.angle)*180/np.pi
-        img_rotated = transform.rotate(img, angle=rotate_by, center=[self.center[1]*scale, self.center[0]*scale], resize=True)
+        tform, (out_rows, out_cols) = self._rotation_transform(img, scale)
         # The resizeable transform will shift the resulting image somewhat wrt original coordinates.
         # When we cut out the box we will compensate for this shift.
         shift_c, shift_r = self._compensate_rotation_shift(img, scale)
@@ -146,18 +199,25 @@ class RotatedBox(object):
         r2 = int((self.center[0] + self.height/2 + margin_height)*scale - shift_r)
         c1 = max(int((self.center[1] - self.width/2 - margin_width)*scale - shift_c), 0)
         c2 = int((self.center[1] + self.width/2 + margin_width)*scale - shift_c)
-        return img_rotated[r1:r2, c1:c2]
 
-    def _compensate_rotation_shift(self, img, scale):
-        """This is an auxiliary method used by extract_from_image.
-        It is needed due to particular specifics of the skimage.transform.rotate implementation.
-        Namely, when you use rotate(... , resize=True), the rotated image is rotated and shifted by certain amount.
-        Thus when we need to cut out the box from the image, we need to account for this shift.
-        We do this by repeating the computation from skimage.transform.rotate here.
+        # Same semantics as slicing the rotated image with [r1:r2, c1:c2]
+        rows = range(out_rows)[r1:r2]
+        cols = range(out_cols)[c1:c2]
+        if len(rows) == 0 or len(cols) == 0:
+            return np.zeros((len(rows), len(cols)) + img.shape[2:])
+        quarter_turns = (np.pi/2 - self.angle) / (np.pi/2)
+        if abs(quarter_turns - round(quarter_turns)) < 1e-9:
+            # Rotation by a multiple of 90 degrees is just a different view of the same data
+            # (only the region itself is converted, i.e. copied, if the image is not floating-point)
+            return util.img_as_float(np.rot90(img, int(round(quarter_turns)) % 4)[r1:r2, c1:c2])
+        tform = transform.SimilarityTransform(translation=(cols.start, rows.start)) + tform
+        tform.params[2] = (0, 0, 1)
+        return transform.warp(img, tform, output_shape=(len(rows), len(cols)), mode='constant', cval=0, clip=True)
 
-        TODO: This makes the code uncomfortably coupled to SKImage (e.g. this logic is appropriate for skimage 0.12.1, but not for 0.11,
-        and no one knows what happens in later versions). A solution would be to use skimage.transform.warp with custom settings, but we can think of it later.
-        """
+    def _rotation_transform(self, img, scale):
+        """Returns the transform (mapping output coordinates to input coordinates) and the output shape
+        used by skimage.transform.rotate(img, (np.pi/2 - angle)*180/np.pi, center=..., resize=True),
+        where the center of rotation is the center of this box scaled by the given scale."""
         ctr = np.asarray([self.center[1]*scale, self.center[0]*scale])
         tform1 = transform.SimilarityTransform(translation=ctr)
         tform2 = transform.SimilarityTransform(rotation=np.pi/2 - self.angle)
@@ -176,12 +236,27 @@ class RotatedBox(object):
         minr = corners[:, 1].min()
         maxc = corners[:, 0].max()
         maxr = corners[:, 1].max()
+        output_shape = np.around((maxr - minr + 1, maxc - minc + 1)).astype(int)
 
         # fit output image in new shape
         translation = (minc, minr)
         tform4 = transform.SimilarityTransform(translation=translation)
         tform = tform4 + tform
         tform.params[2] = (0, 0, 1)
+        return tform, tuple(output_shape)
+
+    def _compensate_rotation_shift(self, img, scale):
+        """This is an auxiliary method used by extract_from_image.
+        It is needed due to particular specifics of the skimage.transform.rotate implementation.
+        Namely, when you use rotate(... , resize=True), the rotated image is rotated and shifted by certain amount.
+        Thus when we need to cut out the box from the image, we need to account for this shift.
+        We do this by repeating the computation from skimage.transform.rotate here (see _rotation_transform).
+
+        TODO: This makes the code uncomfortably coupled to SKImage (e.g. this logic is appropriate for skimage 0.12.1, but not for 0.11,
+        and no one knows what happens in later versions).
+        """
+        ctr = np.asarray([self.center[1]*scale, self.center[0]*scale])
+        tform, _ = self._rotation_transform(img, scale)
 
         # Compute the shift of the transformed center wrt original
         return (ctr - tform.inverse(ctr)).ravel().tolist()
@@ -217,6 +292,7 @@ class RotatedBox(object):
         if points.shape[0] == 1:
             return RotatedBox(points[0], width=0.0, height=0.0, angle=0.0, points=points)
 
+        from sklearn.decomposition import PCA  # Imported on first use (importing sklearn takes about a second)
         m = PCA(2).fit(points)
         # Find the angle
         angle = (np.arctan2(m.components_[0,1], m.components_[0,0]) % np.pi)
@@ -6,6 +6,8 @@ Author: Konstantin Tretyakov
 License: MIT
 '''
 
+import asyncio
+import shlex
 import tempfile
 import numpy as np
 from imageio import imwrite
@@ -32,24 +34,13 @@ def ocr(img, mrz_mode=True, extra_cmdline_params=''):
     output_file_name_base = '%s' % _tempnam()
     output_file_name = "%s.txt" % output_file_name_base
     try:
-        # Prevent annoying warning about lossy conversion to uint8
-        if str(img.dtype).startswith('float') and np.nanmin(img) >= 0 and np.nanmax(img) <= 1:
-            img = img.astype(np.float64) * (np.power(2.0, 8) - 1) + 0.499999999
-            img = img.astype(np.uint8)
-        imwrite(input_file_name, img)
-
-        if mrz_mode:
-			# NB: Tesseract 4.0 does not seem to support tessedit_char_whitelist
-            config = ("--psm 6 -c tessedit_char_whitelist=ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789><"
-                      " -c load_system_dawg=F -c load_freq_dawg=F {}").format(extra_cmdline_params)
-        else:
-            config = "{}".format(extra_cmdline_params)
+        imwrite(input_file_name, _to_uint8(img))
 
         pytesseract.run_tesseract(input_file_name,
                                   output_file_name_base,
                                   'txt',
                                   lang=None,
-                                  config=config)
+                                  config=_config(mrz_mode, extra_cmdline_params))
         
         f = open(output_file_name, encoding='utf-8')
         
@@ -62,6 +53,51 @@ def ocr(img, mrz_mode=True, extra_cmdline_params=''):
         pytesseract.cleanup(output_file_name)
 
 
+async def ocr_async(img, mrz_mode=True, extra_cmdline_params=''):
+    """The asyncio counterpart of ocr: runs Tesseract as a subprocess of the event loop (asyncio.create_subprocess_exec),
+    passing the image via its stdin and reading the text from its stdout, so that no temporary files are needed.
+    When the coroutine is cancelled, the Tesseract process is killed.
+
+    The parameters are those of ocr. Raises pytesseract's TesseractNotFoundError or TesseractError
+    if Tesseract can not be run or fails.
+    """
+    if img is None or img.shape[-1] == 0:  # Issue #34
+        return ''
+    data = imwrite('<bytes>', _to_uint8(img), format='bmp')
+    cmd_args = [pytesseract.tesseract_cmd, 'stdin', 'stdout'] + shlex.split(_config(mrz_mode, extra_cmdline_params))
+    try:
+        proc = await asyncio.create_subprocess_exec(*cmd_args, stdin=asyncio.subprocess.PIPE,
+                                                    stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+    except FileNotFoundError:
+        raise pytesseract.TesseractNotFoundError()
+    try:
+        output, errors = await proc.communicate(data)
+    except BaseException:  # Most importantly, asyncio.CancelledError
+        if proc.returncode is None:
+            proc.kill()
+            await asyncio.shield(proc.wait())
+        raise
+    if proc.returncode:
+        raise pytesseract.TesseractError(proc.returncode, pytesseract.get_errors(errors))
+    return output.decode('utf-8').strip()
+
+
+def _to_uint8(img):
+    # Prevent annoying warning about lossy conversion to uint8
+    if str(img.dtype).startswith('float') and np.nanmin(img) >= 0 and np.nanmax(img) <= 1:
+        img = img.astype(np.float64) * (np.power(2.0, 8) - 1) + 0.499999999
+        img = img.astype(np.uint8)
+    return img
+
+
+def _config(mrz_mode, extra_cmdline_params):
+    if mrz_mode:
+        # NB: Tesseract 4.0 does not seem to support tessedit_char_whitelist
+        return ("--psm 6 -c tessedit_char_whitelist=ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789><"
+                " -c load_system_dawg=F -c load_freq_dawg=F {}").format(extra_cmdline_params)
+    return "{}".format(extra_cmdline_params)
+
+
 def _tempnam():
     '''TODO: Use the with(..) version for auto-deletion?'''
     tmpfile = tempfile.NamedTemporaryFile(prefix="tess_")
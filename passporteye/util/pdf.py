@@ -5,15 +5,26 @@ Author: Konstantin Tretyakov
 License: MIT
 '''
 
+import io
+import struct
 import sys
+import zlib
 
+import numpy as np
+from imageio import v2 as imageio
 from pdfminer.pdfparser import PDFParser
 from pdfminer.pdfdocument import PDFDocument
 from pdfminer.pdfpage import PDFPage
-from pdfminer.pdfinterp import PDFResourceManager
-from pdfminer.pdfinterp import PDFPageInterpreter
-from pdfminer.converter import PDFPageAggregator
-from pdfminer.layout import LTFigure, LTImage
+from pdfminer.pdftypes import LITERALS_CCITTFAX_DECODE, LITERALS_DCT_DECODE, LITERALS_FLATE_DECODE, PDFStream, resolve1
+from pdfminer.psparser import LIT
+
+LITERAL_IMAGE = LIT('Image')
+LITERAL_FORM = LIT('Form')
+LITERAL_INDEXED = LIT('Indexed')
+LITERAL_ICC_BASED = LIT('ICCBased')
+COLOR_COMPONENTS = {LIT('DeviceGray'): 1, LIT('CalGray'): 1, LIT('G'): 1,
+                    LIT('DeviceRGB'): 3, LIT('CalRGB'): 3, LIT('RGB'): 3,
+                    LIT('DeviceCMYK'): 4, LIT('CMYK'): 4}
 
 
 def extract_first_jpeg_in_pdf(fstream):
@@ -24,6 +35,9 @@ def extract_first_jpeg_in_pdf(fstream):
     scanner-produced images around.
     More testing might be needed though.
 
+    The page contents are not interpreted (no layout analysis is done): we only walk the resource dictionaries of the pages,
+    in order, looking for image XObjects (also within form XObjects). Hence inline images are not found.
+
     Note that in principle there is no serious problem extracting PNGs or other image types from PDFs,
     however at the moment I do not have enough test data to try this, and the one I have seems to be unsuitable
     for PDFMiner.
@@ -33,25 +47,183 @@ def extract_first_jpeg_in_pdf(fstream):
     """
     parser = PDFParser(fstream)
     document = PDFDocument(parser)
-    rsrcmgr = PDFResourceManager()
-    device = PDFPageAggregator(rsrcmgr)
-    interpreter = PDFPageInterpreter(rsrcmgr, device)
-    pages = PDFPage.create_pages(document)
-    for page in pages:
-        interpreter.process_page(page)
-        layout = device.result
-        for el in layout:
-            if isinstance(el, LTFigure):
-                for im in el:
-                    if isinstance(im, LTImage):
-                        # Found one!
-                        st = None
-                        try:
-                            imdata = im.stream.get_data()
-                        except:
-                            # Failed to decode (seems to happen nearly always - there's probably a bug in PDFMiner), oh well...
-                            imdata = im.stream.get_rawdata()
-                        if imdata is not None and imdata.startswith(b'\xff\xd8\xff\xe0'):
-                            return imdata
-
+    for page in PDFPage.create_pages(document):
+        for stream in _iter_image_streams(page.resources, set()):
+            if not any(f in LITERALS_DCT_DECODE for f, _ in stream.get_filters()):
+                # Not a JPEG, no need to decode it
+                continue
+            try:
+                imdata = stream.get_data()
+            except Exception:  #pylint: disable=broad-except
+                # Failed to decode (seems to happen nearly always - there's probably a bug in PDFMiner), oh well...
+                imdata = stream.get_rawdata()
+            if imdata is not None and imdata.startswith(b'\xff\xd8\xff'):
+                return imdata
     return None
+
+
+def iter_pdf_images(fstream):
+    """
+    Lazily yields the images embedded in a given PDF file (as image XObjects) as pairs (page_index, image),
+    in the order of pages. The images are decoded to numpy arrays (h x w for grayscale, h x w x 3 for color images).
+    Supported are JPEG (DCTDecode) images, raster images with any of the standard filters (e.g. FlateDecode, i.e. what
+    PNGs are converted to) with 1 or 8 bits per component in gray, RGB, CMYK or indexed color spaces, and
+    CCITT fax images (the latter only if Pillow is installed). Images which can not be decoded are skipped.
+
+    :param fstream: Readable binary stream of the PDF
+    """
+    parser = PDFParser(fstream)
+    document = PDFDocument(parser)
+    for page_index, page in enumerate(PDFPage.create_pages(document)):
+        for stream in _iter_image_streams(page.resources, set()):
+            try:
+                img = _decode_image(stream)
+            except Exception:  #pylint: disable=broad-except
+                img = None
+            if img is not None:
+                yield page_index, img
+
+
+def _iter_image_streams(resources, visited):
+    """Yields the image XObject streams found in the given resource dictionary, recursing into form XObjects.
+    :param visited: the set of ids of the form XObjects visited so far (protects against reference cycles)."""
+    resources = resolve1(resources)
+    if not isinstance(resources, dict):
+        return
+    xobjects = resolve1(resources.get('XObject'))
+    if not isinstance(xobjects, dict):
+        return
+    for xobj in xobjects.values():
+        xobj = resolve1(xobj)
+        if not isinstance(xobj, PDFStream):
+            continue
+        subtype = resolve1(xobj.get('Subtype'))
+        if subtype is LITERAL_IMAGE:
+            yield xobj
+        elif subtype is LITERAL_FORM and id(xobj) not in visited:
+            visited.add(id(xobj))
+            for stream in _iter_image_streams(xobj.get('Resources'), visited):
+                yield stream
+
+
+def _decode_image(stream):
+    """Decodes an image XObject stream to a numpy array, or returns None if this is not supported."""
+    filters = [f for f, _ in stream.get_filters()]
+    if any(f in LITERALS_DCT_DECODE for f in filters):
+        # pdfminer leaves the JPEG data as is
+        data = stream.get_data()
+        if not data.startswith(b'\xff\xd8\xff'):
+            return None
+        img = imageio.imread(data)
+        if img.ndim == 3 and img.shape[2] == 4:
+            img = _cmyk_to_rgb(img)
+        return img
+    elif filters and filters[-1] in LITERALS_CCITTFAX_DECODE:
+        return _decode_ccitt(stream) if len(filters) == 1 else None
+    params = dict(list(stream.get_filters())[-1][1] or {}) if filters else {}
+    if len(filters) == 1 and filters[0] in LITERALS_FLATE_DECODE and resolve1(params.get('Predictor', 1)) >= 10:
+        # The PNG predictors of pdfminer are broken, and the data is exactly what a PNG file would contain anyway
+        return _decode_raster(_unpredict_png(stream.get_rawdata(), params), stream)
+    return _decode_raster(stream.get_data(), stream)
+
+
+def _unpredict_png(data, params):
+    """Decodes the Flate-compressed samples with PNG predictors, by wrapping them into a PNG file and decoding that."""
+    colors = resolve1(params.get('Colors', 1))
+    columns = resolve1(params.get('Columns', 1))
+    bits = resolve1(params.get('BitsPerComponent', 8))
+    color_type = {1: 0, 2: 4, 3: 2, 4: 6}[colors]  # Gray, gray+alpha, RGB, RGBA (the latter used for CMYK as well)
+    rows = len(zlib.decompress(data)) // (1 + (columns * colors * bits + 7) // 8)
+
+    def chunk(tag, body):
+        return struct.pack('>I', len(body)) + tag + body + struct.pack('>I', zlib.crc32(tag + body) & 0xffffffff)
+
+    png = (b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', struct.pack('>IIBBBBB', columns, rows, bits, color_type, 0, 0, 0)) +
+           chunk(b'IDAT', data) + chunk(b'IEND', b''))
+    samples = np.asarray(imageio.imread(png))
+    if bits == 1:
+        return np.packbits(samples.astype(bool), axis=1).tobytes()
+    return samples.astype(np.uint8).tobytes()
+
+
+def _decode_raster(data, stream):
+    """Decodes the (already unfiltered) samples of a raster image."""
+    width, height = resolve1(stream['Width']), resolve1(stream['Height'])
+    bits = 1 if resolve1(stream.get('ImageMask')) else resolve1(stream.get('BitsPerComponent', 8))
+    palette = None
+    colorspace = resolve1(stream.get('ColorSpace', LIT('DeviceGray')))
+    if isinstance(colorspace, list) and colorspace and colorspace[0] is LITERAL_INDEXED:
+        base, lookup = resolve1(colorspace[1]), resolve1(colorspace[3])
+        lookup = lookup.get_data() if isinstance(lookup, PDFStream) else lookup
+        base_components = _color_components(base)
+        if base_components is None:
+            return None
+        palette = np.frombuffer(lookup, np.uint8)
+        palette = palette[:len(palette) // base_components * base_components].reshape(-1, base_components)
+        components = 1
+    else:
+        components = _color_components(colorspace)
+        if components is None:
+            return None
+
+    if bits == 8:
+        img = np.frombuffer(data, np.uint8, count=width * height * components).reshape(height, width, components)
+    elif bits == 1 and components == 1:
+        row_bytes = (width + 7) // 8
+        rows = np.frombuffer(data, np.uint8, count=row_bytes * height).reshape(height, row_bytes)
+        img = np.unpackbits(rows, axis=1)[:, :width, None]
+        if palette is None:
+            img = img * np.uint8(255)
+    else:
+        return None
+
+    decode = resolve1(stream.get('Decode'))
+    if palette is None and isinstance(decode, list) and len(decode) >= 2 and decode[0] > decode[1]:
+        img = 255 - img
+    if palette is not None:
+        img = palette[np.minimum(img[..., 0], len(palette) - 1)]
+    if img.shape[2] == 4:
+        img = _cmyk_to_rgb(img)
+    return img[..., 0] if img.shape[2] == 1 else img
+
+
+def _color_components(colorspace):
+    """Number of components of the given (device, calibrated or ICC-based) color space, or None if not supported."""
+    if isinstance(colorspace, list) and len(colorspace) >= 2 and colorspace[0] is LITERAL_ICC_BASED:
+        return resolve1(resolve1(colorspace[1]).get('N'))
+    if isinstance(colorspace, list) and colorspace:
+        colorspace = colorspace[0]
+    return COLOR_COMPONENTS.get(colorspace)
+
+
+def _cmyk_to_rgb(img):
+    """Naive CMYK to RGB conversion."""
+    cmy, k = img[..., :3].astype(np.float64), img[..., 3:].astype(np.float64)
+    return ((255 - cmy) * (255 - k) / 255).astype(np.uint8)
+
+
+def _decode_ccitt(stream):
+    """Decodes a CCITT fax image by wrapping it into a TIFF file and passing it to Pillow (if it is installed)."""
+    try:
+        from PIL import Image
+    except ImportError:
+        return None
+    params = dict(list(stream.get_filters())[-1][1] or {})
+    k = resolve1(params.get('K', 0))
+    width = resolve1(params.get('Columns', 1728))
+    height = resolve1(params.get('Rows', 0)) or resolve1(stream['Height'])
+    black_is_1 = bool(resolve1(params.get('BlackIs1', False)))
+    data = stream.get_rawdata()
+    tags = [(256, 4, width), (257, 4, height), (258, 3, 1),
+            (259, 3, 4 if k < 0 else 3),     # Compression: CCITT T.6 (group 4) or T.4 (group 3)
+            (262, 3, 1 if black_is_1 else 0),  # Photometric interpretation: BlackIsZero or WhiteIsZero
+            (273, 4, 0), (277, 3, 1), (278, 4, height), (279, 4, len(data))]
+    if k >= 0:
+        tags.append((292, 4, 1 if k > 0 else 0))  # T4Options: 2D coding
+    header_size = 8 + 2 + 12 * len(tags) + 4
+    ifd = b''.join(struct.pack('<HHII', tag, tp, 1, header_size if tag == 273 else value) for tag, tp, value in tags)
+    tiff = b'II*\x00' + struct.pack('<I', 8) + struct.pack('<H', len(tags)) + ifd + struct.pack('<I', 0) + data
+    img = np.asarray(Image.open(io.BytesIO(tiff)).convert('L'))
+    if resolve1(stream.get('Decode')) == [1, 0]:
+        img = 255 - img
+    return img
@@ -4,6 +4,13 @@ PassportEye::Util: Pipeline utility
 Author: Konstantin Tretyakov
 License: MIT
 '''
+import copy
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from .cache import content_hash, fingerprint
+from .profiling import call_hooked
 
 
 class Pipeline(object):
@@ -37,6 +44,18 @@ class Pipeline(object):
     (4, 0)
     >>> a['d']
     0
+
+    In "release mode" (see retain), intermediate values are dropped as soon as all the components which need them
+    for computing the retained keys have run:
+
+    >>> a.retain(['e'])
+    >>> a.invalidate('a')
+    >>> a['e']
+    (4, 0)
+    >>> sorted(k for k in a.data if not k.startswith('__'))
+    ['e']
+    >>> sorted(a.released)
+    ['a', 'b']
     """
 
     def __init__(self):
@@ -45,6 +64,15 @@ class Pipeline(object):
         self.provides = dict()    # Component name -> provides list
         self.depends = dict()     # Component name -> depends list
         self.whoprovides = dict() # key -> component name
+        self.dependents = dict()  # key -> set of names of components depending on it
+        self.retained = None      # Keys to keep in release mode (None if not in release mode)
+        self.released = set()     # Keys computed, but then dropped in release mode
+        self.needed = set()       # Names of the components needed for computing the retained keys
+        self.pending = dict()     # key -> number of the needed components which are still to be run and depend on it
+        self.timeline = []        # (component name, start, end, worker) for each component run
+        self.hooks = []           # Profiling hooks, see add_hook
+        self.cache = None         # A StageCache for the results of components marked __cacheable__, see cache_key
+        self.cache_keys = dict()  # Component name -> its cache key (or None), see cache_key
         self.data['__data__'] = self.data
         self.data['__pipeline__'] = self
 
@@ -64,6 +92,52 @@ class Pipeline(object):
         self.components[name] = callable
         for p in provides:
             self.whoprovides[p] = name
+        for d in depends:
+            self.dependents.setdefault(d, set()).add(name)
+        self.cache_keys = dict()
+        self._plan()
+
+    def clone(self):
+        """
+        Returns a copy of the pipeline with the same components (shared, not copied, so they must not keep
+        per-computation state), hooks and cache, but without any of the computed values. Replacing components in
+        the copy does not affect the original, hence a pipeline may serve as a template for computations in several threads.
+
+        >>> a = Pipeline()
+        >>> a.add_component('1', lambda: 1, ['a'], [])
+        >>> a.add_component('inc', lambda x: x + 1, ['b'], ['a'])
+        >>> a['b']
+        2
+        >>> b = a.clone()
+        >>> b.replace_component('1', lambda: 10, ['a'], [])
+        >>> 'b' in b.data, b['b'], a['b']
+        (False, 11, 2)
+        """
+        p = copy.copy(self)
+        p.data = {k: v for k, v in self.data.items() if k not in self.whoprovides and not k.startswith('__')}
+        p.data['__data__'] = p.data
+        p.data['__pipeline__'] = p
+        p.components = dict(self.components)
+        p.provides = dict(self.provides)
+        p.depends = dict(self.depends)
+        p.whoprovides = dict(self.whoprovides)
+        p.dependents = {k: set(v) for k, v in self.dependents.items()}
+        p.retained = None if self.retained is None else set(self.retained)
+        p.released = set()
+        p.timeline = []
+        p.hooks = list(self.hooks)
+        p.cache_keys = dict()
+        p._plan()
+        return p
+
+    def add_hook(self, hook):
+        """Installs a profiling hook: an object with the before(event) and after(event) methods, called around every
+        component run and every OCR call made by the components (see util.profiling for the details and built-in hooks).
+        With Pipeline.compute, the hooks are called for components run in thread pools, but not in other executors."""
+        self.hooks.append(hook)
+
+    def remove_hook(self, hook):
+        self.hooks.remove(hook)
 
     def remove_component(self, name):
         """Removes an existing component with a given name, invalidating all the values computed by
@@ -71,11 +145,15 @@ class Pipeline(object):
         if name not in self.components:
             raise Exception("No component named %s" % name)
         del self.components[name]
+        for d in self.depends[name]:
+            self.dependents[d].discard(name)
         del self.depends[name]
         for p in self.provides[name]:
             del self.whoprovides[p]
-            self.invalidate(p)
+            self._invalidate(p)
         del self.provides[name]
+        self.cache_keys = dict()
+        self._plan()
 
     def replace_component(self, name, callable, provides=None, depends=None):
         """Changes an existing component with a given name, invalidating all the values computed by
@@ -85,33 +163,215 @@ class Pipeline(object):
 
     def invalidate(self, key):
         """Remove the given data item along with all items that depend on it in the graph."""
-        if key not in self.data:
+        self._invalidate(key)
+        self._plan()
+
+    def _invalidate(self, key):
+        if key in self.data:
+            del self.data[key]
+        elif key in self.released:
+            self.released.discard(key)
+        else:
             return
-        del self.data[key]
 
-        # Find all components that used it and invalidate their results
-        for cname in self.components:
-            if key in self.depends[cname]:
-                for downstream_key in self.provides[cname]:
-                    self.invalidate(downstream_key)
+        # Invalidate the results of all components that used it
+        for cname in self.dependents.get(key, ()):
+            for downstream_key in self.provides[cname]:
+                self._invalidate(downstream_key)
+
+    def retain(self, keys):
+        """
+        Switches the pipeline to "release mode": when computing the given keys, each intermediate value is dropped from
+        self.data as soon as all the components which need it for computing those keys have run (as are the unused
+        outputs of these components). A dropped value which is requested later is recomputed.
+        Pass None to switch release mode off.
+        """
+        self.retained = None if keys is None else set(keys)
+        self._plan()
+
+    def _plan(self):
+        """Finds the components needed for computing the retained keys and counts, for each key, those of them
+        which still have to be run and need it."""
+        self.pending = dict()
+        self.needed = set()
+        if self.retained is None:
+            return
+        stack = [self.whoprovides[k] for k in self.retained if k in self.whoprovides]
+        while stack:
+            cname = stack.pop()
+            if cname in self.needed:
+                continue
+            self.needed.add(cname)
+            stack.extend(self.whoprovides[d] for d in self.depends[cname] if d in self.whoprovides)
+        for cname in self.needed:
+            if not all(k in self.data or k in self.released for k in self.provides[cname]):
+                for d in self.depends[cname]:
+                    self.pending[d] = self.pending.get(d, 0) + 1
+
+    def _release(self, cname):
+        """Called in release mode after the component cname has run: drops the values no longer needed."""
+        if cname not in self.needed:
+            return
+        for d in self.depends[cname]:
+            if d in self.pending:
+                self.pending[d] -= 1
+        for k in self.depends[cname] + self.provides[cname]:
+            if self.pending.get(k, 0) == 0 and k not in self.retained and k in self.whoprovides and k in self.data:
+                del self.data[k]
+                self.released.add(k)
 
     def __setitem__(self, key, value):
         self.data[key] = value
 
     def __getitem__(self, key):
-        self._compute(key)
-        return self.data[key]
+        return self._compute(key)
+
+    def cache_key(self, cname):
+        """
+        Returns the key under which the results of the given component are stored in self.cache: a hash of the pipeline
+        version, the fingerprint of the component (see util.cache.fingerprint) and the keys of the components it depends on.
+        Returns None if the component or any of those it depends on is not marked as __cacheable__ (or has a None fingerprint).
+        """
+        if cname not in self.cache_keys:
+            key = None
+            component = self.components[cname]
+            if getattr(component, '__cacheable__', False):
+                dep_keys = [self.cache_key(self.whoprovides[d]) if d in self.whoprovides else None for d in self.depends[cname]]
+                component_fingerprint = fingerprint(component) if None not in dep_keys else None
+                if component_fingerprint is not None:
+                    key = content_hash(repr((getattr(self, 'version', ''), component_fingerprint, self.provides[cname],
+                                             self.depends[cname], dep_keys)).encode('utf-8'))
+            self.cache_keys[cname] = key
+        return self.cache_keys[cname]
+
+    def _load_cached(self, cname):
+        """Tries to load the results of a component from the cache, returns True on success."""
+        if self.cache is None or self.cache_key(cname) is None:
+            return False
+        values = self.cache.get(self.cache_key(cname), self.provides[cname], getattr(self, 'version', ''))
+        if values is None:
+            return False
+        self.data.update(values)
+        self.released.difference_update(self.provides[cname])
+        return True
 
     def _compute(self, key):
-        if key not in self.data:
-            cname = self.whoprovides[key]
-            for d in self.depends[cname]:
-                self._compute(d)
-            inputs = [self.data[d] for d in self.depends[cname]]
-            results = self.components[cname](*inputs)
-            if len(self.provides[cname]) == 1:
-                self.data[self.provides[cname][0]] = results
+        if key in self.data:
+            return self.data[key]
+        cname = self.whoprovides[key]
+        if self._load_cached(cname):
+            value = self.data[key]
+            if self.retained is not None:
+                self._release(cname)
+            return value
+        inputs = [self._compute(d) for d in self.depends[cname]]
+        self._store(cname, self._run(cname, inputs))
+        value = self.data[key]
+        if self.retained is not None:
+            self._release(cname)
+        return value
+
+    def _run(self, cname, inputs):
+        """Runs a component, calling the hooks (if any) around it."""
+        if not self.hooks:
+            return _run_component(self.components[cname], inputs)
+        callable = self.components[cname]
+        return call_hooked(tuple(self.hooks), 'component', cname, lambda *inputs: _run_component(callable, inputs), *inputs)
+
+    def _store(self, cname, run):
+        """Stores the results of a component run (as returned by _run_component) and records it in the timeline."""
+        start, end, worker, results = run
+        self.timeline.append((cname, start, end, worker))
+        if len(self.provides[cname]) == 1:
+            self.data[self.provides[cname][0]] = results
+        else:
+            for k, v in zip(self.provides[cname], results):
+                self.data[k] = v
+        self.released.difference_update(self.provides[cname])
+        if self.cache is not None and self.cache_key(cname) is not None:
+            self.cache.put(self.cache_key(cname), {k: self.data[k] for k in self.provides[cname]}, getattr(self, 'version', ''))
+
+    def compute(self, keys, executor=None):
+        """
+        Computes several keys at once, returning a dictionary key -> value. When an executor (e.g. a ThreadPoolExecutor or,
+        for picklable components, a ProcessPoolExecutor) is given, the components which do not depend on each other are
+        run concurrently in it. Components depending on __data__ run in the calling thread, and those depending on
+        __pipeline__ (which may compute, replace or invalidate anything) run in the calling thread while nothing else runs.
+        Each component run is recorded in self.timeline as a (name, start, end, worker) tuple (times from time.perf_counter).
+
+        >>> from concurrent.futures import ThreadPoolExecutor
+        >>> a = Pipeline()
+        >>> a.add_component('1', lambda: 1, ['a'], [])
+        >>> a.add_component('2', lambda: 2, ['b'], [])
+        >>> a.add_component('sum', lambda x, y: x + y, ['c'], ['a', 'b'])
+        >>> a.add_component('diff', lambda x, y: x - y, ['d'], ['a', 'b'])
+        >>> with ThreadPoolExecutor(2) as ex:
+        ...     a.compute(['c', 'd'], ex)
+        {'c': 3, 'd': -1}
+        >>> sorted(name for name, start, end, worker in a.timeline)
+        ['1', '2', 'diff', 'sum']
+        """
+        result = {k: self.data[k] for k in keys if k in self.data}
+        # The components to run and the components (among those) each of them is waiting for
+        todo, stack = set(), [self.whoprovides[k] for k in keys if k not in self.data]
+        while stack:
+            cname = stack.pop()
+            if cname in todo or all(k in self.data for k in self.provides[cname]):
+                continue
+            if self._load_cached(cname):
+                result.update((k, self.data[k]) for k in keys if k in self.provides[cname])
             else:
-                for k, v in zip(self.provides[cname], results):
-                    self.data[k] = v
+                todo.add(cname)
+                stack.extend(self.whoprovides[d] for d in self.depends[cname] if d not in self.data and d in self.whoprovides)
+        waiting = {c: {self.whoprovides[d] for d in self.depends[c] if self.whoprovides.get(d) in todo} for c in todo}
+        running = dict()  # future -> component name
+
+        def finish(cname, run=None):
+            if run is not None:
+                self._store(cname, run)
+            result.update((k, self.data[k]) for k in keys if k in self.provides[cname])
+            if self.retained is not None:
+                self._release(cname)
+            todo.discard(cname)
+            for c in todo:
+                waiting[c].discard(cname)
+
+        try:
+            while todo:
+                progress, inline, exclusive = False, [], []
+                for cname in sorted(c for c in todo if not waiting[c] and c not in running.values()):
+                    if all(k in self.data for k in self.provides[cname]):
+                        finish(cname)  # Already computed meanwhile (e.g. by a component using __pipeline__)
+                        progress = True
+                    elif executor is None or '__data__' in self.depends[cname] and '__pipeline__' not in self.depends[cname]:
+                        inline.append(cname)
+                    elif '__pipeline__' in self.depends[cname]:
+                        exclusive.append(cname)
+                    else:
+                        inputs = [self._compute(d) for d in self.depends[cname]]
+                        if self.hooks and isinstance(executor, ThreadPoolExecutor):
+                            running[executor.submit(self._run, cname, inputs)] = cname
+                        else:
+                            running[executor.submit(_run_component, self.components[cname], inputs)] = cname
+                        progress = True
+                if inline or (exclusive and not running):
+                    cname = (inline or exclusive)[0]
+                    finish(cname, self._run(cname, [self._compute(d) for d in self.depends[cname]]))
+                elif running:
+                    done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+                    for future in done:
+                        finish(running.pop(future), future.result())
+                elif not progress and todo:
+                    raise Exception("Circular dependencies between components %s" % sorted(todo))
+        finally:
+            if running:
+                wait(list(running))
+        return {k: result[k] for k in keys}
+
 
+def _run_component(callable, inputs):
+    """Runs a component on its inputs, returning (start, end, worker, results). Module-level, so that it can be pickled
+    for process executors."""
+    start = time.perf_counter()
+    results = callable(*inputs)
+    return start, time.perf_counter(), '%d/%s' % (os.getpid(), threading.current_thread().name), results
@@ -0,0 +1,148 @@
+'''
+PassportEye::Util: Profiling hooks for pipelines
+
+Hooks are objects with `before(event)` and `after(event)` methods (see Hook), installed with Pipeline.add_hook.
+They are called around every component run by the pipeline and every OCR call (and ROI extraction) made by its components.
+An event is a dictionary with the following keys:
+
+    kind:      'component', 'ocr' or 'roi'
+    name:      the name of the component (or 'ocr', 'extract_roi')
+    shapes:    the shapes of the inputs which have one (numpy arrays), None for the other inputs
+    start:     time.perf_counter() at the start of the call
+    end, duration (seconds), allocated (the net number of bytes allocated, if memory is traced, otherwise None):
+               only set for `after`
+    worker:    "<process id>/<thread name>" of the caller
+
+When no hooks are installed, nothing of this is done at all.
+
+Author: Konstantin Tretyakov
+License: MIT
+'''
+import contextvars
+import json
+import logging
+import os
+import threading
+import time
+import tracemalloc
+
+# The hooks of the pipeline whose component is currently running (so that OCR calls made by components can be reported)
+_active_hooks = contextvars.ContextVar('passporteye_hooks', default=())
+
+
+class Hook(object):
+    """Base class for hooks (any object with the `before` and `after` methods will do, though).
+    When a hook has `trace_memory = True`, the net memory allocated by each call is measured using tracemalloc
+    (which is started on the first such call, and slows everything down noticeably).
+    Hooks must be thread-safe: components (and OCR calls) may run concurrently, see Pipeline.compute."""
+
+    trace_memory = False
+
+    def before(self, event):
+        pass
+
+    def after(self, event):
+        pass
+
+
+def call_hooked(hooks, kind, name, fn, *args, **kwargs):
+    """Calls fn(*args, **kwargs), reporting the call to the given hooks. The hooks are also made active for the duration
+    of the call, so that the OCR calls made inside are reported to them as well."""
+    event = {'kind': kind, 'name': name, 'shapes': [getattr(a, 'shape', None) for a in args],
+             'worker': '%d/%s' % (os.getpid(), threading.current_thread().name)}
+    trace_memory = any(getattr(h, 'trace_memory', False) for h in hooks)
+    if trace_memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    for h in hooks:
+        h.before(event)
+    memory = tracemalloc.get_traced_memory()[0] if trace_memory else None
+    token = _active_hooks.set(hooks)
+    event['start'] = time.perf_counter()
+    try:
+        return fn(*args, **kwargs)
+    finally:
+        event['end'] = time.perf_counter()
+        _active_hooks.reset(token)
+        event['duration'] = event['end'] - event['start']
+        event['allocated'] = tracemalloc.get_traced_memory()[0] - memory if trace_memory else None
+        for h in hooks:
+            h.after(event)
+
+
+def traced(kind, name, fn, *args, **kwargs):
+    """Calls fn(*args, **kwargs), reporting the call to the hooks of the currently running pipeline component, if any."""
+    hooks = _active_hooks.get()
+    if not hooks:
+        return fn(*args, **kwargs)
+    return call_hooked(hooks, kind, name, fn, *args, **kwargs)
+
+
+class LoggingHook(Hook):
+    """Logs each finished call (with its duration, input shapes and allocated memory) as a structured log record:
+    the event is available as the `passporteye` attribute of the record."""
+
+    def __init__(self, logger=None, level=logging.DEBUG, trace_memory=False):
+        self.logger = logger or logging.getLogger('passporteye')
+        self.level = level
+        self.trace_memory = trace_memory
+
+    def after(self, event):
+        self.logger.log(self.level, "%s %s: %.1f ms", event['kind'], event['name'], event['duration'] * 1000,
+                        extra={'passporteye': event})
+
+
+class Timings(Hook):
+    """Collects an in-memory summary of the calls: the number of calls and the total duration (in seconds) for each name.
+
+    >>> t = Timings()
+    >>> t.after({'kind': 'component', 'name': 'loader', 'duration': 0.5, 'allocated': None})
+    >>> t.after({'kind': 'ocr', 'name': 'ocr', 'duration': 0.25, 'allocated': None})
+    >>> t.after({'kind': 'ocr', 'name': 'ocr', 'duration': 0.25, 'allocated': None})
+    >>> t.summary()
+    {'loader': {'calls': 1, 'seconds': 0.5}, 'ocr': {'calls': 2, 'seconds': 0.5}}
+    """
+
+    def __init__(self, trace_memory=False):
+        self.trace_memory = trace_memory
+        self.totals = dict()
+        self._lock = threading.Lock()
+
+    def after(self, event):
+        with self._lock:
+            total = self.totals.setdefault(event['name'], {'calls': 0, 'seconds': 0.0})
+            total['calls'] += 1
+            total['seconds'] += event['duration']
+            if event['allocated'] is not None:
+                total['allocated'] = total.get('allocated', 0) + event['allocated']
+
+    def summary(self):
+        with self._lock:
+            return {name: dict(total) for name, total in self.totals.items()}
+
+
+class ChromeTrace(Hook):
+    """Collects the calls as "complete" events of the Chrome trace format, viewable in chrome://tracing or Perfetto.
+
+    >>> t = ChromeTrace()
+    >>> t.after({'kind': 'ocr', 'name': 'ocr', 'start': 1.0, 'duration': 0.5, 'worker': '1/MainThread',
+    ...          'shapes': [(40, 600)], 'allocated': None})
+    >>> t.to_json()
+    '{"traceEvents": [{"name": "ocr", "cat": "ocr", "ph": "X", "ts": 1000000.0, "dur": 500000.0, "pid": 1, "tid": "MainThread", "args": {"shapes": [[40, 600]], "allocated": null}}]}'
+    """
+
+    def __init__(self, trace_memory=False):
+        self.trace_memory = trace_memory
+        self.events = []
+
+    def after(self, event):
+        pid, tid = event['worker'].split('/', 1)
+        self.events.append({'name': event['name'], 'cat': event['kind'], 'ph': 'X',
+                            'ts': event['start'] * 1e6, 'dur': event['duration'] * 1e6, 'pid': int(pid), 'tid': tid,
+                            'args': {'shapes': event['shapes'], 'allocated': event['allocated']}})
+
+    def to_json(self):
+        return json.dumps({'traceEvents': list(self.events)})
+
+    def save(self, filename):
+        with open(filename, 'w') as f:
+            f.write(self.to_json())
@@ -38,6 +38,7 @@ setup(name='PassportEye',
       entry_points={
           'console_scripts': ['evaluate_mrz=passporteye.mrz.scripts:evaluate_mrz',
                               'mrz=passporteye.mrz.scripts:mrz',
-                              'extract_mrz_rois=passporteye.mrz.scripts:extract_mrz_rois']
+                              'extract_mrz_rois=passporteye.mrz.scripts:extract_mrz_rois',
+                              'mrz-parse=passporteye.mrz.scripts:mrz_parse']
       }
      )
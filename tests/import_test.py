@@ -0,0 +1,61 @@
+'''
+Test module for use with py.test.
+Write each test as a function named test_<something>.
+Read more here: http://pytest.org/
+
+Author: Konstantin Tretyakov
+License: MIT
+'''
+import os
+import subprocess
+import sys
+import pytest
+import passporteye
+
+HEAVY_MODULES = ['numpy', 'scipy', 'skimage', 'sklearn', 'matplotlib', 'pdfminer', 'pytesseract', 'pkg_resources']
+
+
+def import_times(module):
+    """Imports the module in a fresh interpreter with `python -X importtime`, returning the dictionary
+    module -> cumulative import time (in seconds) of all the modules imported."""
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([root] + os.environ.get('PYTHONPATH', '').split(os.pathsep)))
+    out = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import %s' % module], env=env, cwd=root,
+                         stderr=subprocess.PIPE, universal_newlines=True, check=True).stderr
+    times = {}
+    for line in out.splitlines():
+        if line.startswith('import time:') and '|' in line and 'cumulative' not in line:
+            _, cumulative, name = line.split('|')
+            times[name.strip()] = int(cumulative) / 1e6
+    return times
+
+
+LIGHT_MODULES = ['passporteye', 'passporteye.mrz.text', 'passporteye.mrz.scripts']
+
+
+def test_lazy_imports():
+    # Parsing MRZ texts and starting the scripts needs none of the image processing stack
+    for module in LIGHT_MODULES:
+        times = import_times(module)
+        assert not [m for m in times if m.split('.')[0] in HEAVY_MODULES], module
+    # The image pipeline loads matplotlib (plotting), scikit-learn (PCA) and pdfminer (PDFs) only when they are used
+    times = import_times('passporteye.mrz.image')
+    assert not {'sklearn', 'matplotlib', 'pdfminer'} & set(times)
+
+
+@pytest.mark.skipif(not os.environ.get('PASSPORTEYE_BENCHMARK'), reason='Set PASSPORTEYE_BENCHMARK=1 to run the benchmarks')
+def test_benchmark_import_time():
+    """The cumulative import time of the modules not needing the image processing stack must be under 0.5s.
+    Run with `PASSPORTEYE_BENCHMARK=1 python -m pytest -s -k benchmark tests/import_test.py`."""
+    for module in LIGHT_MODULES:
+        seconds = import_times(module)[module]
+        print('\nimport %s: %0.0f ms' % (module, seconds * 1e3))
+        assert seconds < 0.5, (module, seconds)
+
+
+def test_lazy_attributes():
+    from passporteye.mrz.image import read_mrz, MRZReader
+    assert passporteye.read_mrz is read_mrz and passporteye.MRZReader is MRZReader
+    assert {'read_mrz', 'read_mrz_many', 'read_mrz_async', 'locate_mrz'} <= set(dir(passporteye))
+    with pytest.raises(AttributeError):
+        passporteye.no_such_name
@@ -6,8 +6,24 @@ Read more here: http://pytest.org/
 Author: Peter Horsley
 License: MIT
 '''
+import asyncio
 import io
+import mmap
+import os
+import random
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pytest
+from imageio import imread, imwrite
+from pytesseract import pytesseract
+from skimage import filters, transform
 from passporteye import read_mrz
+from passporteye import read_all_mrz, locate_mrz
+from passporteye.mrz import image
+from passporteye.mrz.image import MRZPipeline, MRZReader, MRZStreamReader, MultiMRZPipeline
+from passporteye.util.geometry import RotatedBox
 
 def read_img(filename, as_stream=False):
     file = io.open(filename, "rb", buffering=0) if as_stream else filename
@@ -111,3 +127,405 @@ def assert_td2_png(mrz):
     assert mrz.valid_date_of_birth
     assert mrz.valid_expiration_date
     assert mrz.valid_composite
+
+def test_box_scores_rank_mrz_first():
+    # The MRZ is the widest of the candidate boxes on the sample passport, yet it is not the first one by area
+    p = MRZPipeline('./tests/data/passport-td3.png')
+    boxes, scores = p['boxes'], p['box_scores']
+    assert len(scores) == len(boxes) > 1
+    assert all(0 <= s <= 1 for s in scores)
+    best = max(range(len(boxes)), key=lambda i: scores[i])
+    assert boxes[best].width == max(b.width for b in boxes)
+    assert best != 0
+
+
+def test_min_box_score(monkeypatch):
+    # Garbled readings, so that all the boxes are tried unless their score is too low
+    rois = []
+    monkeypatch.setattr(image, 'ocr', lambda roi, **kwargs: rois.append(roi) or 'P<UTO')
+    scores = MRZPipeline('./tests/data/passport-td3.png')['box_scores']
+    calls = []
+    for min_box_score in [0.0, 0.5, 1.0]:
+        del rois[:]
+        read_mrz('./tests/data/passport-td3.png', min_box_score=min_box_score)
+        calls.append(len(rois))
+    assert calls[0] > calls[1] > calls[2] == 0 and len([s for s in scores if s >= 0.5]) == 1
+
+def test_quality_gate():
+    assert MRZPipeline('./tests/data/passport-td3.png').rejection_reason is None
+
+    buf = io.BytesIO()
+    imwrite(buf, np.full((600, 800), 128, dtype=np.uint8), format='png')
+    p = MRZPipeline(io.BytesIO(buf.getvalue()))
+    assert p.rejection_reason == 'blank'
+    assert p.result is None  # Rejected without running OCR
+    assert read_mrz(io.BytesIO(buf.getvalue()), return_reason=True) == (None, 'blank')
+
+    # An 8-bit document narrower than Scaler.max_width is not rescaled (hence not converted to floats) by the Scaler
+    img = imread('./tests/data/passport-td3.png')[..., :3].mean(axis=2)
+    small = transform.rescale(img, 240.0 / img.shape[1], preserve_range=True, anti_aliasing=True).astype(np.uint8)
+    p = MRZPipeline(small)
+    assert p['img_small'].dtype == np.uint8
+    assert p.rejection_reason is None and p['quality']['overexposed'] < 0.9
+
+def test_prior_region_boxes():
+    p = MRZPipeline('./tests/data/passport-td3.png', prior_region=0.4)
+    prior_boxes, boxes = p['prior_boxes'], p['boxes']
+    mrz_box = max(boxes, key=lambda b: b.width)
+    # The MRZ is found first (in the bottom strip) and has the best score among the prior boxes
+    assert prior_boxes[0].approx_equal(mrz_box.center, mrz_box.width, mrz_box.height, mrz_box.angle, tol=2)
+    scores = p['prior_box_scores']
+    assert len(scores) == len(prior_boxes) and scores[0] == max(scores)
+
+
+def test_deskew(monkeypatch):
+    img = (imread('./tests/data/passport-td3.png') * 1.0)[..., :3].mean(axis=2)
+    rotated = transform.rotate(img, 7, resize=True, preserve_range=True, cval=255).astype(np.uint8)
+    # The image is never rotated as a whole
+    monkeypatch.setattr(transform, 'rotate', None)
+    p = MRZPipeline(rotated, deskew=True)
+    i = int(np.argmax(p['box_scores']))
+    mrz_box, snapped = p['boxes'][i], p['boxes_straight'][i]
+    # The MRZ box gets the (upright) angle of the document, estimated about as precisely as the angle of the MRZ itself
+    assert abs(snapped.angle - np.deg2rad(97)) < 0.003
+
+    def line_sharpness(box):
+        # The ink density of the densest row of the region: lower when the text lines run across the rows
+        return (box.extract_from_image(p['img'], 1.0 / p['scale_factor']) < 0.5).mean(1).max()
+    # A box whose own angle is imprecise is extracted at the angle of the document
+    ragged = RotatedBox(mrz_box.center, mrz_box.width, mrz_box.height, mrz_box.angle + 0.015)
+    fixed = image.Deskewer()([ragged], p['skew'])[0]
+    assert fixed.angle == snapped.angle
+    assert line_sharpness(ragged) < 0.9 * line_sharpness(mrz_box) < 0.9 * line_sharpness(fixed)
+
+    # A straight document: the regions of the boxes are slices of the image
+    p = MRZPipeline('./tests/data/passport-td3.png', deskew=True)
+    mrz_box = max(p['boxes_straight'], key=lambda b: b.width)
+    assert mrz_box.angle == np.pi / 2 and mrz_box.extract_from_image(p['img'], 1.0 / p['scale_factor']).base is not None
+
+    # With prior regions, the prior boxes are snapped to their own skew estimate, the whole image is not even searched
+    td3 = 'P<UTOERIKSSON<<ANNA<MARIA<<<<<<<<<<<<<<<<<<<\nL898902C36UTO7408122F1204159ZE184226B<<<<<10'
+    monkeypatch.setattr(image, 'ocr', lambda roi, **kwargs: td3)
+    p = MRZPipeline(rotated, prior_region=0.4, deskew=True)
+    assert p.result.valid and abs(p['prior_boxes_straight'][0].angle - np.deg2rad(97)) < 0.003
+    assert 'boxes' not in p.data
+
+
+def _multi_document_page():
+    docs = [imread(fn)[..., :3].mean(axis=2) for fn in ['./tests/data/passport-td3.png', './tests/data/passport-td2.jpg']]
+    h, w = max(d.shape[0] for d in docs), max(d.shape[1] for d in docs)
+    page = np.full((2 * h + 150, 2 * w + 150), 255, dtype=np.uint8)
+    origins = []
+    for k, d in enumerate([docs[0], docs[1], docs[1], docs[0]]):
+        r, c = 50 + (k // 2) * (h + 50), 50 + (k % 2) * (w + 50)
+        page[r:r + d.shape[0], c:c + d.shape[1]] = d
+        origins.append((r, c, d.shape))
+    f = io.BytesIO()
+    imwrite(f, page, format='png')
+    f.seek(0)
+    return f, origins
+
+
+def test_tiled_boxes():
+    f, origins = _multi_document_page()
+    boxes = MultiMRZPipeline(f)['tiled_boxes']
+    # The MRZ of each document is found: a wide horizontal box in the lower part of the document
+    for r, c, shape in origins:
+        inside = [b for b in boxes if b.angle == np.pi / 2 and r < b.cx < r + shape[0] and c < b.cy < c + shape[1]]
+        mrz_box = max(inside, key=lambda b: b.width)
+        assert mrz_box.width > 0.7 * shape[1] and mrz_box.cx > r + 0.7 * shape[0]
+
+
+def test_read_all_mrz(monkeypatch):
+    td3 = lambda name: ('P<UTOERIKSSON<<' + name).ljust(44, '<') + '\nL898902C36UTO7408122F1204159ZE184226B<<<<<10'
+    td2 = lambda name: ('I<UTOERIKSSON<<' + name).ljust(36, '<') + '\nD231458907UTO7408122F1204159<<<<<<<6'
+    texts = [td3('ANNA'), td2('BRITA'), td2('CARIN'), td3('DORIS')]
+    f, origins = _multi_document_page()
+
+    def document(box):
+        return next((k for k, (r, c, shape) in enumerate(origins) if r < box.cx < r + shape[0] and c < box.cy < c + shape[1]), None)
+
+    # The fake OCR reads the MRZ of the document containing the box (if the box looks like an MRZ) and nothing otherwise
+    boxes_of_rois, calls = {}, []
+    extract_from_image = RotatedBox.extract_from_image
+
+    def extract(box, *args, **kwargs):
+        roi = extract_from_image(box, *args, **kwargs)
+        boxes_of_rois[id(roi)] = box
+        return roi
+
+    def fake_ocr(roi, **kwargs):
+        box = boxes_of_rois[id(roi)]
+        calls.append(box)
+        k = document(box)
+        if k is None or box.angle != np.pi / 2 or box.width < 0.7 * origins[k][2][1]:
+            return ''
+        return texts[k]
+
+    monkeypatch.setattr(RotatedBox, 'extract_from_image', extract)
+    monkeypatch.setattr(image, 'ocr', fake_ocr)
+    mrzs = read_all_mrz(f)
+    # Every box is OCR-ed, identical readings (of overlapping boxes) are reported once
+    assert len(calls) == len(MultiMRZPipeline(_multi_document_page()[0])['tiled_boxes'])
+    # One MRZ per document, in the reading order, each with its box inside the document
+    assert [mrz.names for mrz in mrzs] == ['ANNA', 'BRITA', 'CARIN', 'DORIS']
+    assert [mrz.mrz_type for mrz in mrzs] == ['TD3', 'TD2', 'TD2', 'TD3'] and all(mrz.valid for mrz in mrzs)
+    assert [document(mrz.aux['box']) for mrz in mrzs] == [0, 1, 2, 3]
+    assert all(isinstance(mrz.aux['box'], RotatedBox) and 'roi' not in mrz.aux for mrz in mrzs)
+
+
+def test_locate_mrz():
+    frame = imread('./tests/data/passport-td3.jpg')
+    p = MRZPipeline('./tests/data/passport-td3.jpg')
+    expected = max(p['boxes'], key=lambda b: b.width).scaled(1.0 / p['scale_factor'])
+    mrz_box = max(locate_mrz(frame), key=lambda b: b.width)
+    # Up to a couple of pixels of the downscaled image (the scaling methods differ slightly)
+    assert mrz_box.approx_equal(expected.center, expected.width, expected.height, expected.angle, tol=2 / p['scale_factor'])
+
+
+@pytest.mark.skipif(not os.environ.get('PASSPORTEYE_BENCHMARK'), reason='Set PASSPORTEYE_BENCHMARK=1 to run the benchmarks')
+def test_benchmark_locate_mrz():
+    """The latency target of locate_mrz for live framing: the median time per frame must be under 0.2s.
+    Run with `PASSPORTEYE_BENCHMARK=1 python -m pytest -s -k benchmark tests/mrz_test.py`."""
+    frame = imread('./tests/data/passport-td3.jpg')
+    locate_mrz(frame)
+    times = []
+    for _ in range(10):
+        start = time.perf_counter()
+        locate_mrz(frame)
+        times.append(time.perf_counter() - start)
+    print('\nlocate_mrz: %0.1f ms per frame' % (sorted(times)[len(times) // 2] * 1e3))
+    assert sorted(times)[len(times) // 2] < 0.2
+
+
+def test_stream_reader(monkeypatch):
+    # A "video" of a slightly moving document, every third frame out of focus
+    doc = transform.rescale(imread('./tests/data/passport-td3.jpg')[..., :3].mean(axis=2) / 255, 0.6)
+    frames = []
+    for k in range(12):
+        frame = np.ones((doc.shape[0] + 80, doc.shape[1] + 80))
+        r, c = 40 + int(10 * np.sin(k)), 40 + int(10 * np.cos(k))
+        frame[r:r + doc.shape[0], c:c + doc.shape[1]] = doc
+        if k % 3 == 1:
+            frame = filters.gaussian(frame, 4)
+        frames.append((frame * 255).astype(np.uint8))
+
+    # Each OCR reading gets three characters of the second line wrong
+    td3 = ['P<UTOERIKSSON<<ANNA<MARIA<<<<<<<<<<<<<<<<<<<', 'L898902C36UTO7408122F1204159ZE184226B<<<<<10']
+    rnd = random.Random(1)
+    ocr_frames = []
+
+    def fake_ocr(roi, **kwargs):
+        ocr_frames.append(reader.frames)
+        lines = [list(ln) for ln in td3]
+        for _ in range(3):
+            lines[1][rnd.randrange(28)] = rnd.choice('0123456789ABC<')
+        return '\n'.join(''.join(ln) for ln in lines)
+
+    monkeypatch.setattr(image, 'ocr', fake_ocr)
+    reader = MRZStreamReader()
+    mrz = reader.read(frames)
+    assert mrz.valid and mrz.number == 'L898902C3' and mrz.aux['method'] == 'vote(%d)' % len(ocr_frames)
+    # The box is tracked from the first frame on, blurry frames are not OCR-ed, reading stops as soon as the MRZ is valid
+    assert mrz.aux['box'].angle == np.pi / 2 and mrz.aux['box'].width > 0.5 * doc.shape[1]
+    assert reader.frames < len(frames) and all(k % 3 != 2 for k in ocr_frames)
+
+
+def test_box_to_mrz_consensus(monkeypatch):
+    # The direct and the rescaled readings each get a different digit of the date of birth wrong
+    readings = iter(['P<UTOERIKSSON<<ANNA<MARIA<<<<<<<<<<<<<<<<<<<\nL898902C36UTO7409122F1204159ZE184226B<<<<<10',
+                     'P<UTOERIKSSON<<ANNA<MARIA<<<<<<<<<<<<<<<<<<<\nL898902C36UTO7408152F1204159ZE184226B<<<<<10'])
+    monkeypatch.setattr(image, 'ocr', lambda roi, **kwargs: next(readings))
+    img = np.random.RandomState(0).rand(40, 100)
+    roi, text, mrz = image.BoxToMRZ()(RotatedBox([20, 50], 80, 20, np.pi / 2), img, img, 1.0)
+    assert mrz.valid and mrz.date_of_birth == '740812' and mrz.aux['method'] == 'consensus(direct,rescaled(3))'
+    assert text.split('\n')[1] == 'L898902C36UTO7408122F1204159ZE184226B<<<<<10'
+
+
+def test_decoded_image_input():
+    fn = './tests/data/passport-td3.png'
+    expected = MRZPipeline(fn)['boxes']
+    rgb = imread(fn)
+    for img in [rgb, rgb[..., :3]]:
+        boxes = MRZPipeline(img)['boxes']
+        assert [b.center.tolist() for b in boxes] == [b.center.tolist() for b in expected]
+    # Grayscale arrays are used as is
+    gray = MRZPipeline(fn)['img']
+    assert MRZPipeline(gray)['img'] is gray
+
+    pil_image = pytest.importorskip('PIL.Image')
+    boxes = MRZPipeline(pil_image.open(fn))['boxes']
+    assert [b.center.tolist() for b in boxes] == [b.center.tolist() for b in expected]
+
+    # Integer arrays of any dtype and floats in 0..255 are rescaled to [0, 1]
+    gray8 = rgb[..., :3].mean(axis=2).astype(np.uint8)
+    expected = MRZPipeline(gray8)['boxes']
+    for img in [gray8.astype(np.int32), gray8.astype(np.int64), gray8 * 1.0, gray8.astype(np.uint16) * 257,
+                pil_image.fromarray(gray8).convert('I'), pil_image.fromarray(gray8).convert('F')]:
+        p = MRZPipeline(img)
+        assert p.rejection_reason is None
+        assert [b.center.tolist() for b in p['boxes']] == [b.center.tolist() for b in expected]
+
+
+def test_buffer_input(tmp_path):
+    fn = './tests/data/passport-td3.jpg'
+    expected = MRZPipeline(fn)['img']
+    with open(fn, 'rb') as f:
+        data = f.read()
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    for buf in [mapped, bytearray(data), memoryview(data)]:
+        assert np.array_equal(MRZPipeline(buf)['img'], expected)
+
+    # Uncompressed TIFF pages are not even copied, only the first page is read
+    tifffile = pytest.importorskip('tifffile')
+    gray = (expected * 255).astype(np.uint8)
+    tif = str(tmp_path / 'scan.tif')
+    tifffile.imwrite(tif, gray)
+    tifffile.imwrite(tif, gray[::2, ::2], append=True)
+    img = MRZPipeline(tif)['img']
+    assert np.array_equal(img, gray) and not img.flags.owndata and not img.flags.writeable
+    with open(tif, 'rb') as f:
+        assert np.array_equal(MRZPipeline(f.read())['img'], gray)
+
+
+def test_multi_page_tiff(tmp_path, monkeypatch):
+    # The passport page is in the middle of a scanner drop: pages are read one by one until a valid MRZ is found
+    tifffile = pytest.importorskip('tifffile')
+    td3 = 'P<UTOERIKSSON<<ANNA<MARIA<<<<<<<<<<<<<<<<<<<\nL898902C36UTO7408122F1204159ZE184226B<<<<<10'
+    monkeypatch.setattr(image, 'ocr', lambda roi, **kwargs: td3)
+    passport = (imread('./tests/data/passport-td3.png')[..., :3].mean(axis=2)).astype(np.uint8)
+    blank = np.full_like(passport, 128)
+    tif = str(tmp_path / 'drop.tif')
+    for k, page in enumerate([blank, blank, passport, blank]):
+        tifffile.imwrite(tif, page, append=k > 0, compression='zlib' if k % 2 else None)
+    images = list(image.Loader(tif).iter_images())
+    assert [page for page, _ in images] == [0, 1, 2, 3] and np.array_equal(images[2][1], passport)
+
+    pages = []
+    iter_images = image.Loader.iter_images
+    monkeypatch.setattr(image.Loader, 'iter_images', lambda self: (pages.append(page) or (page, img) for page, img in iter_images(self)))
+    with open(tif, 'rb') as f:
+        data = f.read()
+    for file in [tif, data]:
+        del pages[:]
+        mrz = read_mrz(file)
+        assert mrz.valid and mrz.aux['page'] == 2
+        assert pages == [0, 1, 2]
+    # The rejection reason is reported when none of the pages passed the quality check
+    assert read_mrz(tif, return_reason=True)[1] is None
+    blanks = str(tmp_path / 'blanks.tif')
+    for k in range(2):
+        tifffile.imwrite(blanks, blank, append=k > 0)
+    assert read_mrz(blanks, return_reason=True) == (None, 'blank')
+    # Pages fanned out to workers: the result is the same, at most max_workers pages are ahead of the one being checked
+    del pages[:]
+    mrz = read_mrz(tif, max_workers=2)
+    assert mrz.valid and mrz.aux['page'] == 2 and pages == [0, 1, 2, 3]
+
+
+def test_release_mode(monkeypatch):
+    td3 = 'P<UTOERIKSSON<<ANNA<MARIA<<<<<<<<<<<<<<<<<<<\nL898902C36UTO7408122F1204159ZE184226B<<<<<1X'
+    monkeypatch.setattr(image, 'ocr', lambda roi, **kwargs: td3)
+    for kwargs in [{}, {'prior_region': 0.4}, {'deskew': True}]:
+        expected = MRZPipeline('./tests/data/passport-td3.png', **kwargs)
+        expected.components['mrz'].debug = True
+        p = MRZPipeline('./tests/data/passport-td3.png', **kwargs)
+        p.retain(['mrz_final'])
+        assert p.result.to_dict() == expected.result.to_dict()
+        # No intermediate images are kept (values only requested by components at run time, e.g. the fallback
+        # boxes of the prior region search, are not released), the debug information is only collected on request
+        assert not {'img', 'img_small', 'img_binary', 'img_straight', 'roi'} & set(p.data) and '__debug__mrz' not in p.data
+        assert kwargs or [k for k in p.data if not k.startswith('__')] == ['mrz_final']
+        assert len(expected.data['__debug__mrz']) > 0
+        # Released values are recomputed when needed
+        assert np.array_equal(p['img'], expected['img'])
+        p.replace_component('scaler', image.Scaler(1000))
+        assert p['img_small'].shape[1] == 1000 and 'mrz_final' not in p.data
+    mrz = read_mrz('./tests/data/passport-td3.png', save_roi=True)
+    assert mrz.aux['roi'].shape == expected['roi'].shape
+
+
+def test_mrz_reader():
+    td3 = 'P<UTOERIKSSON<<ANNA<MARIA<<<<<<<<<<<<<<<<<<<\nL898902C36UTO7408122F1204159ZE184226B<<<<<10'
+    calls = []
+    reader = MRZReader(ocr=lambda roi, extra_cmdline_params='': calls.append(roi.shape) or td3, max_width=300)
+    template = dict(reader.template.components)
+    files = ['./tests/data/passport-td3.jpg', './tests/data/passport-td3.png', './tests/data/passport-td2.jpg'] * 2
+    with ThreadPoolExecutor(3) as ex:
+        mrzs = list(ex.map(reader.read, files))
+    assert all(mrz.valid and mrz.number == 'L898902C3' for mrz in mrzs) and len(calls) == len(files)
+    # Every input is processed by its own copy of the pipeline, the template itself is never run nor changed
+    assert reader.template.components == template and reader.template.timeline == []
+    p = reader.pipeline(files[0])
+    assert p.components['scaler'].max_width == 300 and p.components['boone'] is template['boone']
+
+
+def test_read_mrz_many(monkeypatch):
+    td3 = 'P<UTOERIKSSON<<ANNA<MARIA<<<<<<<<<<<<<<<<<<<\nL898902C36UTO7408122F1204159ZE184226B<<<<<10'
+    monkeypatch.setattr(image, 'ocr', lambda roi, **kwargs: time.sleep(random.random() * 0.01) or td3)
+    files = ['./tests/data/passport-td3.jpg', './tests/data/passport-td3.png', np.full((400, 600), 255, np.uint8),
+             './tests/data/passport-td2.jpg'] * 3
+    expected = [read_mrz(f) for f in files]
+    for threads in [1, 4]:
+        results = list(image.read_mrz_many(files, threads=threads))
+        assert [f for f, _ in results] == files
+        assert [mrz and mrz.to_dict() for _, mrz in results] == [mrz and mrz.to_dict() for mrz in expected]
+    results = list(image.read_mrz_many(iter(files), threads=4, ordered=False))
+    assert sorted(id(f) for f, _ in results) == sorted(id(f) for f in files)
+    assert sum(mrz is None for _, mrz in results) == 3 and all(mrz.valid for _, mrz in results if mrz is not None)
+
+
+FAKE_TESSERACT = """#!%s
+import os, sys, time
+assert sys.argv[1:3] == ['stdin', 'stdout'] and sys.stdin.buffer.read(2) == b'BM'
+log = os.environ['FAKE_TESSERACT_LOG']
+with open(log, 'a') as f:
+    f.write('start %%d\\n' %% os.getpid())
+time.sleep(float(os.environ['FAKE_TESSERACT_DELAY']))
+with open(log, 'a') as f:
+    f.write('end %%d\\n' %% os.getpid())
+print('P<UTOERIKSSON<<ANNA<MARIA<<<<<<<<<<<<<<<<<<<')
+print('L898902C36UTO7408122F1204159ZE184226B<<<<<10')
+"""
+
+
+def test_read_mrz_async(tmp_path, monkeypatch):
+    tesseract, log = tmp_path / 'tesseract', tmp_path / 'log'
+    tesseract.write_text(FAKE_TESSERACT % sys.executable)
+    tesseract.chmod(0o755)
+    monkeypatch.setattr(pytesseract, 'tesseract_cmd', str(tesseract))
+    monkeypatch.setenv('FAKE_TESSERACT_LOG', str(log))
+    monkeypatch.setenv('FAKE_TESSERACT_DELAY', '0.1')
+    files = ['./tests/data/passport-td3.jpg', './tests/data/passport-td3.png', './tests/data/passport-td2.jpg']
+
+    async def read_all():
+        semaphore = asyncio.Semaphore(1)
+        with ThreadPoolExecutor(3) as executor:
+            return await asyncio.gather(*[image.read_mrz_async(f, executor=executor, semaphore=semaphore) for f in files])
+    mrzs = asyncio.run(read_all())
+    assert all(mrz.valid and mrz.number == 'L898902C3' for mrz in mrzs)
+    # With the semaphore, the Tesseract processes ran one at a time
+    events = [line.split()[0] for line in log.read_text().splitlines()]
+    assert events == ['start', 'end'] * len(files)
+
+    # Cancelling the task kills the running Tesseract process
+    log.unlink()
+    monkeypatch.setenv('FAKE_TESSERACT_DELAY', '60')
+
+    async def read_and_cancel():
+        task = asyncio.ensure_future(image.read_mrz_async(files[0]))
+        for _ in range(200):
+            if log.exists():
+                break
+            await asyncio.sleep(0.05)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        await asyncio.sleep(0.1)
+    start = time.time()
+    asyncio.run(read_and_cancel())
+    assert time.time() - start < 30
+    started = log.read_text().split()
+    assert started[0] == 'start' and 'end' not in started
+    with pytest.raises(ProcessLookupError):
+        os.kill(int(started[1]), 0)
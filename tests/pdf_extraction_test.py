@@ -7,7 +7,10 @@ Author: Konstantin Tretyakov
 License: MIT
 '''
 from pkg_resources import resource_filename
-from passporteye.util.pdf import extract_first_jpeg_in_pdf
+from imageio.v2 import imread
+from passporteye.util.pdf import extract_first_jpeg_in_pdf, iter_pdf_images
+from passporteye.mrz import image
+from passporteye.mrz.text import MRZ
 import sys
 
 # Smoke test for "extract_first_jpeg_in_pdf"
@@ -18,4 +21,38 @@ def test_extract_jpeg():
                           ('pdf-with-none.pdf',False)]:
         with open(resource_filename('tests', 'data/%s' % fn), 'rb') as f:
             img = extract_first_jpeg_in_pdf(f)
-            assert (len(img) == 5805 or len(img) == 5804) if has_image else (img is None)
\ No newline at end of file
+            assert (len(img) == 5805 or len(img) == 5804) if has_image else (img is None)
+
+
+def test_iter_pdf_images():
+    pacman = imread(resource_filename('tests', 'data/pacman.png'))
+    for fn, n_images in [('pdf-with-jpg.pdf', 1), ('pdf-with-png.pdf', 1), ('pdf-with-pngjpg.pdf', 2), ('pdf-with-none.pdf', 0)]:
+        with open(resource_filename('tests', 'data/%s' % fn), 'rb') as f:
+            images = list(iter_pdf_images(f))
+        assert len(images) == n_images
+        assert all(page == 0 and img.shape[:2] == pacman.shape[:2] for page, img in images)
+    with open(resource_filename('tests', 'data/pdf-with-png.pdf'), 'rb') as f:
+        (_, img), = iter_pdf_images(f)
+        assert (img == pacman[..., :img.shape[2]]).all()
+
+
+def test_read_mrz_pages(monkeypatch):
+    # read_mrz tries the images of a PDF one by one and stops at the first valid MRZ
+    lines = {True: ['IDAUT10000999<6<<<<<<<<<<<<<<<', '7109094F1112315AUT<<<<<<<<<<<4', 'MUSTERFRAU<<ISOLDE<<<<<<<<<<<<'],
+             False: ['IDAUT10000999<6<<<<<<<<<<<<<<<', '7109094F1112315AUT<<<<<<<<<<<6', 'MUSTERFRAU<<ISOLDE<<<<<<<<<<<<']}
+    for valid_on, n_runs in [([True, True], 1), ([False, True], 2), ([False, False], 2)]:
+        runs = []
+
+        class FakePipeline(object):
+            rejection_reason = None
+
+            def __init__(self, img):
+                runs.append(img)
+                self.result = MRZ(lines[valid_on[len(runs) - 1]])
+
+            def retain(self, keys):
+                pass
+        monkeypatch.setattr(image.MRZReader, 'pipeline', lambda self, img: FakePipeline(img))
+        mrz = image.read_mrz(resource_filename('tests', 'data/pdf-with-pngjpg.pdf'))
+        assert mrz.valid == valid_on[-1] and mrz.aux['page'] == 0
+        assert len(runs) == n_runs and all(img.ndim == 2 for img in runs)
@@ -0,0 +1,166 @@
+'''
+Test module for use with py.test.
+Write each test as a function named test_<something>.
+Read more here: http://pytest.org/
+
+Author: Konstantin Tretyakov
+License: MIT
+'''
+import io
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pytest
+from passporteye.mrz import image
+from passporteye import read_mrz
+from passporteye.mrz.image import MRZPipeline, MultiMRZPipeline
+from passporteye.util.cache import StageCache
+from passporteye.util.pipeline import Pipeline
+from passporteye.util.profiling import ChromeTrace, Hook
+
+
+def _sleep_pipeline():
+    p = Pipeline()
+    p.add_component('a', lambda: time.sleep(0.2) or 1, ['a'], [])
+    p.add_component('b', lambda: time.sleep(0.2) or 2, ['b'], [])
+    p.add_component('sum', lambda a, b: a + b, ['c'], ['a', 'b'])
+    p.add_component('check', lambda c, pipeline: pipeline['a'] + c, ['d'], ['c', '__pipeline__'])
+    p.add_component('e', lambda: time.sleep(0.2) or 5, ['e'], [])
+    return p
+
+
+def test_compute_concurrently():
+    p = _sleep_pipeline()
+    with ThreadPoolExecutor(4) as ex:
+        assert p.compute(['d', 'e', 'c'], ex) == {'d': 4, 'e': 5, 'c': 3}
+    spans = {name: (start, end) for name, start, end, worker in p.timeline}
+    assert sorted(spans) == ['a', 'b', 'check', 'e', 'sum']
+    # The independent components overlap, the one using __pipeline__ runs alone
+    assert max(end for _, end in spans.values()) - min(start for start, _ in spans.values()) < 0.5
+    assert all(end <= spans['check'][0] for name, (_, end) in spans.items() if name != 'check')
+
+    # Sequential evaluation gives the same results
+    p = _sleep_pipeline()
+    assert p.compute(['d', 'e', 'c']) == {'d': 4, 'e': 5, 'c': 3}
+    assert len(set(worker for _, _, _, worker in p.timeline)) == 1
+
+    # Errors are propagated once the running components are done
+    p.add_component('fail', lambda a: 1 / 0, ['f'], ['a'])
+    with ThreadPoolExecutor(4) as ex, pytest.raises(ZeroDivisionError):
+        p.compute(['f'], ex)
+
+
+def test_mrz_pipeline_compute(monkeypatch):
+    td3 = 'P<UTOERIKSSON<<ANNA<MARIA<<<<<<<<<<<<<<<<<<<\nL898902C36UTO7408122F1204159ZE184226B<<<<<1X'
+    monkeypatch.setattr(image, 'ocr', lambda roi, **kwargs: td3)
+    expected = MRZPipeline('./tests/data/passport-td3.jpg', prior_region=0.4)
+    with ThreadPoolExecutor(4) as ex:
+        p = MRZPipeline('./tests/data/passport-td3.jpg', prior_region=0.4)
+        result = p.compute(['mrz_final', 'rois'], ex)
+    assert result['mrz_final'].to_dict() == expected.result.to_dict()
+    assert [r.shape for r in result['rois']] == [r.shape for r in expected['rois']]
+
+
+def test_profiling_hooks(monkeypatch, tmp_path):
+    td3 = 'P<UTOERIKSSON<<ANNA<MARIA<<<<<<<<<<<<<<<<<<<\nL898902C36UTO7408122F1204159ZE184226B<<<<<10'
+    monkeypatch.setattr(image, 'ocr', lambda roi, **kwargs: td3)
+    mrz = read_mrz('./tests/data/passport-td3.jpg', timings=True)
+    assert {'loader', 'scaler', 'boone', 'box_locator', 'mrz', 'extract_roi', 'ocr'} <= set(mrz.aux['timings'])
+    assert mrz.aux['timings']['ocr']['calls'] == 1 and all(t['seconds'] >= 0 for t in mrz.aux['timings'].values())
+    assert 'timings' not in read_mrz('./tests/data/passport-td3.jpg').aux
+
+    events = []
+    hook = Hook()
+    hook.trace_memory = True
+    hook.after = events.append
+    trace = ChromeTrace()
+    with ThreadPoolExecutor(4) as ex:
+        p = MultiMRZPipeline('./tests/data/passport-td3.jpg')
+        p.add_hook(hook)
+        p.add_hook(trace)
+        p.compute(['all_mrz'], ex)
+    loader = [e for e in events if e['name'] == 'loader'][0]
+    assert loader['kind'] == 'component' and loader['allocated'] > 0 and loader['duration'] > 0
+    # The OCR calls made in the worker threads of FindAllValidMRZ are reported too
+    ocr_calls = [e for e in events if e['kind'] == 'ocr']
+    assert len(ocr_calls) == len(p['tiled_boxes']) and all(len(e['shapes'][0]) == 2 for e in ocr_calls)
+    fn = str(tmp_path / 'trace.json')
+    trace.save(fn)
+    with open(fn) as f:
+        assert len(json.load(f)['traceEvents']) == len(events)
+
+
+def test_stage_cache(monkeypatch, tmp_path):
+    td3 = 'P<UTOERIKSSON<<ANNA<MARIA<<<<<<<<<<<<<<<<<<<\nL898902C36UTO7408122F1204159ZE184226B<<<<<1X'
+    monkeypatch.setattr(image, 'ocr', lambda roi, **kwargs: td3)
+    cache = StageCache(str(tmp_path / 'cache'))
+    expected = MRZPipeline('./tests/data/passport-td3.jpg')
+    first = MRZPipeline('./tests/data/passport-td3.jpg', cache=cache)
+    assert first.result.to_dict() == expected.result.to_dict()
+    assert {'loader', 'scaler', 'boone', 'box_locator', 'mrz'} <= set(name for name, _, _, _ in first.timeline)
+
+    # Different OCR settings: everything up to the OCR comes from the cache (keyed by the contents of the file)
+    with open('./tests/data/passport-td3.jpg', 'rb') as f:
+        p = MRZPipeline(f.read(), extra_cmdline_params='--oem 0', cache=cache)
+    assert p.result.to_dict() == expected.result.to_dict()
+    assert [name for name, _, _, _ in p.timeline] == ['mrz', 'other_max_width']
+    assert np.array_equal(p['img'], expected['img']) and not p['img'].flags.writeable
+    # ... also with the concurrent scheduler
+    with ThreadPoolExecutor(2) as ex:
+        p = MRZPipeline('./tests/data/passport-td3.jpg', cache=cache)
+        p.compute(['mrz_final', 'rois'], ex)
+    assert sorted(name for name, _, _, _ in p.timeline) == ['extractor', 'mrz', 'other_max_width']
+
+    # Changing a component's parameters or the pipeline version invalidates it and everything after it
+    p = MRZPipeline('./tests/data/passport-td3.jpg', cache=cache)
+    p.replace_component('boone', image.BooneTransform(square_size=7))
+    p.result
+    assert 'loader' not in [name for name, _, _, _ in p.timeline] and 'box_locator' in [name for name, _, _, _ in p.timeline]
+    p = MRZPipeline('./tests/data/passport-td3.jpg', cache=cache)
+    p.version = '2.0'
+    p.result
+    assert 'loader' in [name for name, _, _, _ in p.timeline]
+
+    # Size-bounded
+    cache.max_bytes = 0
+    cache.evict()
+    assert cache.get(p.cache_key('loader'), ['img'], '2.0') is None
+
+
+def test_stage_cache_streams(tmp_path):
+    cache = StageCache(str(tmp_path / 'cache'))
+    with open('./tests/data/passport-td3.png', 'rb') as f:
+        data = f.read()
+    expected = [b.center.tolist() for b in MRZPipeline(data)['boxes']]
+
+    # Streams which can not be read twice (pipes, sockets) are processed without caching
+    r, w = os.pipe()
+    writer = threading.Thread(target=lambda: open(w, 'wb').write(data))
+    writer.start()
+    with open(r, 'rb') as f:
+        assert [b.center.tolist() for b in MRZPipeline(f, cache=cache)['boxes']] == expected
+    writer.join()
+    assert os.listdir(cache.directory) == []
+
+    # Seekable streams are hashed, then returned to their position
+    f = io.BytesIO(data)
+    p = MRZPipeline(f, cache=cache)
+    assert p.cache_key('loader') == MRZPipeline(data, cache=cache).cache_key('loader') and f.tell() == 0
+    assert [b.center.tolist() for b in p['boxes']] == expected and os.listdir(cache.directory) != []
+
+
+def test_stage_cache_eviction(monkeypatch, tmp_path):
+    # The cache is only scanned on the first put and when evicting, not on every put
+    cache = StageCache(str(tmp_path / 'cache'), max_bytes=100 * 1000)
+    scans = []
+    entries = StageCache._entries
+    monkeypatch.setattr(StageCache, '_entries', lambda self: scans.append(1) or entries(self))
+    for i in range(200):
+        cache.put('k%d' % i, {'x': np.zeros(1000, dtype=np.uint8)})
+    assert len(scans) < 30  # Rather than 200
+    total = sum(size for _, size, _ in entries(cache))
+    assert 0.8 * cache.max_bytes < total <= cache.max_bytes == 100 * 1000
+    assert cache.get('k199', ['x']) is not None and cache.get('k0', ['x']) is None
@@ -0,0 +1,97 @@
+'''
+Test module for use with py.test.
+Write each test as a function named test_<something>.
+Read more here: http://pytest.org/
+
+Author: Konstantin Tretyakov
+License: MIT
+'''
+import csv
+import json
+import numpy as np
+import pytest
+from imageio import imread, imwrite
+from passporteye.mrz import image
+from passporteye.mrz.scripts import evaluate_mrz, mrz_parse, process_file
+from passporteye.mrz.text import MRZ
+
+MRZS = [
+    ['IDAUT10000999<6<<<<<<<<<<<<<<<', '7109094F1112315AUT<<<<<<<<<<<4', 'MUSTERFRAU<<ISOLDE<<<<<<<<<<<<'],
+    ['P<UTOERIKSSON<<ANNA<MARIA<<<<<<<<<<<<<<<<<<<', 'L898902C36UTO7408122F1204159ZE184226B<<<<<10'],
+    ['I<UTOERIKSSON<<ANNA<MARIA<<<<<<<<<<<', 'D231458907UTO7408122F1204159<<<<<<<5'],
+    ['not an MRZ'],
+] * 5
+
+
+def test_mrz_parse(tmp_path, capsys):
+    text = tmp_path / 'mrz.txt'
+    text.write_text(''.join('\n'.join(lines) + '\n\n' for lines in MRZS))
+    expected = [dict(MRZ(lines).to_dict(), record=i, raw_text='\n'.join(lines)) for i, lines in enumerate(MRZS)]
+
+    mrz_parse([str(text)])
+    out, err = capsys.readouterr()
+    assert [json.loads(line) for line in out.splitlines()] == expected
+    assert err.startswith('Parsed 20 MRZs (10 valid, 0 malformed) in') and err.endswith('records/s\n')
+
+    # In parallel, in chunks, from a JSONL file (the results are in the input order)
+    jsonl = tmp_path / 'mrz.jsonl'
+    jsonl.write_text(''.join(json.dumps({'id': i, 'text': '\n'.join(lines)}) + '\n' for i, lines in enumerate(MRZS)))
+    mrz_parse(['-i', 'jsonl', '--field', 'text', '-j', '2', '-c', '3', str(jsonl)])
+    assert [json.loads(line) for line in capsys.readouterr()[0].splitlines()] == expected
+
+    # CSV output, with OCR cleanup
+    output = tmp_path / 'out.csv'
+    text.write_text('\n\n'.join(['IDAUT10000999<6<<<<<<<<<<<<<<<\n7IO9O94FIi iz3iSAUT<<<<<<<<<<<4\nMUSTERFRAU<<ISOLDE<<<<<<<<<<<<'] * 2))
+    mrz_parse(['--cleanup', '-f', 'csv', '-o', str(output), str(text)])
+    with open(output, newline='') as f:
+        rows = list(csv.DictReader(f))
+    assert [(r['record'], r['mrz_type'], r['valid_score'], r['names'], r['personal_number']) for r in rows] == \
+           [('0', 'TD1', '100', 'ISOLDE', ''), ('1', 'TD1', '100', 'ISOLDE', '')]
+
+
+
+def test_mrz_parse_malformed(tmp_path, capsys):
+    # A malformed record gets valid_score 0 and an error, and the run goes on
+    jsonl = tmp_path / 'mrz.jsonl'
+    jsonl.write_text('\n'.join([json.dumps({'mrz': MRZS[0]}), '{"mrz": 5}', '{"id": 2}', '{"mrz"',
+                                 json.dumps({'mrz': '\n'.join(MRZS[1])})]) + '\n')
+    mrz_parse(['-i', 'jsonl', '-c', '2', str(jsonl)])
+    out, err = capsys.readouterr()
+    records = [json.loads(line) for line in out.splitlines()]
+    assert [(r['record'], r['valid_score']) for r in records] == [(0, 100), (1, 0), (2, 0), (3, 0), (4, 100)]
+    assert [r.get('error', '').split(':')[0] for r in records] == ['', 'not an MRZ text', "missing field 'mrz'", 'invalid JSON', '']
+    assert err.startswith('Parsed 5 MRZs (2 valid, 3 malformed) in')
+
+    csvfile = tmp_path / 'mrz.csv'
+    csvfile.write_text('id,mrz\n0,"%s"\n1\n' % '\n'.join(MRZS[1]))
+    mrz_parse(['-i', 'csv', '-f', 'csv', str(csvfile)])
+    out, err = capsys.readouterr()
+    rows = list(csv.DictReader(out.splitlines()))
+    assert [(r['record'], r['valid_score'], r['error']) for r in rows] == [('0', '100', ''), ('1', '0', "missing field 'mrz'")]
+    assert err.startswith('Parsed 2 MRZs (1 valid, 1 malformed) in')
+
+
+def test_process_file(tmp_path, monkeypatch):
+    # The scripts read all the pages of a multi-page file, like read_mrz
+    tifffile = pytest.importorskip('tifffile')
+    td3 = 'P<UTOERIKSSON<<ANNA<MARIA<<<<<<<<<<<<<<<<<<<\nL898902C36UTO7408122F1204159ZE184226B<<<<<10'
+    monkeypatch.setattr(image, 'ocr', lambda roi, **kwargs: td3)
+    passport = imread('./tests/data/passport-td3.png')[..., :3].mean(axis=2).astype(np.uint8)
+    tif = str(tmp_path / 'scan.tif')
+    for k, page in enumerate([np.full_like(passport, 128), passport]):
+        tifffile.imwrite(tif, page, append=k > 0)
+    filename, mrz, walltime, rejection_reason = process_file((tif, True, '', 0.0))
+    assert filename == tif and mrz.valid and mrz.aux['page'] == 1 and rejection_reason is None
+    assert 'roi' in mrz.aux and 'timings' in mrz.aux and walltime > 0
+
+    blank = str(tmp_path / 'blank.png')
+    imwrite(blank, np.full((600, 800), 128, dtype=np.uint8))
+    filename, mrz, walltime, rejection_reason = process_file((blank, False, '', 0.0))
+    assert mrz is None and rejection_reason == 'blank'
+
+
+def test_evaluate_mrz_resume(monkeypatch, capsys):
+    monkeypatch.setattr('sys.argv', ['evaluate_mrz', '--resume'])
+    with pytest.raises(SystemExit):
+        evaluate_mrz()
+    assert '--resume requires --output' in capsys.readouterr().err
@@ -0,0 +1,86 @@
+'''
+Test module for use with py.test.
+Write each test as a function named test_<something>.
+Read more here: http://pytest.org/
+
+Author: Konstantin Tretyakov
+License: MIT
+'''
+import csv
+import json
+import sqlite3
+import pytest
+from passporteye.mrz.sinks import SINK_FIELDS, mrz_record, open_sink
+from passporteye.mrz.text import MRZ
+
+MRZS = [
+    MRZ(['IDAUT10000999<6<<<<<<<<<<<<<<<', '7109094F1112315AUT<<<<<<<<<<<4', 'MUSTERFRAU<<ISOLDE<<<<<<<<<<<<']),
+    MRZ.from_ocr('P<UTOERIKSSON<<ANNA<MARIA<<<<<<<<<<<<<<<<<<<\nL898902C36UTO7408122F1204159ZE184226B<<<<<10'),
+    MRZ(['VIUSATRAVELER<<HAPPYPERSON<<<<<<<<<<<<<<<<<<', '555123ABC6GBR6502056F04122361FLNDDDAM5803085']),
+    None,
+]
+MRZS[1].aux['method'] = 'direct'
+MRZS[1].aux['timings'] = {'ocr': {'calls': 1, 'seconds': 0.5}}
+
+
+def read_back(path, fmt):
+    """Reads the stored records back as lists of strings (None for empty values) in the SINK_FIELDS order."""
+    def as_str(v):
+        return None if v is None or v == '' else str(v)
+    if fmt == 'jsonl':
+        with open(path) as f:
+            return [[as_str(json.loads(line)[k]) for k in SINK_FIELDS] for line in f]
+    if fmt == 'csv':
+        with open(path, newline='') as f:
+            return [[as_str(row[k]) for k in SINK_FIELDS] for row in csv.DictReader(f)]
+    if fmt == 'sqlite':
+        with sqlite3.connect(path) as c:
+            return [[as_str(bool(v) if k.startswith('valid') and k != 'valid_score' and v is not None else v)
+                     for k, v in zip(SINK_FIELDS, row)] for row in c.execute('SELECT * FROM results')]
+    import pyarrow.dataset
+    return [[as_str(row[k]) for k in SINK_FIELDS] for row in pyarrow.dataset.dataset(path, format=fmt.replace('arrow', 'ipc')).to_table().to_pylist()]
+
+
+@pytest.mark.parametrize('fmt', ['jsonl', 'csv', 'sqlite', 'parquet', 'arrow'])
+def test_sinks(tmp_path, fmt):
+    if fmt in ['parquet', 'arrow']:
+        pytest.importorskip('pyarrow')
+    path = str(tmp_path / ('results.' + fmt))
+    with open_sink(path, buffer_size=3) as sink:
+        for i, mrz in enumerate(MRZS):
+            sink.write_mrz('%d.png' % i, mrz, walltime=0.25, rejection_reason=None if mrz else 'blank')
+        assert sink.done() == {'0.png', '1.png', '2.png'}  # The first batch
+    expected = [[None if v is None else str(v) for v in mrz_record('%d.png' % i, mrz, 0.25, None if mrz else 'blank').values()]
+                for i, mrz in enumerate(MRZS)]
+    assert read_back(path, fmt) == expected
+    assert expected[1][SINK_FIELDS.index('timings')] == '{"ocr": {"calls": 1, "seconds": 0.5}}'
+
+    # Resuming: the results are appended
+    with open_sink(path) as sink:
+        assert sink.done() == {'0.png', '1.png', '2.png', '3.png'}
+        sink.write_mrz('4.png', MRZS[0], walltime=0.25)
+    assert read_back(path, fmt) == expected + [['4.png'] + expected[0][1:]]
+
+
+@pytest.mark.parametrize('fmt', ['jsonl', 'csv'])
+def test_crash_recovery(tmp_path, fmt):
+    path = str(tmp_path / ('results.' + fmt))
+    with open_sink(path) as sink:
+        sink.write_mrz('0.png', MRZS[0])
+    committed = read_back(path, fmt)
+    # A batch which was being written when the process died
+    with open(path, 'a') as f:
+        f.write('{"filename": "1.png", "mrz_type": "TD' if fmt == 'jsonl' else '1.png,TD1,10')
+    with open_sink(path) as sink:
+        assert sink.done() == {'0.png'}
+        sink.write_mrz('2.png', MRZS[1])
+    assert [row[0] for row in read_back(path, fmt)] == ['0.png', '2.png']
+    assert read_back(path, fmt)[:1] == committed
+
+
+def test_open_sink(tmp_path):
+    with pytest.raises(ValueError):
+        open_sink(str(tmp_path / 'results.xls'))
+    sink = open_sink(str(tmp_path / 'results.db'))
+    assert type(sink).__name__ == 'SQLiteSink'
+    sink.close()
@@ -0,0 +1,114 @@
+'''
+Test module for use with py.test.
+Write each test as a function named test_<something>.
+Read more here: http://pytest.org/
+
+Author: Konstantin Tretyakov
+License: MIT
+'''
+import os
+import random
+import timeit
+from collections import OrderedDict
+from datetime import datetime
+import pytest
+from passporteye.mrz.text import MRZ, MRZ_FIELDS, MRZCheckDigit, MRZOCRCleaner, parse_batch
+
+VALID_MRZS = [
+    ['IDAUT10000999<6<<<<<<<<<<<<<<<', '7109094F1112315AUT<<<<<<<<<<<4', 'MUSTERFRAU<<ISOLDE<<<<<<<<<<<<'],
+    ['I<UTOERIKSSON<<ANNA<MARIA<<<<<<<<<<<', 'D231458907UTO7408122F1204159<<<<<<<6'],
+    ['VIUSATRAVELER<<HAPPYPERSON<<<<<<<<<<<<<<<<<<', '555123ABC6GBR6502056F04122361FLNDDDAM5803085'],
+    ['V<UTOERIKSSON<<ANNA<MARIA<<<<<<<<<<<', 'L8988901C4XXX4009078F9612109<<<<<<<<'],
+    ['P<POLKOWALSKA<KWIATKOWSKA<<JOANNA<<<<<<<<<<<', 'AA00000000POL6002084F1412314<<<<<<<<<<<<<<<4'],
+    ['P<UTOERIKSSON<<ANNA<MARIA<<<<<<<<<<<<<<<<<<<', 'L898902C36UTO7408122F1204159ZE184226B<<<<<10'],
+]
+
+
+def mutate(mrz_lines, rnd):
+    """A random corruption of the given MRZ: changed, removed or added characters (also ones invalid in MRZs), changed dates."""
+    lines = list(mrz_lines)
+    for _ in range(rnd.randint(0, 3)):
+        i = rnd.randrange(len(lines))
+        ln = lines[i]
+        j = rnd.randrange(len(ln) + 1)
+        op = rnd.choice(['change', 'change', 'digit', 'delete', 'insert', 'truncate', 'date'])
+        if op == 'change':
+            ln = ln[:j] + rnd.choice('ABCIPVZ0123456789<<<<a é\x00') + ln[j + 1:]
+        elif op == 'digit':
+            ln = ln[:j] + rnd.choice('0123456789') + ln[j + 1:]
+        elif op == 'delete':
+            ln = ln[:j] + ln[j + 1:]
+        elif op == 'insert':
+            ln = ln[:j] + rnd.choice('A0<') + ln[j:]
+        elif op == 'truncate':
+            ln = ln[:j]
+        else:
+            date = '%02d%02d%02d' % (rnd.randrange(100), rnd.randrange(14), rnd.randrange(33))
+            ln = ln[:j] + date + ln[j + 6:]
+        lines[i] = ln
+    return lines
+
+
+def as_dict(batch, i):
+    return OrderedDict((k, batch[k][i].item() if k == 'valid_score' else batch[k][i])
+                       for k in MRZ_FIELDS if batch[k][i] is not None or k == 'mrz_type')
+
+
+def test_parse_batch():
+    rnd = random.Random(1)
+    mrzs = VALID_MRZS + [mutate(rnd.choice(VALID_MRZS), rnd) for _ in range(3000)]
+    mrzs += [[], ['', 'x'], [1, 2, 3], ['a', 'b', 3], 'abc', 'ab', [b'x' * 30] * 3, ['x' * 50], ['<<<', '<<', '<']]
+    batch = parse_batch(mrzs)
+    for i, mrz_lines in enumerate(mrzs):
+        mrz = MRZ(mrz_lines)
+        d = mrz.to_dict()
+        assert as_dict(batch, i) == d and list(as_dict(batch, i)) == list(d), mrz_lines
+        assert batch['valid'][i] == mrz.valid
+    assert sum(batch['valid']) > len(VALID_MRZS) and not all(batch['valid'])
+    assert set(batch['mrz_type']) == {'TD1', 'TD2', 'TD3', 'MRVA', 'MRVB', None}
+    assert all(len(v) == 0 for v in parse_batch([]).values())
+
+
+def test_fast_paths():
+    rnd = random.Random(2)
+    cleaner, check_digit = MRZOCRCleaner.__instance__, MRZCheckDigit.__instance__
+    alphabet = 'ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789<<<<abcdefgiosz éß\x00'
+    for _ in range(2000):
+        txt = ''.join(rnd.choice(alphabet) for _ in range(rnd.randint(0, 50)))
+        # The check digit, as originally computed
+        res = sum([check_digit.CHECK_CODES.get(c, -1000)*[7, 3, 1][i % 3] for i, c in enumerate(txt)])
+        assert MRZCheckDigit.compute(txt) == ('' if txt == '' or res < 0 else str(res % 10)), txt
+        # The translate tables fix the lines the same way as _fix_char
+        tp = rnd.choice(list(cleaner.FORMAT))
+        i = rnd.randrange(len(cleaner.FORMAT[tp]))
+        assert cleaner._fix_line(txt, tp, i) == ''.join(cleaner._fix_char(c, tp, i, j) for j, c in enumerate(txt)), txt
+    dates = ['%02d%04d' % (y, md) for y in [0, 1, 4, 68, 69, 96, 99] for md in range(1333)]
+    dates += ['7412 1', '74123', '741', '7412311', '74١231', 'abcdef', '']
+    for ymd in dates:
+        try:
+            expected = bool(datetime.strptime(ymd, '%y%m%d'))
+        except ValueError:
+            expected = False
+        assert MRZ._check_date(ymd) == expected, ymd
+    assert not hasattr(MRZ([]), '__dict__')
+
+
+@pytest.mark.skipif(not os.environ.get('PASSPORTEYE_BENCHMARK'), reason='Set PASSPORTEYE_BENCHMARK=1 to run the benchmarks')
+def test_benchmark_from_ocr():
+    """The time per MRZ.from_ocr call on typical OCR output (valid and garbled MRZs of all types).
+    Run with `PASSPORTEYE_BENCHMARK=1 python -m pytest -s -k benchmark tests/text_test.py`. The call must take at most
+    PASSPORTEYE_BENCHMARK_MAX_US microseconds (by default 30, about twice the time it takes on a laptop, while before
+    the translate-table cleaner and check digits it took about 50)."""
+    rnd = random.Random(0)
+    texts = []
+    for lines in VALID_MRZS * 20:
+        text = '\n'.join(lines)
+        if rnd.random() < 0.5:
+            # Typical OCR errors: confused characters, lowercase, spaces
+            text = ''.join(rnd.choice(['O', 'o', 'l', ' ', c.lower()]) if c != '\n' and rnd.random() < 0.05 else c for c in text)
+        texts.append(text)
+    from_ocr = MRZ.from_ocr
+    runs = timeit.repeat(lambda: [from_ocr(t) for t in texts], number=10, repeat=5)
+    us_per_call = min(runs) / (10 * len(texts)) * 1e6
+    print('\nMRZ.from_ocr: %0.1f us per call' % us_per_call)
+    assert us_per_call <= float(os.environ.get('PASSPORTEYE_BENCHMARK_MAX_US', 30))